@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 import argparse
 import logging
+import types
 import warnings
 
 import paramiko
 
+from SFTPClient import Cache
 from SFTPClient import Client
+from SFTPClient import Connect
+from SFTPClient import MultiHost
+from SFTPClient import Throttle
 
 HELP_COMMAND_SPACING = 50  # Max length(+1) of sample commands in help files
 HELP_FILE_LOCATION = "help_files/"
@@ -20,8 +25,11 @@ def main():
 
     if args['verbose']:
         logging.basicConfig(level=logging.DEBUG)
-    host_name = args['host']
     user_name = args['username']
+    if args['inventory'] is not None:
+        hosts = MultiHost.read_inventory(args['inventory'], args['port'], user_name)
+    else:
+        hosts = [MultiHost.parse_host(host, args['port'], user_name) for host in args['host'].split(',') if host]
 
     password = None
     if 'password' in args and args['password'] is not None:
@@ -33,8 +41,15 @@ def main():
         # the user supplied private key password input
         private_key_password = args['private_key_password']
 
+    cache = None
+    if args['cache'] is not None:
+        cache = Cache.DownloadCache(args['cache'], args['cache_size'] * 1024 * 1024, args['cache_dedupe'])
+
     try:
-        cli = SFTPCLI(host_name, user_name, password, private_key_password)
+        cli = SFTPCLI(hosts, user_name, password, private_key_password, args['parallel'],
+                      keepalive=args['keepalive'], reconnect_attempts=args['reconnect_attempts'],
+                      ciphers=args['ciphers'], kex=args['kex'], download_cache=cache,
+                      rate_limit=args['limit'])
     except paramiko.SSHException:
         print("Unable to connect, please check user and server info.")
         return 1
@@ -48,6 +63,13 @@ def main():
             if isinstance(result, list):
                 for item in result:
                     print(item)
+            elif isinstance(result, types.GeneratorType):
+                # streamed output (cat, tail -f) is printed as it arrives; Ctrl-C stops it
+                try:
+                    for item in result:
+                        print(item, flush=True)
+                except KeyboardInterrupt:
+                    result.close()
             elif isinstance(result, str):
                 print(result)
         except (ValueError, FileNotFoundError, TypeError, PermissionError, IOError) as e:
@@ -61,21 +83,65 @@ def main():
 
 def capture_arguments():
     parser = argparse.ArgumentParser()
-    parser.add_argument('-H', '--host', help='Input host name', required=True)
+    parser.add_argument('-H', '--host', help='Input host name ([user@]host[:port]), or a comma separated list of hosts',
+                        required=False)
+    parser.add_argument('-I', '--inventory', help='File listing one [user@]host[:port] per line', required=False)
     parser.add_argument('-U', '--username', help='input username', required=True)
+    parser.add_argument('--port', help='SSH port (default 22)', required=False, type=int, default=22)
+    parser.add_argument('--parallel', help='Max hosts worked on at once in multi-host mode (default '
+                        + str(MultiHost.DEFAULT_MAX_WORKERS) + ')', required=False, type=int,
+                        default=MultiHost.DEFAULT_MAX_WORKERS)
+    parser.add_argument('--keepalive', help='Seconds between SSH keepalives, 0 to disable (default '
+                        + str(Client.KEEPALIVE_INTERVAL) + ')', required=False, type=int,
+                        default=Client.KEEPALIVE_INTERVAL)
+    parser.add_argument('--reconnect-attempts', help='Times to try reconnecting when the connection drops (default '
+                        + str(Client.RECONNECT_ATTEMPTS) + ')', required=False, type=int,
+                        default=Client.RECONNECT_ATTEMPTS)
+    parser.add_argument('--ciphers', help='Comma separated ciphers to prefer, fastest first (default: the profile '
+                        'saved by "bench --save", else ' + ','.join(Connect.PREFERRED_CIPHERS) + ')', required=False,
+                        type=lambda text: text.split(','))
+    parser.add_argument('--kex', help='Comma separated key exchange algorithms to prefer (default '
+                        + ','.join(Connect.PREFERRED_KEX) + ')', required=False,
+                        type=lambda text: text.split(','))
+    parser.add_argument('--cache', help='Cache downloads in DIR (default ' + Cache.DEFAULT_CACHE_DIRECTORY
+                        + ') so unchanged remote files are not fetched again', required=False, nargs='?',
+                        const=Cache.DEFAULT_CACHE_DIRECTORY, metavar='DIR')
+    parser.add_argument('--cache-size', help='Download cache size limit in MB, least recently used files are '
+                        'evicted (default ' + str(Cache.DEFAULT_MAX_BYTES // (1024 * 1024)) + ')', required=False,
+                        type=int, default=Cache.DEFAULT_MAX_BYTES // (1024 * 1024))
+    parser.add_argument('--cache-dedupe', help='Store cached downloads by content hash, so identical files are '
+                        'kept once', required=False, action='store_true')
+    parser.add_argument('--limit', help='Cap all transfers at RATE bytes/second, e.g. 500K or 20M (default: no '
+                        'limit; see the limit command)', required=False, type=Throttle.parse_rate, metavar='RATE')
     parser.add_argument('-P', '--password', help='input password', required=False)
     parser.add_argument('-p', '--private_key_password', help='Passphrase required to decrypt private key', required=False)
     parser.add_argument('-v', '--verbose', help='Verbose logging', required=False, action='store_true')
     parser.set_defaults(verbose=None)
     arguments = parser.parse_args()
+    if (arguments.host is None) == (arguments.inventory is None):
+        parser.error('exactly one of -H/--host and -I/--inventory is required')
     return arguments
 
 
 class SFTPCLI(object):
-    def __init__(self, hostname, username, password=None, private_key_password=None):
-        self.sftp = Client.SFTP(hostname, username, password, private_key_password)
-        print("Connection Successful!\n"
-              "Type a command or 'help' to see available commands")
+    def __init__(self, hosts, username, password=None, private_key_password=None,
+                 parallel=MultiHost.DEFAULT_MAX_WORKERS, **options):
+        # options (keepalive, reconnect_attempts, ciphers, kex, download_cache, rate_limit) go to every
+        # Client.SFTP connection
+        if len(hosts) == 1:
+            host = hosts[0]
+            self.sftp = Client.SFTP(host.hostname, host.username or username, password, private_key_password,
+                                    port=host.port, **options)
+            print("Connection Successful!\n"
+                  "Type a command or 'help' to see available commands")
+        else:
+            self.sftp = MultiHost.MultiSFTP(hosts, username, password, private_key_password, parallel, **options)
+            if not self.sftp.clients:
+                raise paramiko.SSHException('Unable to connect to any host')
+            print("Connected to " + str(len(self.sftp.clients)) + " of " + str(len(hosts)) + " hosts\n"
+                  "Commands run on every host; type a command or 'help' to see available commands")
+            for label, error in self.sftp.errors.items():
+                print(label + ": FAILED: " + str(error))
 
     def execute_command(self, cmd):
         """Find and execute the command"""
@@ -0,0 +1,208 @@
+import gzip
+import logging
+import os
+import posixpath
+import shlex
+import tarfile
+import threading
+
+import paramiko
+
+# Compression applied to archive streams. zstd needs the optional "zstandard" package locally
+# and the zstd command on the server.
+COMPRESSIONS = ('gzip', 'zstd')
+# Fast levels: the stream is compressed while it is sent, so speed matters more than ratio
+GZIP_LEVEL = 1
+ZSTD_LEVEL = 3
+# Exit status of a shell that could not find the command (e.g. no tar on the server)
+COMMAND_NOT_FOUND = 127
+# Bytes of a remote command's stderr kept for its error message (the last ones)
+MAX_STDERR = 64 * 1024
+
+
+class ExecUnavailable(IOError):
+    """The server refused the exec request, or lacks the commands needed on its side"""
+
+
+def check_compression(compression):
+    """Raise ValueError unless compression is None or one of COMPRESSIONS usable here"""
+    if compression is None:
+        return
+    if compression not in COMPRESSIONS:
+        raise ValueError('Unsupported compression ' + repr(compression) + ', use one of: ' + ', '.join(COMPRESSIONS))
+    if compression == 'zstd':
+        try:
+            import zstandard  # noqa: F401
+        except ImportError:
+            raise ValueError('zstd compression requires the zstandard package ("pip install zstandard")')
+
+
+class _ChannelWriter(object):
+    """File-like object writing to an SSH channel's stdin (enough for tarfile and the compressors)"""
+
+    def __init__(self, channel):
+        self.channel = channel
+
+    def write(self, data):
+        self.channel.sendall(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def open_exec(connection, command):
+    """Start command in a new exec channel on the connection's transport"""
+    transport = connection.sftp_client.get_channel().get_transport()
+    channel = transport.open_session()
+    try:
+        channel.exec_command(command)
+    except paramiko.SSHException as e:
+        channel.close()
+        raise ExecUnavailable('exec not available: ' + str(e))
+    return channel
+
+
+class StderrReader(object):
+    """Reads an exec channel's stderr in a thread, as it arrives
+
+        stderr shares the channel's window with stdout: left unread, a command writing many
+        warnings fills it, and neither its output nor its exit status ever arrives. Only the last
+        MAX_STDERR bytes are kept; text() returns them once the stream has ended.
+    """
+
+    def __init__(self, channel):
+        self._channel = channel
+        self._data = bytearray()
+        self._thread = threading.Thread(target=self._run, name='exec-stderr', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        try:
+            while True:
+                data = self._channel.recv_stderr(32768)
+                if not data:
+                    return
+                self._data += data
+                del self._data[:-MAX_STDERR]
+        except (OSError, paramiko.SSHException) as e:
+            logging.debug('reading stderr failed: ' + str(e))
+
+    def text(self):
+        """The stderr of the command, waiting for it to end (or the channel to close)"""
+        self._thread.join()
+        return self._data.decode('utf-8', 'replace').strip()
+
+
+def _finish(channel, command, stderr):
+    """Wait for the remote command and raise if it failed"""
+    status = channel.recv_exit_status()
+    errors = stderr.text()
+    channel.close()
+    if status == COMMAND_NOT_FOUND:
+        raise ExecUnavailable('command not found on the server: ' + errors)
+    if status != 0:
+        raise IOError('remote ' + command + ' failed (exit status ' + str(status) + '): ' + errors)
+
+
+def upload_tree(connection, localdir, remotedir, compression=None):
+    """Upload the local tree localdir into remotedir as one tar stream extracted by the server
+
+        The tar is generated (and optionally compressed) as it is sent over an exec channel to
+        "tar -x" on the server, so nothing is staged on either side and there is no per-file
+        round trip. File modes and mtimes are preserved by tar. Raises ExecUnavailable if the
+        server does not allow remote commands or lacks tar (or zstd).
+
+        :param connection: a pysftp.Connection
+        :param remotedir: directory the tree is extracted into (created if missing); relative
+            paths are taken from the SFTP working directory
+    """
+    check_compression(compression)
+    # exec channels start in the home directory, not the SFTP working directory
+    target = shlex.quote(posixpath.join(connection.normalize('.'), remotedir or '.'))
+    extract = {None: 'tar -xf - -C ' + target,
+               'gzip': 'tar -xzf - -C ' + target,
+               'zstd': 'command -v zstd >/dev/null || exit 127; zstd -dcq | tar -xf - -C ' + target}[compression]
+    command = 'mkdir -p ' + target + ' && ' + extract
+    logging.debug('Streaming ' + localdir + ' to: ' + command)
+    channel = open_exec(connection, command)
+    stderr = StderrReader(channel)
+    try:
+        writer = _ChannelWriter(channel)
+        if compression == 'gzip':
+            stream = gzip.GzipFile(fileobj=writer, mode='wb', compresslevel=GZIP_LEVEL)
+        elif compression == 'zstd':
+            import zstandard
+            stream = zstandard.ZstdCompressor(level=ZSTD_LEVEL).stream_writer(writer, closefd=False)
+        else:
+            stream = writer
+        try:
+            with tarfile.open(fileobj=stream, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+                tar.add(localdir, arcname=os.path.basename(os.path.normpath(localdir)))
+        finally:
+            if stream is not writer:
+                stream.close()
+        channel.shutdown_write()
+    except (OSError, EOFError, paramiko.SSHException) as e:
+        # the remote side went away early; its exit status says why
+        logging.debug('archive stream interrupted: ' + str(e))
+        if channel.exit_status_ready():
+            _finish(channel, command, stderr)
+        channel.close()
+        raise
+    _finish(channel, command, stderr)
+
+
+def _extract_stream(reader, localdir):
+    """Extract a tar stream into localdir, refusing members that would land outside it"""
+    with tarfile.open(fileobj=reader, mode='r|') as tar:
+        if hasattr(tarfile, 'data_filter'):
+            tar.extractall(localdir, filter='data')
+            return
+        root = os.path.realpath(localdir)
+        for member in tar:
+            path = os.path.realpath(os.path.join(root, member.name))
+            if os.path.commonpath([root, path]) != root or member.issym() or member.islnk() or member.isdev():
+                raise IOError('refusing to extract ' + member.name + ' outside ' + localdir)
+            tar.extract(member, root)
+
+
+def download_tree(connection, remotedir, localdir, compression=None):
+    """Download the remote tree remotedir into localdir as one tar stream created by the server
+
+        "tar -c" runs on the server over an exec channel and its output (optionally compressed on
+        the wire) is extracted as it arrives, without an intermediate archive file and without a
+        round trip per file or directory. Modes and mtimes are preserved. Raises ExecUnavailable
+        if the server does not allow remote commands or lacks tar (or zstd).
+
+        :param connection: a pysftp.Connection
+        :param remotedir: remote directory; relative paths are taken from the SFTP working directory
+    """
+    check_compression(compression)
+    remotedir = connection.normalize(remotedir)
+    parent, name = posixpath.split(remotedir.rstrip('/') or '/')
+    create = 'tar -cf - -C ' + shlex.quote(parent or '/') + ' ' + shlex.quote(name or '.')
+    command = {None: create,
+               'gzip': create.replace('tar -cf', 'tar -czf', 1),
+               'zstd': 'command -v zstd >/dev/null || exit 127; ' + create + ' | zstd -cq -' + str(ZSTD_LEVEL)}[compression]
+    logging.debug('Streaming ' + remotedir + ' from: ' + command)
+    os.makedirs(localdir, exist_ok=True)
+    channel = open_exec(connection, command)
+    stderr = StderrReader(channel)
+    try:
+        channel.shutdown_write()
+        reader = channel.makefile('rb')
+        if compression == 'gzip':
+            reader = gzip.GzipFile(fileobj=reader, mode='rb')
+        elif compression == 'zstd':
+            import zstandard
+            reader = zstandard.ZstdDecompressor().stream_reader(reader)
+        _extract_stream(reader, localdir)
+    except (tarfile.TarError, OSError, EOFError, paramiko.SSHException) as e:
+        # a truncated stream usually means the remote command failed; its exit status says why
+        logging.debug('archive stream interrupted: ' + str(e))
+        if channel.eof_received:
+            _finish(channel, command, stderr)
+        channel.close()
+        raise IOError('archive download of ' + remotedir + ' failed: ' + str(e))
+    _finish(channel, command, stderr)
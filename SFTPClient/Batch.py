@@ -0,0 +1,325 @@
+import collections
+import fnmatch
+import posixpath
+import re
+import stat
+
+from paramiko.sftp import (CMD_ATTRS, CMD_CLOSE, CMD_HANDLE, CMD_LSTAT, CMD_MKDIR, CMD_NAME, CMD_OPENDIR,
+                          CMD_READDIR, CMD_REMOVE, CMD_RENAME, CMD_RMDIR, CMD_SETSTAT, CMD_STAT, CMD_STATUS, SFTPError)
+from paramiko.sftp_attr import SFTPAttributes
+
+from SFTPClient.Transfer import MAX_IN_FLIGHT, Pipeline
+
+# READDIR requests kept outstanding per directory while walking (each returns up to ~100 entries)
+READDIR_AHEAD = 4
+GLOB_CHARACTERS = re.compile('[*?[]')
+
+
+def _check(sftp, t, msg, expected):
+    """Raise IOError (or EOFError at the end of a directory) unless the reply has the expected type"""
+    if t == CMD_STATUS:
+        sftp._convert_status(msg)
+    if t != expected:
+        raise SFTPError('Unexpected response type ' + str(t))
+
+
+def request_pipelined(sftp, requests, in_flight=MAX_IN_FLIGHT):
+    """Send requests while keeping in_flight of them outstanding, yielding the replies as they arrive
+
+        requests is an iterable of (key, type, *args), consumed lazily, so it may itself be a
+        generator issuing requests on the same channel (e.g. walk()). Path arguments must
+        already be adjusted to the working directory (sftp._adjust_cwd). Yields (key, type, msg)
+        in arrival order.
+    """
+    pipeline = Pipeline(sftp)
+    requests = iter(requests)
+    pending = {}
+    exhausted = False
+    while pending or not exhausted:
+        while not exhausted and len(pending) < in_flight:
+            try:
+                key, t, *args = next(requests)
+            except StopIteration:
+                exhausted = True
+                break
+            pending[pipeline.send(t, *args)] = key
+        if pending:
+            num, t, msg = pipeline.wait_any(list(pending))
+            yield pending.pop(num), t, msg
+
+
+def status_pipelined(sftp, requests, in_flight=MAX_IN_FLIGHT):
+    """Like request_pipelined for requests answered with a STATUS; yields (key, IOError or None)"""
+    for key, t, msg in request_pipelined(sftp, requests, in_flight):
+        try:
+            _check(sftp, t, msg, CMD_STATUS)
+            yield key, None
+        except (IOError, SFTPError) as e:
+            yield key, e
+
+
+def stat_pipelined(sftp, paths, command, in_flight=MAX_IN_FLIGHT):
+    """STAT or LSTAT (command) many paths at once; yields (path, SFTPAttributes or IOError)"""
+    requests = ((path, command, sftp._adjust_cwd(path)) for path in paths)
+    for path, t, msg in request_pipelined(sftp, requests, in_flight):
+        try:
+            _check(sftp, t, msg, CMD_ATTRS)
+            yield path, SFTPAttributes._from_msg(msg)
+        except (IOError, SFTPError) as e:
+            yield path, e
+
+
+def stat_many(sftp, paths, in_flight=MAX_IN_FLIGHT):
+    """STAT many paths at once; returns a dict of path -> SFTPAttributes or IOError"""
+    return dict(stat_pipelined(sftp, paths, CMD_STAT, in_flight))
+
+
+def walk(sftp, top, onerror=None, in_flight=MAX_IN_FLIGHT, recursive=True):
+    """Yield (path, SFTPAttributes) for everything below the remote directory top
+
+        Unlike pysftp's walktree, which lists one directory per round trip, directories are
+        opened and read concurrently over a single pipeline: every directory found is queued,
+        READDIR_AHEAD READDIRs are kept outstanding per directory and up to in_flight requests
+        in total. Entries come in no particular order, and the attributes are those of the
+        listing (lstat: symbolic links are reported, not followed). A directory that cannot be
+        read is passed to onerror(path, error), or raises if onerror is None. With recursive
+        False only top itself is listed. top may also be a list of directories, listed together.
+    """
+    pipeline = Pipeline(sftp)
+    waiting = collections.deque([top] if isinstance(top, str) else top)
+    # request number -> directory; a directory is [path, handle (None while opening), READDIRs outstanding, done]
+    pending = {}
+
+    def read(directory):
+        directory[2] += 1
+        pending[pipeline.send(CMD_READDIR, directory[1])] = directory
+
+    def finish(directory, error=None):
+        directory[3] = True
+        if directory[2] == 0:
+            pipeline.send(CMD_CLOSE, directory[1])
+        if error is not None:
+            if onerror is None:
+                raise error
+            onerror(directory[0], error)
+
+    try:
+        while waiting or pending:
+            while waiting and len(pending) < in_flight:
+                path = waiting.popleft()
+                pending[pipeline.send(CMD_OPENDIR, sftp._adjust_cwd(path))] = [path, None, 0, False]
+            num, t, msg = pipeline.wait_any(list(pending))
+            directory = pending.pop(num)
+            if directory[1] is None:
+                try:
+                    _check(sftp, t, msg, CMD_HANDLE)
+                except (IOError, SFTPError) as e:
+                    if onerror is None:
+                        raise
+                    onerror(directory[0], e)
+                    continue
+                directory[1] = msg.get_binary()
+                for _ in range(READDIR_AHEAD):
+                    read(directory)
+                continue
+            directory[2] -= 1
+            if directory[3]:
+                # a READDIR sent before the end of the directory was seen
+                finish(directory)
+                continue
+            try:
+                _check(sftp, t, msg, CMD_NAME)
+            except EOFError:
+                finish(directory)
+                continue
+            except (IOError, SFTPError) as e:
+                finish(directory, e)
+                continue
+            for _ in range(msg.get_int()):
+                filename = msg.get_text()
+                attr = SFTPAttributes._from_msg(msg, filename, msg.get_text())
+                if filename in ('.', '..'):
+                    continue
+                child = posixpath.join(directory[0], filename)
+                if recursive and stat.S_ISDIR(attr.st_mode):
+                    waiting.append(child)
+                yield child, attr
+            read(directory)
+    finally:
+        # close the directories still open if the walk is abandoned part way
+        for num, directory in list(pending.items()):
+            try:
+                t, msg = pipeline.wait(num)
+                if directory[1] is None:
+                    if t == CMD_HANDLE:
+                        pipeline.send(CMD_CLOSE, msg.get_binary())
+                    continue
+                directory[2] -= 1
+                if directory[2] == 0:
+                    pipeline.send(CMD_CLOSE, directory[1])
+            except Exception:
+                break
+
+
+def chmod(sftp, paths, mode, recursive=False, in_flight=MAX_IN_FLIGHT):
+    """Apply a Modes.ModeChange to paths (and everything below them if recursive)
+
+        The paths are stat'ed together, directories are walked concurrently (see walk()) and the
+        SETSTAT requests are pipelined with the listing. Entries that already have the mode are
+        skipped using the attributes from the listing, and symbolic links found while walking
+        are not followed. Returns (changed, unchanged, [(path, error), ...]).
+    """
+    counts = {'changed': 0, 'unchanged': 0}
+    failures = []
+
+    def change(path, attr):
+        is_dir = stat.S_ISDIR(attr.st_mode)
+        new_mode = mode.new_mode(attr.st_mode, is_dir)
+        if new_mode == stat.S_IMODE(attr.st_mode):
+            counts['unchanged'] += 1
+            return None
+        request = SFTPAttributes()
+        request.st_mode = new_mode
+        return path, CMD_SETSTAT, sftp._adjust_cwd(path), request
+
+    def requests():
+        for path, attr in stat_pipelined(sftp, paths, CMD_STAT, in_flight):
+            if isinstance(attr, Exception):
+                failures.append((path, attr))
+                continue
+            request = change(path, attr)
+            if request is not None:
+                yield request
+            if recursive and stat.S_ISDIR(attr.st_mode):
+                for child, child_attr in walk(sftp, path, lambda p, e: failures.append((p, e)), in_flight):
+                    if not stat.S_ISLNK(child_attr.st_mode):
+                        request = change(child, child_attr)
+                        if request is not None:
+                            yield request
+
+    for path, error in status_pipelined(sftp, requests(), in_flight):
+        if error is None:
+            counts['changed'] += 1
+        else:
+            failures.append((path, error))
+    return counts['changed'], counts['unchanged'], failures
+
+
+def has_magic(path):
+    return GLOB_CHARACTERS.search(path) is not None
+
+
+def glob(sftp, pattern):
+    """Return sorted (path, SFTPAttributes) for the remote entries matching a shell-style pattern
+
+        Wildcards may appear in any path component; each directory involved is listed once (see
+        walk()). As in the shell, names starting with '.' only match patterns that do too.
+    """
+    head, tail = posixpath.split(pattern)
+    if has_magic(head):
+        directories = [path for path, attr in glob(sftp, head) if stat.S_ISDIR(attr.st_mode)]
+    else:
+        directories = [head]
+    if not has_magic(tail):
+        matches = stat_pipelined(sftp, [posixpath.join(directory, tail) for directory in directories], CMD_LSTAT)
+        return sorted(((path, attr) for path, attr in matches if not isinstance(attr, Exception)),
+                      key=lambda match: match[0])
+    matches = []
+    for directory in directories:
+        for path, attr in walk(sftp, directory or '.', recursive=False):
+            name = posixpath.basename(path)
+            if fnmatch.fnmatchcase(name, tail) and (tail.startswith('.') or not name.startswith('.')):
+                matches.append((posixpath.join(directory, name), attr))
+    return sorted(matches, key=lambda match: match[0])
+
+
+def expand(sftp, targets):
+    """Resolve paths and patterns to [(path, SFTPAttributes or IOError)] (lstat, in the order given)
+
+        Plain paths are lstat'ed together; a pattern matching nothing gives an IOError.
+    """
+    attrs = dict(stat_pipelined(sftp, [target for target in targets if not has_magic(target)], CMD_LSTAT))
+    entries = []
+    for target in targets:
+        if not has_magic(target):
+            entries.append((target, attrs[target]))
+            continue
+        try:
+            matches = glob(sftp, target)
+        except IOError as e:
+            entries.append((target, e))
+            continue
+        if not matches:
+            entries.append((target, IOError('No match for ' + target)))
+        entries.extend(matches)
+    return entries
+
+
+def remove(sftp, paths, in_flight=MAX_IN_FLIGHT):
+    """Remove remote files with pipelined requests; yields (path, IOError or None) as they complete"""
+    return status_pipelined(sftp, ((path, CMD_REMOVE, sftp._adjust_cwd(path)) for path in paths), in_flight)
+
+
+def mkdir(sftp, paths, mode=0o777, in_flight=MAX_IN_FLIGHT):
+    """Create remote directories with pipelined requests; yields (path, IOError or None)
+
+        The requests run concurrently, so the parents of paths must already exist.
+    """
+    attr = SFTPAttributes()
+    attr.st_mode = mode
+    return status_pipelined(sftp, ((path, CMD_MKDIR, sftp._adjust_cwd(path), attr) for path in paths), in_flight)
+
+
+def rmdir(sftp, paths, in_flight=MAX_IN_FLIGHT):
+    """Remove empty remote directories with pipelined requests; yields (path, IOError or None)"""
+    return status_pipelined(sftp, ((path, CMD_RMDIR, sftp._adjust_cwd(path)) for path in paths), in_flight)
+
+
+def rename(sftp, renames, in_flight=MAX_IN_FLIGHT):
+    """Rename (old, new) pairs with pipelined requests; yields ((old, new), IOError or None)
+
+        The renames run concurrently, so no pair may be renamed onto another pair's source (see
+        check_renames()). SFTP rename does not overwrite existing files.
+    """
+    requests = (((old, new), CMD_RENAME, sftp._adjust_cwd(old), sftp._adjust_cwd(new)) for old, new in renames)
+    return status_pipelined(sftp, requests, in_flight)
+
+
+def regex_renames(names, pattern, replacement):
+    """(old, new) for the names matching a regular expression, replacing the first match (\\1 for groups)"""
+    regex = re.compile(pattern)
+    return [(name, regex.sub(replacement, name, count=1)) for name in sorted(names) if regex.search(name)]
+
+
+def template_renames(names, pattern, template):
+    """(old, new) for the names matching a shell-style pattern, named by a printf-style template
+
+        The template may use %(n)d (1, 2, ... in name order), %(name)s, %(stem)s and %(ext)s,
+        e.g. "photo_%(n)03d%(ext)s"; a template with a single plain conversion ("%03d.txt") is
+        given n.
+    """
+    renames = []
+    for n, name in enumerate(sorted(name for name in names if fnmatch.fnmatchcase(name, pattern)), 1):
+        stem, ext = posixpath.splitext(name)
+        fields = {'n': n, 'name': name, 'stem': stem, 'ext': ext}
+        try:
+            renames.append((name, template % fields if '%(' in template else template % n))
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError('Invalid template ' + repr(template) + ': ' + str(e))
+    return renames
+
+
+def check_renames(renames):
+    """Drop renames that change nothing and raise ValueError for ones that would collide"""
+    renames = [(old, new) for old, new in renames if old != new]
+    sources = set(old for old, _new in renames)
+    targets = set()
+    for old, new in renames:
+        if not posixpath.basename(new):
+            raise ValueError('Renaming ' + old + ' would give an empty name')
+        if new in targets:
+            raise ValueError('More than one file would be renamed to ' + new)
+        if new in sources:
+            raise ValueError(old + ' would be renamed onto ' + new + ', which is renamed too; rename in two steps')
+        targets.add(new)
+    return renames
@@ -0,0 +1,153 @@
+import logging
+import os
+import statistics
+import time
+
+import paramiko
+from paramiko.sftp import CMD_ATTRS, CMD_STAT, SFTPError
+
+from SFTPClient import Transfer
+
+# Bytes sent in each direction per configuration
+DEFAULT_SIZE = 8 * 1024 * 1024
+# Small requests used to measure the round-trip time
+RTT_REQUESTS = 50
+# Cipher used while comparing MACs (AEAD ciphers such as AES-GCM do not use a separate MAC)
+MAC_TEST_CIPHER = 'aes128-ctr'
+AEAD_CIPHERS = ('aes128-gcm@openssh.com', 'aes256-gcm@openssh.com', 'chacha20-poly1305@openssh.com')
+# Measured, but never recommended: CBC modes, 3DES and MD5/truncated MACs are considered weak
+WEAK_ALGORITHMS = ('aes128-cbc', 'aes192-cbc', 'aes256-cbc', '3des-cbc', 'hmac-md5', 'hmac-md5-96', 'hmac-sha1-96')
+# Remote scratch file, created in the remote working directory and removed afterwards
+SCRATCH_FILE = '.sftp_bench.tmp'
+
+
+def measure_rtt(sftp, requests=RTT_REQUESTS):
+    """Time small STAT requests, one at a time and then pipelined
+
+        Returns (median round-trip time in seconds, pipelined requests per second).
+    """
+    samples = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        sftp.stat('.')
+        samples.append(time.perf_counter() - start)
+
+    pipeline = Transfer.Pipeline(sftp)
+    start = time.perf_counter()
+    nums = [pipeline.send(CMD_STAT, '.') for _ in range(requests)]
+    for num in nums:
+        t, _msg = pipeline.wait(num)
+        if t != CMD_ATTRS:
+            raise SFTPError('Expected attributes')
+    return statistics.median(samples), requests / (time.perf_counter() - start)
+
+
+def measure_throughput(sftp, data):
+    """Upload data to a scratch file and read it back with the pipelined transfers
+
+        Returns (upload bytes/second, download bytes/second).
+    """
+    try:
+        start = time.perf_counter()
+        with sftp.open(SCRATCH_FILE, 'wb') as f:
+            Transfer.write_pipelined(sftp, f.handle, data)
+        upload = len(data) / (time.perf_counter() - start)
+
+        start = time.perf_counter()
+        with sftp.open(SCRATCH_FILE, 'rb') as f:
+            Transfer.read_pipelined(sftp, f.handle, len(data), lambda offset, block: None)
+        download = len(data) / (time.perf_counter() - start)
+    finally:
+        try:
+            sftp.remove(SCRATCH_FILE)
+        except IOError:
+            pass
+    return upload, download
+
+
+def configurations():
+    """The settings to compare: every cipher, every MAC (with MAC_TEST_CIPHER) and compression off/on
+
+        Yields (setting, value, connection options) for the algorithms the installed paramiko
+        implements; whether the server accepts them is only known once connected.
+    """
+    for cipher in paramiko.Transport._preferred_ciphers:
+        yield 'cipher', cipher, {'ciphers': [cipher], 'compression': False}
+    for mac in paramiko.Transport._preferred_macs:
+        yield 'mac', mac, {'ciphers': [MAC_TEST_CIPHER], 'macs': [mac], 'compression': False}
+    for compression in (False, True):
+        yield 'compression', compression, {'compression': compression}
+
+
+def negotiated(transport, setting, value):
+    """Whether the server agreed to the setting being measured"""
+    if setting == 'cipher':
+        return transport.local_cipher == value
+    if setting == 'mac':
+        return transport.local_cipher == MAC_TEST_CIPHER and transport.local_mac == value
+    return (transport.local_compression != 'none') == value
+
+
+def run(connect, size=DEFAULT_SIZE, data=None):
+    """Benchmark every configuration, returning one result dict per setting tried
+
+        :param connect: callable taking connection options (see configurations()) as keyword
+            arguments and returning a connected pysftp.Connection, e.g. SFTP.initiate_connection
+        :param data: payload to transfer (default: size random bytes, which compression cannot shrink)
+    """
+    data = data if data is not None else os.urandom(size)
+    results = []
+    for setting, value, options in configurations():
+        result = {'setting': setting, 'value': value}
+        results.append(result)
+        try:
+            connection = connect(**options)
+        except (paramiko.SSHException, EOFError, OSError) as e:
+            logging.debug('bench: ' + setting + ' ' + str(value) + ' not negotiable: ' + str(e))
+            result['error'] = 'not negotiable'
+            continue
+        try:
+            sftp = connection.sftp_client
+            if not negotiated(sftp.get_channel().get_transport(), setting, value):
+                result['error'] = 'not supported by the server'
+                continue
+            result['rtt'], result['requests_per_second'] = measure_rtt(sftp)
+            result['upload_bps'], result['download_bps'] = measure_throughput(sftp, data)
+        finally:
+            connection.close()
+    return results
+
+
+def recommend(results):
+    """Build a connection profile from the fastest cipher, MAC and compression setting (weak ones excluded)"""
+    def fastest(setting):
+        measured = [r for r in results if r['setting'] == setting and 'error' not in r
+                    and r['value'] not in WEAK_ALGORITHMS]
+        if not measured:
+            return None
+        return max(measured, key=lambda r: r['upload_bps'] + r['download_bps'])['value']
+
+    profile = {}
+    cipher, mac, compression = fastest('cipher'), fastest('mac'), fastest('compression')
+    if cipher is not None:
+        profile['ciphers'] = [cipher]
+    if mac is not None and cipher not in AEAD_CIPHERS:
+        profile['macs'] = [mac]
+    if compression is not None:
+        profile['compression'] = compression
+    return profile
+
+
+def format_results(results):
+    """One line per result: setting, RTT, pipelined request rate and throughput in each direction"""
+    lines = ['{:<12s} {:<32s} {:>9s} {:>10s} {:>12s} {:>12s}'.format('setting', 'value', 'rtt ms', 'req/s',
+                                                                     'up MB/s', 'down MB/s')]
+    for r in results:
+        if 'error' in r:
+            lines.append('{:<12s} {:<32s} {}'.format(r['setting'], str(r['value']), r['error']))
+        else:
+            lines.append('{:<12s} {:<32s} {:>9.2f} {:>10.0f} {:>12.2f} {:>12.2f}{}'.format(
+                r['setting'], str(r['value']), r['rtt'] * 1000, r['requests_per_second'],
+                r['upload_bps'] / 1e6, r['download_bps'] / 1e6,
+                ' (weak, not recommended)' if r['value'] in WEAK_ALGORITHMS else ''))
+    return lines
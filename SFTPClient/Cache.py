@@ -0,0 +1,196 @@
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import time
+
+DEFAULT_CACHE_DIRECTORY = '~/.cache/sftpclient'
+DEFAULT_MAX_BYTES = 1024 ** 3
+# ioctl that makes dst a copy-on-write clone of src (Linux btrfs/XFS/...), see ioctl_ficlone(2)
+FICLONE = 0x40049409
+HASH_BLOCK_SIZE = 1024 * 1024
+# objects shared by several entries are only counted once
+USED_BYTES = 'SELECT COALESCE(SUM(size), 0) FROM (SELECT DISTINCT object, size FROM entries)'
+
+
+def cache_key(hostname, port, username, remotepath, size, mtime):
+    """Identify a version of a remote file: it is assumed unchanged while its size and mtime are"""
+    return '\0'.join([username or '', hostname, str(port), remotepath, str(size), str(int(mtime))])
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def clone(src, dst):
+    """Make dst a reflink of src if the filesystem supports it, else a hardlink, else a copy
+
+        dst is replaced atomically. Returns 'reflink', 'link' or 'copy'.
+    """
+    directory = os.path.dirname(os.path.abspath(dst))
+    fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(dst) + '.', dir=directory)
+    try:
+        method = None
+        try:
+            import fcntl
+            with open(src, 'rb') as source:
+                fcntl.ioctl(fd, FICLONE, source.fileno())
+            shutil.copystat(src, temp_path)
+            method = 'reflink'
+        except (ImportError, OSError) as e:
+            logging.debug('reflink unavailable: ' + str(e))
+        os.close(fd)
+        fd = None
+        if method is None:
+            os.remove(temp_path)
+            try:
+                os.link(src, temp_path)
+                method = 'link'
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP):
+                    raise
+                shutil.copy2(src, temp_path)
+                method = 'copy'
+        os.replace(temp_path, dst)
+        return method
+    except BaseException:
+        if fd is not None:
+            os.close(fd)
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class DownloadCache(object):
+    """Local cache of downloaded files, so unchanged remote files are not transferred again
+
+        Entries are keyed by remote host, path, size and mtime (see cache_key), and point at an
+        object file in <directory>/objects. With content_hash, objects are named by the SHA-256
+        of their contents, so identical files from different paths or hosts are stored once (and
+        are checked by digest when fetched); otherwise they are named by the hash of their key.
+        A hit is cloned into the destination (reflink, hardlink or copy, see clone()). Once the
+        objects exceed max_bytes, the least recently used entries are evicted. The index is an
+        SQLite database, so several clients (threads or processes) can share a cache directory.
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY, max_bytes=DEFAULT_MAX_BYTES, content_hash=False):
+        self.directory = os.path.expanduser(directory)
+        self.objects = os.path.join(self.directory, 'objects')
+        self.max_bytes = max_bytes
+        self.content_hash = content_hash
+        os.makedirs(self.objects, exist_ok=True)
+        with self._index() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, object TEXT NOT NULL, '
+                       'size INTEGER NOT NULL, mtime INTEGER NOT NULL, last_used REAL NOT NULL)')
+            db.execute('CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)')
+
+    def _index(self):
+        # one connection per call: sqlite3 connections cannot be shared between threads
+        return sqlite3.connect(os.path.join(self.directory, 'index.sqlite'), timeout=30, isolation_level=None)
+
+    def _object_path(self, name):
+        return os.path.join(self.objects, name)
+
+    def fetch(self, key, localpath):
+        """Clone the cached copy of key to localpath; returns False (a miss) if there is none"""
+        db = self._index()
+        try:
+            row = db.execute('SELECT object, size, mtime FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return False
+            name, size, mtime = row
+            path = self._object_path(name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                stat = None
+            # objects may be hardlinked to downloads; one edited in place no longer matches. An object
+            # named by its digest may be shared by files with different mtimes, so it is checked by digest
+            if stat is None or stat.st_size != size or (file_digest(path) != name if self.content_hash
+                                                        else int(stat.st_mtime) != mtime):
+                logging.debug('Dropping stale cache entry for ' + localpath)
+                self._delete(db, key, name)
+                return False
+            db.execute('UPDATE entries SET last_used = ? WHERE key = ?', (time.time(), key))
+        finally:
+            db.close()
+        logging.debug('Cache hit for ' + localpath + ' (' + clone(path, localpath) + ')')
+        return True
+
+    def store(self, key, localpath):
+        """Add a downloaded file to the cache, then evict
+
+            The entry records the size and mtime of the object it points at (an existing object
+            with the same contents, with content_hash), which fetch() checks it against.
+        """
+        name = file_digest(localpath) if self.content_hash else hashlib.sha256(key.encode('utf-8')).hexdigest()
+        path = self._object_path(name)
+        if not os.path.exists(path):
+            clone(localpath, path)
+        stat = os.stat(path)
+        db = self._index()
+        try:
+            db.execute('INSERT OR REPLACE INTO entries (key, object, size, mtime, last_used) VALUES (?, ?, ?, ?, ?)',
+                       (key, name, stat.st_size, int(stat.st_mtime), time.time()))
+            self._evict(db)
+        finally:
+            db.close()
+
+    def discard(self, key):
+        """Remove the entry for key (e.g. when its contents turned out to be out of date)"""
+        db = self._index()
+        try:
+            row = db.execute('SELECT object FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                self._delete(db, key, row[0])
+        finally:
+            db.close()
+
+    def _delete(self, db, key, name):
+        """Delete an entry, and its object unless another entry shares it; returns whether the object went"""
+        db.execute('DELETE FROM entries WHERE key = ?', (key,))
+        if db.execute('SELECT 1 FROM entries WHERE object = ? LIMIT 1', (name,)).fetchone() is not None:
+            return False
+        try:
+            os.remove(self._object_path(name))
+        except FileNotFoundError:
+            pass
+        return True
+
+    def _evict(self, db):
+        """Remove least recently used entries until the objects fit in max_bytes"""
+        total = db.execute(USED_BYTES).fetchone()[0]
+        while total > self.max_bytes:
+            row = db.execute('SELECT key, object, size FROM entries ORDER BY last_used LIMIT 1').fetchone()
+            if row is None:
+                break
+            key, name, size = row
+            if self._delete(db, key, name):
+                total -= size
+            logging.debug('Evicted cache entry ' + name)
+
+    def stats(self):
+        """Return (number of entries, number of objects, bytes used)"""
+        db = self._index()
+        try:
+            entries, objects = db.execute('SELECT COUNT(*), COUNT(DISTINCT object) FROM entries').fetchone()
+            used = db.execute(USED_BYTES).fetchone()[0]
+        finally:
+            db.close()
+        return entries, objects, used
+
+    def clear(self):
+        db = self._index()
+        try:
+            db.execute('DELETE FROM entries')
+        finally:
+            db.close()
+        shutil.rmtree(self.objects)
+        os.makedirs(self.objects)
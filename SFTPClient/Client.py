@@ -1,24 +1,89 @@
+import codecs
+import collections
+import itertools
+import json
 import logging
 import paramiko
 import pysftp
 import ntpath
 import os
+import posixpath
+import re
+import stat
 
 from paramiko import ssh_exception
 from functools import wraps
 import tempfile
+import threading
+import time
 import shutil
 
+from SFTPClient import Archive
+from SFTPClient import Batch
+from SFTPClient import Bench
+from SFTPClient import Cache
+from SFTPClient import Connect
+from SFTPClient import Diff
+from SFTPClient import Grep
+from SFTPClient import Integrity
+from SFTPClient import Mirror
+from SFTPClient import Modes
+from SFTPClient import Peek
+from SFTPClient import Stream
+from SFTPClient import Throttle
+from SFTPClient import Transfer
+from SFTPClient import Watch
+
 DOWNLOADS_DIRECTORY = "downloads"
 HISTORY_FILE = "command_history.txt"
+MANIFEST_FILE = "transfer_manifest.txt"
+
+# Seconds between SSH keepalive messages (0 disables them)
+KEEPALIVE_INTERVAL = 30
+# Reconnection attempts after the session drops, with exponential backoff between them
+RECONNECT_ATTEMPTS = 5
+RECONNECT_BACKOFF = 1.0
+RECONNECT_MAX_DELAY = 30.0
+
+
+def pop_option(args, name):
+    """Remove "<name> <value>" from a command's argument list, returning (value or None, remaining args)"""
+    args = list(args)
+    if name not in args:
+        return None, args
+    index = args.index(name)
+    if index + 1 >= len(args):
+        raise TypeError(name + ' requires a value')
+    value = args[index + 1]
+    del args[index:index + 2]
+    return value, args
 
 
 class SFTP(object):
-    def __init__(self, hostname, username, password=None, private_key_password=None):
+    def __init__(self, hostname, username, password=None, private_key_password=None, port=22,
+                 keepalive=KEEPALIVE_INTERVAL, reconnect_attempts=RECONNECT_ATTEMPTS,
+                 ciphers=None, kex=None, macs=None, compression=None, download_cache=None, rate_limit=None):
         self.hostname = hostname
+        self.port = port
         self.username = username
         self.password = password
         self.private_key_password = private_key_password
+        self.keepalive = keepalive
+        self.reconnect_attempts = reconnect_attempts
+        # algorithm preferences; None uses the host's saved profile (see bench) or Connect's defaults
+        self.ciphers = ciphers
+        self.kex = kex
+        self.macs = macs
+        self.compression = compression
+        # optional Cache.DownloadCache: get/getm then skip remote files that have not changed
+        self.download_cache = download_cache
+        # paces transfers (rate_limit bytes/second for the whole session)
+        self.scheduler = Throttle.Scheduler(rate_limit)
+        # remote directories known to exist (absolute where the working directory is known), so
+        # put -t and mkdir -p do not check or create them again
+        self.known_directories = set()
+        # set to stop a long-running command (watch, tail -f) from another thread
+        self.interrupted = threading.Event()
         self.local_directory = os.path.expanduser('~')
         self.connection = self.initiate_connection()
         if not os.path.exists(DOWNLOADS_DIRECTORY):
@@ -43,7 +108,84 @@ class SFTP(object):
             return func(self, args)
         return logged_func
 
+    def reconnecting(idempotent):
+        """A decorator factory for commands that need the remote connection
+
+            A connection that has dropped is re-established before the command runs. Idempotent
+            commands are also run again if the connection drops while they are running.
+        """
+        def decorator(func):
+            @wraps(func)
+            def reconnecting_func(self, args):
+                if not self.connection_alive():
+                    self.reconnect()
+                attempt = 0
+                while True:
+                    try:
+                        return func(self, args)
+                    except Exception as e:
+                        if not idempotent or attempt >= self.reconnect_attempts or self.connection_alive():
+                            raise
+                        attempt += 1
+                        logging.warning('Connection lost during ' + func.__name__ + ' (' + str(e) + '), retrying')
+                        self.reconnect()
+            return reconnecting_func
+        return decorator
+
+    def connection_alive(self):
+        """Check, without a round trip to the server, whether the SSH session is still up"""
+        try:
+            return Transfer.connection_alive(self.connection.sftp_client)
+        except Exception:
+            return False
+
+    def reconnect(self):
+        """Re-open the session with the cached credentials, backing off exponentially between attempts
+
+            The remote working directory is restored on the new connection. Raises the last
+            connection error once reconnect_attempts attempts have failed.
+        """
+        try:
+            cwd = self.connection.sftp_client.getcwd()
+        except Exception:
+            cwd = None
+        try:
+            self.connection.close()
+        except Exception:
+            pass
+        delay = RECONNECT_BACKOFF
+        for attempt in range(1, self.reconnect_attempts + 1):
+            logging.info('Reconnecting to ' + self.hostname + ' (attempt ' + str(attempt) + ' of '
+                            + str(self.reconnect_attempts) + ')')
+            try:
+                self.connection = self.initiate_connection()
+                break
+            except (paramiko.SSHException, EOFError, OSError) as e:
+                if attempt == self.reconnect_attempts:
+                    raise
+                logging.warning('Reconnect failed: ' + str(e) + ', retrying in ' + str(delay) + 's')
+                time.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+        if cwd is not None:
+            self.connection.chdir(cwd)
+        return self.connection
+
+    def _reconnected_sftp(self):
+        """Reconnect and return the new paramiko SFTPClient (used to resume transfers)"""
+        return self.reconnect().sftp_client
+
+    def open(self, remotepath, mode='r', **options):
+        """Open a remote file as a Python file object (see Stream.open); this is not a command
+
+            Reads are prefetched and writes sent behind, paced by the session's bandwidth limit.
+        """
+        if not isinstance(remotepath, str):
+            raise TypeError("open is not a command (try 'cat' or 'get')")
+        options.setdefault('throttle', self.scheduler.throttle())
+        return Stream.open(self.connection.sftp_client, remotepath, mode, **options)
+
     # region Commands Section
+    @reconnecting(idempotent=True)
     def ping(self, _args):
         """Returns 'pong' if the connection is alive, else 'nothing happened'"""
         return "pong" if self.connection.listdir() else "nothing happened"
@@ -60,6 +202,7 @@ class SFTP(object):
         return command_history
 
     @log_history
+    @reconnecting(idempotent=True)
     def ls(self, args):
         """List directory contents on the remote server"""
         results = None
@@ -77,18 +220,46 @@ class SFTP(object):
         return results
 
     @log_history
+    @reconnecting(idempotent=True)
     def chmod(self, args):
         """Change or modify permissions of directories and files on the remote server
 
-            Set the mode of a remotepath to mode, where mode is an integer representation
-            of the octal mode to use.
+            Usage: chmod [-R] <mode> <remotepath> [<remotepath> ...], where mode is octal (755)
+            or symbolic (u+x,go-w); the original "chmod <remotepath> <mode>" also works, unless the
+            path is a valid mode too ("chmod 755 644"), which is rejected as ambiguous. Several paths,
+            or with -R whole trees, are changed with pipelined requests, skipping entries that
+            already have the mode. Returns a summary followed by any failures.
         """
-        if len(args) is 2:
-            self.connection.chmod(args[0], int(args[1]))
+        recursive = '-R' in args
+        args = [str(arg) for arg in args if arg != '-R']
+        if len(args) < 2:
+            raise TypeError('"Usage: chmod [-R] <mode> <file/dir_path> [<file/dir_path> ...]"')
+        try:
+            mode, paths = Modes.ModeChange(args[0]), args[1:]
+        except ValueError:
+            if len(args) != 2:
+                raise TypeError('"Usage: chmod [-R] <mode> <file/dir_path> [<file/dir_path> ...]"')
+            try:
+                mode, paths = Modes.ModeChange(args[1]), args[:1]
+            except ValueError as e:
+                raise TypeError(str(e))
         else:
-            raise TypeError('"Usage: chmod <file/dir_path> <mode>"')
+            if len(args) == 2 and Modes.is_mode(args[1]):
+                # either could be the path: "chmod 755 644" must not quietly apply the wrong mode
+                raise TypeError('chmod: ambiguous, both ' + repr(args[0]) + ' and ' + repr(args[1])
+                                + ' are modes; name the path as ./' + args[1] + ' or ./' + args[0])
+        if len(paths) == 1 and not recursive and mode.absolute:
+            # a single SETSTAT; checking the current mode first would cost as much. pysftp takes
+            # the octal digits as an int (755 for 0o755)
+            self.connection.chmod(paths[0], int('%o' % mode.octal))
+            return
+        changed, unchanged, failures = Batch.chmod(self.connection.sftp_client, paths, mode, recursive)
+        return (['chmod: ' + str(changed) + ' changed, ' + str(unchanged) + ' already ' + mode.text + ', '
+                 + str(len(failures)) + ' failed']
+                + [path + ': ' + str(error) for path, error in failures])
 
     @log_history
+    @reconnecting(idempotent=False)
     def rmdir(self, args):
         """
         Recursively delete a directory and all it's files and subdirectories
@@ -102,78 +273,134 @@ class SFTP(object):
             for dir in reversed(dirs):
                 self.connection.rmdir(dir)
             self.connection.rmdir(args[0])
+            self._forget_directory(args[0])
         else:
             raise TypeError(f"Error: '{args[0]}' is not a directory")
 
 
 
     @log_history
+    @reconnecting(idempotent=False)
     def rm(self, args):
         """
             Remove file from remote path given by argument. Arg may include path ('/').
+            Several files and shell-style patterns ('logs/*.log') may be given: patterns are
+            matched against one listing per directory and the files are removed with pipelined
+            requests, returning one line per file and a summary. With -n nothing is removed and
+            the files that would be are listed.
         """
-        if len(args) != 1:
-            raise TypeError("Usage: rm <filename | path/to/filename>")
-        else:
-            if self.connection.isfile(args[0]):
-                self.connection.remove(args[0])
+        dry_run = '-n' in args
+        targets = [arg for arg in args if arg != '-n']
+        if not targets or any(not target.strip() for target in targets):
+            raise TypeError("Usage: rm [-n] <filename | path/to/filename | pattern> [...]")
+        if len(targets) == 1 and not dry_run and not Batch.has_magic(targets[0]):
+            if self.connection.isfile(targets[0]):
+                self.connection.remove(targets[0])
+            else:
+                raise IOError(f"The remote path '{targets[0]}' is not a file")
+            return
+        sftp = self.connection.sftp_client
+        files, results = [], []
+        for path, attr in Batch.expand(sftp, targets):
+            if isinstance(attr, Exception):
+                results.append((path, attr))
+            elif stat.S_ISDIR(attr.st_mode):
+                results.append((path, IOError('Is a directory (use rmdir)')))
             else:
-                raise IOError(f"The remote path '{args[0]}' is not a file")
+                files.append(path)
+        if dry_run:
+            return ['would remove ' + path for path in files] + [path + ': FAILED: ' + str(error)
+                                                                   for path, error in results]
+        results.extend(Batch.remove(sftp, files))
+        return self._batch_report('removed', results)
 
     @log_history
+    @reconnecting(idempotent=False)
     def mkdir(self, args):
         """
             Creates directory on remote path passed as an argument. Directories
-            are created with permissions 775.
+            are created with permissions 775. With -p, or a path containing '/',
+            missing parent directories are created too and an existing directory
+            is not an error; directories already seen this session are not checked again.
         """
+        parents = '-p' in args
+        args = [arg for arg in args if arg != '-p']
         if len(args) != 1:
-            raise TypeError("Usage: mkdir <dirname | path/to/dirname>")
+            raise TypeError("Usage: mkdir [-p] <dirname | path/to/dirname>")
         else:
-            if args[0].find('/') != -1:
-                self.connection.makedirs(args[0], mode=775)
+            if parents or args[0].find('/') != -1:
+                self._ensure_directory(args[0])
             else:
                 self.connection.mkdir(args[0], mode=775)
+                self._remember_directory(args[0])
 
     @log_history
+    @reconnecting(idempotent=True)
     def get(self, args):
         """
         Downloads a remote file to the local machine. Given a single remotepath
         argument (arg[0]), the file is placed in the DOWNLOADS_DIRECTORY. If
         given a remotepath argument (arg[0]) and a localpath argument (arg[1]),
-        the file is downloaded to the localpath.
+        the file is downloaded to the localpath. The localpath only appears once
+        the download has completed. With '--hash <algorithm>' the file is hashed
+        as it downloads and checked against the server's digest.
+        With '--archive' the remotepath is a directory, streamed as a single tar
+        created on the server ('--compress gzip|zstd' compresses it on the wire)
+        and extracted into the localpath (or DOWNLOADS_DIRECTORY) as it arrives.
+        '--limit <rate>' (e.g. 20M) caps the download at rate bytes/second.
         """
+        algorithm, args = pop_option(args, '--hash')
+        if algorithm is not None:
+            Integrity.new_hash(algorithm)
+        rate, args = self._rate_option(args)
+        compression, args = pop_option(args, '--compress')
+        use_archive = '--archive' in args
+        args = [arg for arg in args if arg != '--archive']
         if len(args) < 1 or len(args) > 2:
             raise TypeError("get() takes 1 or 2 arguments (" + str(len(args)) + " given)")
+        if use_archive:
+            if algorithm is not None:
+                raise TypeError('get: --hash cannot be combined with --archive')
+            Archive.check_compression(compression)
+            if not self.connection.isdir(args[0]):
+                raise IOError(f"The remote path '{args[0]}' is not a directory")
+            self._get_archive(args[0], os.path.expanduser(args[1]) if len(args) == 2 else DOWNLOADS_DIRECTORY,
+                              compression)
+            return
 
         # Check file exists or pysftp will create an empty file in the target directory
-        if self.connection.isfile(args[0]):
-            if len(args) is 1:
-                head, tail = ntpath.split(args[0])
-                remote_file = tail or ntpath.basename(head)
-                localpath = os.path.join(DOWNLOADS_DIRECTORY, remote_file)
-                self.connection.get(args[0], localpath)
-            elif len(args) is 2:
-                self.connection.get(args[0], os.path.expanduser(args[1]))
-        else:
-            raise IOError(f"The remote path '{args[0]}' is not a file")
+        attr = self._remote_file(args[0])
+        if len(args) is 1:
+            head, tail = ntpath.split(args[0])
+            remote_file = tail or ntpath.basename(head)
+            localpath = os.path.join(DOWNLOADS_DIRECTORY, remote_file)
+            self._download(args[0], localpath, algorithm, attr, self.scheduler.throttle(rate))
+        elif len(args) is 2:
+            self._download(args[0], os.path.expanduser(args[1]), algorithm, attr, self.scheduler.throttle(rate))
 
     @log_history
+    @reconnecting(idempotent=True)
     def getm(self, args):
         '''Does download a remote files (more than 1) to the local machine. Files will be downloaded to a "download"
-         folder'''
+         folder. With '--hash <algorithm>' every file is hashed as it downloads and checked against the server.
+         '--limit <rate>' caps the whole batch at rate bytes/second. The files are stat'ed at once and
+         downloaded over one pipeline, the next files being opened and requested while one drains.'''
+        algorithm, args = pop_option(args, '--hash')
+        if algorithm is not None:
+            Integrity.new_hash(algorithm)
+        rate, args = self._rate_option(args)
         if len(args) < 1:
             raise TypeError("get() takes 1 or more arguments (" + str(len(args)) + " given)")
         else:
-            for f in args:
-                if self.connection.isfile(f):
-                    head, tail = ntpath.split(f)
-                    remote_file = tail or ntpath.basename(head)
-                    localpath = os.path.join(DOWNLOADS_DIRECTORY, remote_file)
-                    self.connection.get(f, localpath)
-                else:
-                    raise IOError(f"The remote path '{f}' is not a file")
+            files = []
+            for f, attr in zip(args, self._remote_files(args)):
+                head, tail = ntpath.split(f)
+                remote_file = tail or ntpath.basename(head)
+                files.append((f, os.path.join(DOWNLOADS_DIRECTORY, remote_file), attr))
+            self._download_many(files, algorithm, self.scheduler.throttle(rate))
 
     @log_history
+    @reconnecting(idempotent=True)
     def put(self, args):
         """
         Send a file to the remote server.
@@ -181,29 +408,87 @@ class SFTP(object):
         Filename and mtime are preserved.
         Allows use if '-t' flag to set remote path which will be used for any following files. if any directory
         does not exist, it is created.
+        Files are uploaded from a memory mapping with pipelined writes sized by the connection's flow
+        controller, and resume after a dropped connection ('--mmap' is accepted for compatibility).
+        The '--hash <algorithm>' option hashes the following files as they are sent and checks them against
+        the server's digest.
+        With '--archive', following directories are sent as a single tar stream extracted on the server
+        ('--compress gzip|zstd' compresses it), which avoids a round-trip per file. This needs remote
+        command execution (as cp_r does); without it the directories are put file by file.
+        '--segments <N>' uploads each following file as N byte ranges written concurrently over
+        separate SFTP channels, so a single large file can fill a long fat pipe.
+        '--limit <rate>' (e.g. 20M) caps the following files at rate bytes/second between them.
+        Consecutive files are sent over one pipeline, the next files being opened and written while
+        one drains (see Transfer.put_many).
         """
         target = None
+        use_archive = False
+        compression = None
+        algorithm = None
+        segments = 1
+        throttle = self.scheduler.throttle()
+        # plain files waiting to be sent together, as (localpath, remotepath, algorithm)
+        batch = []
+
+        def flush():
+            self._put_files(batch, throttle)
+            del batch[:]
+
         iter_args = iter(args)
         for arg in iter_args:
             arg = os.path.expanduser(arg)
             if arg == '-t':
                 target = next(iter_args)
+            elif arg == '--mmap':
+                # every upload is memory-mapped now
+                pass
+            elif arg == '--hash':
+                algorithm = next(iter_args, None)
+                Integrity.new_hash(algorithm)
+            elif arg == '--archive':
+                use_archive = True
+            elif arg == '--compress':
+                compression = next(iter_args, None)
+                Archive.check_compression(compression)
+            elif arg == '--segments':
+                try:
+                    segments = int(next(iter_args, ''))
+                except ValueError:
+                    raise TypeError('--segments requires a number of segments')
+                if segments < 1:
+                    raise TypeError('--segments requires a number of segments')
+            elif arg == '--limit':
+                flush()
+                throttle = self.scheduler.throttle(self._parse_rate(next(iter_args, '')))
+            elif use_archive and os.path.isdir(arg):
+                flush()
+                self._put_archive(arg, target, compression)
             elif os.path.isfile(arg):
                 if target is not None:
-                    try:
-                        self.connection.mkdir(target)
-                    except IOError:
-                        pass  # already exists
-                    self.connection.put(arg, target + '/' + os.path.basename(arg), preserve_mtime=True)
+                    self._ensure_directory(target)
+                    remotepath = target + '/' + os.path.basename(arg)
+                else:
+                    remotepath = None
+                if algorithm is not None and segments > 1:
+                    raise TypeError('put: --hash cannot be combined with --segments')
+                if segments > 1:
+                    flush()
+                    Transfer.segmented_put(self.connection.sftp_client, arg, remotepath or os.path.basename(arg),
+                                           segments, preserve_mtime=True, reconnect=self._reconnected_sftp,
+                                           throttle=throttle)
                 else:
-                    self.connection.put(arg, preserve_mtime=True)
+                    batch.append((arg, remotepath or os.path.basename(arg), algorithm))
             elif os.path.isdir(arg):
+                flush()
                 raise IOError("Cannot put directories")
 
             else:
+                flush()
                 raise FileNotFoundError("couldn't find the requested file")
+        flush()
 
     @log_history
+    @reconnecting(idempotent=True)
     def cd(self, args):
         """ Changes the remote directory to the specified path """
         if len(args) != 1:
@@ -214,6 +499,7 @@ class SFTP(object):
             else:
                 raise TypeError("Error: path is not a directory")
     @log_history
+    @reconnecting(idempotent=True)
     def pwd(self, _args):
         """ Prints the remote working directory """
         if len(_args) != 0:
@@ -222,11 +508,51 @@ class SFTP(object):
             return self.connection.pwd
 
     @log_history
+    @reconnecting(idempotent=False)
     def rename(self, args):
-        if len(args) is 2:
-            self.connection.rename(args[0], args[1])
+        """Rename a remote file or directory, or many at once
+
+            "rename -r <regex> <replacement> [<remotedir>]" renames every entry of the directory
+            whose name matches the regular expression (the first match is replaced, \\1 refers to
+            groups); "rename -t <pattern> <template> [<remotedir>]" renames the entries matching a
+            shell-style pattern after a printf-style template (%(n)03d, %(name)s, %(stem)s,
+            %(ext)s). The directory is listed once and the renames are pipelined, returning one
+            line per entry and a summary. With -n the renames are listed but not made.
+        """
+        dry_run = '-n' in args
+        args = [arg for arg in args if arg != '-n']
+        if args and args[0] in ('-r', '-t'):
+            if len(args) not in (3, 4):
+                raise TypeError('Usage: rename [-n] -r <regex> <replacement> [<remotedir>] | '
+                                '-t <pattern> <template> [<remotedir>]')
+            directory = args[3] if len(args) == 4 else '.'
+            names = [posixpath.basename(path) for path, _attr in
+                     Batch.walk(self.connection.sftp_client, directory, recursive=False)]
+            try:
+                if args[0] == '-r':
+                    renames = Batch.regex_renames(names, args[1], args[2])
+                else:
+                    renames = Batch.template_renames(names, args[1], args[2])
+                renames = Batch.check_renames(renames)
+            except (ValueError, re.error) as e:
+                raise TypeError(str(e))
+            if len(args) == 4:
+                renames = [(posixpath.join(directory, old), posixpath.join(directory, new)) for old, new in renames]
+        elif len(args) is 2:
+            if not dry_run:
+                self.connection.rename(args[0], args[1])
+                self._forget_directory(args[0])
+                return
+            renames = [(args[0], args[1])]
         else:
             raise TypeError('rename() takes exactly two arguments (' + str(len(args)) + ' given)')
+        if dry_run:
+            return ['would rename ' + old + ' -> ' + new for old, new in renames]
+        results = [(old + ' -> ' + new, error) for (old, new), error in Batch.rename(self.connection.sftp_client,
+                                                                                    renames)]
+        for old, _new in renames:
+            self._forget_directory(old)
+        return self._batch_report('renamed', results)
 
     @log_history
     def renamel(self, args):
@@ -236,6 +562,7 @@ class SFTP(object):
             raise TypeError('renamel() takes exactly two arguments (' + str(len(args)) + ' given)')
 
     @log_history
+    @reconnecting(idempotent=False)
     def cp(self, args):
         """Copy a remote directory from src to dst
 
@@ -245,7 +572,18 @@ class SFTP(object):
 
             This is a pure (S)FTP solution, which means that it does not require the ability to perform
             remote shell execution).
+
+            With '--hash <algorithm>' every file is hashed as it is downloaded, and both the source
+            and the copy are checked against the server's digests. '--limit <rate>' caps the copy at
+            rate bytes/second each way; with a limit (or a session-wide one) the files are sent
+            through our own paced transfers rather than pysftp's get_r/put_r.
         """
+        algorithm, args = pop_option(args, '--hash')
+        if algorithm is not None:
+            Integrity.new_hash(algorithm)
+        rate, args = self._rate_option(args)
+        paced = rate is not None or self.scheduler.rate is not None
+        throttle = self.scheduler.throttle(rate)
         if len(args) is 2:
             if self.connection.exists(args[0]):
                 if self.connection.exists(args[1]) and self.connection.isdir(args[1]):
@@ -262,6 +600,7 @@ class SFTP(object):
 
                 # setup local vars
                 tmp_d = tempfile.gettempdir()
+                sources = {}
                 local_d = os.path.join(tmp_d, os.path.basename(args[0]))
                 moved_local_d = os.path.join(tmp_d, os.path.basename(remote_d))
                 logging.debug('Copying ' + args[0] + ' to ' + remote_d + ' using tmp_d:' + tmp_d)
@@ -271,7 +610,10 @@ class SFTP(object):
                         # if the source folder is empty, paramiko (or pysftp?) will not actually do a get_r(),
                         # but still reports success. This is an issue, and is being addressed by creating that folder manually
                         logging.debug('Starting get...')
-                        self.connection.get_r(args[0], tmp_d, preserve_mtime=True)
+                        if algorithm is not None or paced:
+                            sources = self._get_r(args[0], tmp_d, algorithm, throttle)
+                        else:
+                            self.connection.get_r(args[0], tmp_d, preserve_mtime=True)
                         logging.debug('Copied ' + os.path.basename(args[0]) + ' to ' + tmp_d)
                     else:
                         logging.debug('Creating empty directory at: ' + os.path.join(tmp_d, args[0]) + '...')
@@ -297,7 +639,19 @@ class SFTP(object):
 
                     # put the contents ofthe temporary
                     logging.debug('Starting put of src: ' + os.path.join(tmp_d, os.path.basename(remote_d)) + ' dst: ' + remote_path)
-                    self.connection.put_r(os.path.join(tmp_d, os.path.basename(remote_d)), remote_path, preserve_mtime=True)
+                    copied = os.path.join(tmp_d, os.path.basename(remote_d))
+                    if paced:
+                        self._put_r(copied, remote_path, throttle)
+                    else:
+                        self.connection.put_r(copied, remote_path, preserve_mtime=True)
+
+                    if algorithm is not None:
+                        # check the copies on the server against the digests taken while downloading
+                        for source, (hasher, source_verified) in sources.items():
+                            destination = posixpath.join(remote_path, posixpath.relpath(source, args[0]))
+                            digest, copy_verified = Integrity.verify(self.connection, destination, hasher)
+                            Integrity.record(MANIFEST_FILE, algorithm, digest, source, destination,
+                                             source_verified and copy_verified)
                 finally:
                     # cleanup the local temporary directories
                     logging.debug('Starting cleanup...')
@@ -311,6 +665,7 @@ class SFTP(object):
             raise TypeError('Usage: cp <remote_source> <remote_destination>')
 
     @log_history
+    @reconnecting(idempotent=False)
     def cp_r(self, args):
         """Copy a remote directory from src to dst via remote command execution
 
@@ -330,6 +685,241 @@ class SFTP(object):
         else:
             raise TypeError('cp_r() takes exactly two arguments (' + str(len(args)) + ' given)')
 
+    @log_history
+    @reconnecting(idempotent=False)
+    def bench(self, args):
+        """Measure the round-trip time and throughput of each cipher, MAC and compression setting
+
+            Every setting is tried on a separate connection. '--size <bytes>' sets how much is
+            transferred in each direction, and '--save' stores the fastest settings as this host's
+            connection profile, which later connections use.
+        """
+        size, args = pop_option(args, '--size')
+        save = '--save' in args
+        if [arg for arg in args if arg != '--save']:
+            raise TypeError('Usage: bench [--size <bytes>] [--save]')
+        results = Bench.run(self.initiate_connection, int(size) if size is not None else Bench.DEFAULT_SIZE)
+        profile = Bench.recommend(results)
+        lines = Bench.format_results(results)
+        lines.append('Recommended profile: ' + json.dumps(profile))
+        if save:
+            Connect.save_profile(self.hostname, self.port, profile)
+            lines.append('Saved to ' + Connect.PROFILE_FILE)
+        return lines
+
+    @log_history
+    def cache(self, args):
+        """Show the download cache's size and location, or empty it with 'cache clear'"""
+        if self.download_cache is None:
+            raise TypeError('The download cache is not enabled (start the client with --cache)')
+        if args == ['clear']:
+            self.download_cache.clear()
+            return 'Download cache cleared'
+        if args:
+            raise TypeError('Usage: cache [clear]')
+        entries, objects, used = self.download_cache.stats()
+        return [self.download_cache.directory,
+                str(entries) + ' file(s), ' + str(objects) + ' stored object(s), ' + str(used) + ' of '
+                + str(self.download_cache.max_bytes) + ' bytes used']
+
+    @log_history
+    @reconnecting(idempotent=True)
+    def diff(self, args):
+        """Compare a local directory with a remote one: diff [--checksum] <localdir> <remotedir>
+
+            Both trees are walked at the same time (see Diff.compare) and every difference is listed
+            relative to both directories: 'added <path>' exists only locally, 'removed <path>' only
+            on the server, and 'changed <path> (<reason>)' differs in type, size or mtime. With
+            '--checksum' files of the same size are compared by SHA-256 digest instead of mtime.
+        """
+        checksum = 'sha256' if '--checksum' in args else None
+        args = [arg for arg in args if arg != '--checksum']
+        if len(args) != 2:
+            raise TypeError('Usage: diff [--checksum] <localdir> <remotedir>')
+        changes = list(Diff.compare(self.connection, os.path.expanduser(args[0]), args[1], checksum))
+        counts = {status: sum(1 for change in changes if change.status == status)
+                  for status in ('added', 'removed', 'changed')}
+        return ([change.status + ' ' + change.path + (' (' + change.reason + ')' if change.reason else '')
+                 for change in changes]
+                + [', '.join(str(count) + ' ' + status for status, count in counts.items())])
+
+    @log_history
+    @reconnecting(idempotent=True)
+    def mirror(self, args):
+        """Make a remote directory a copy of a local one, or the reverse:
+            mirror push|pull [-n] [--delete] [--full] [--hash <algorithm>] <localdir> <remotedir>
+
+            'push' updates <remotedir> from <localdir> and 'pull' the reverse. A manifest of what
+            the last sync left on both sides (Mirror.Manifest, per host and pair of directories)
+            lets later runs list only the directories whose mtime has moved and transfer only
+            what differs. Paths only on the destination are removed with '--delete', '--full'
+            walks both trees whole (for files changed in place, which leave their directory's
+            mtime alone), '--hash' records each transferred file's digest in the manifest and
+            '-n' lists what would be done.
+        """
+        algorithm, args = pop_option(args, '--hash')
+        if algorithm is not None:
+            Integrity.new_hash(algorithm)
+        flags = {arg for arg in args if arg in ('-n', '--delete', '--full')}
+        args = [arg for arg in args if arg not in flags]
+        if len(args) != 3 or args[0] not in ('push', 'pull'):
+            raise TypeError('Usage: mirror push|pull [-n] [--delete] [--full] [--hash <algorithm>] '
+                            '<localdir> <remotedir>')
+        localdir, remotedir = self._mirror_roots(args[1], args[2])
+        with Mirror.Manifest() as manifest:
+            results, listed, directories = Mirror.sync(
+                self.connection.sftp_client, manifest, self._host_key(), args[0], localdir, remotedir,
+                delete='--delete' in flags, full='--full' in flags, dry_run='-n' in flags, algorithm=algorithm,
+                reconnect=self._reconnected_sftp, throttle=self.scheduler.throttle())
+        return (self._sync_lines(results)
+                + [self._sync_counts(results, 'uploaded' if args[0] == 'push' else 'downloaded')
+                   + '; ' + str(listed) + ' directories listed of ' + str(directories)])
+
+    @log_history
+    @reconnecting(idempotent=True)
+    def watch(self, args):
+        """Push a local directory to a remote one, then keep pushing its changes until interrupted (Ctrl-C):
+            watch [--delete] [--poll <seconds>] <localdir> <remotedir>
+
+            Changes are picked up with inotify (or by scanning the tree every '--poll' seconds, also
+            the fallback where inotify is missing), gathered into batches and pushed as they settle,
+            each as a mirror push (see Watch.watch) over the open connection. Every push is printed
+            as it happens; '--delete' also removes what is deleted locally.
+        """
+        poll, args = pop_option(args, '--poll')
+        delete = '--delete' in args
+        args = [arg for arg in args if arg != '--delete']
+        if len(args) != 2:
+            raise TypeError('Usage: watch [--delete] [--poll <seconds>] <localdir> <remotedir>')
+        try:
+            interval = float(poll) if poll is not None else Watch.POLL_INTERVAL
+        except ValueError:
+            raise TypeError('watch: --poll takes a number of seconds, not ' + repr(poll))
+        localdir, remotedir = self._mirror_roots(args[0], args[1])
+        self.interrupted.clear()
+        pushed = []
+        with Mirror.Manifest() as manifest:
+            try:
+                for results in Watch.watch(self.connection.sftp_client, manifest, self._host_key(), localdir,
+                                           remotedir, self.interrupted, delete=delete, poll=poll is not None,
+                                           interval=interval, reconnect=self._reconnected_sftp,
+                                           throttle=self.scheduler.throttle()):
+                    for line in self._sync_lines(results):
+                        print(line, flush=True)
+                    pushed.extend(results)
+            except KeyboardInterrupt:
+                pass
+        return 'watch: ' + self._sync_counts(pushed, 'uploaded')
+
+    @log_history
+    @reconnecting(idempotent=True)
+    def cat(self, args):
+        """Return the lines of remote files, as they are read: cat <remotepath> [<remotepath> ...]
+
+            Each file is read in windows of Peek.CAT_WINDOW bytes (pipelined READs), and the lines
+            are yielded as each window arrives, so nothing is written to disk and memory use stays
+            bounded.
+        """
+        if not args:
+            raise TypeError('Usage: cat <remotepath> [<remotepath> ...]')
+        sftp, throttle = self.connection.sftp_client, self.scheduler.throttle()
+        return self._lines(data for remotepath in args for data in Peek.cat(sftp, remotepath, throttle))
+
+    @log_history
+    @reconnecting(idempotent=True)
+    def head(self, args):
+        """Return the first lines of a remote file: head [-n <lines> | -c <bytes>] <remotepath>
+
+            Only the start of the file is read, in blocks until there are enough lines (10 by
+            default); '-c' returns the first bytes instead.
+        """
+        lines, size, args = self._count_options('head', args)
+        if len(args) != 1:
+            raise TypeError('Usage: head [-n <lines> | -c <bytes>] <remotepath>')
+        data = Peek.head(self.connection.sftp_client, args[0], lines=lines, size=size)
+        text = data.decode('utf-8', 'replace')
+        return text if size is not None else text.splitlines()
+
+    @log_history
+    @reconnecting(idempotent=True)
+    def tail(self, args):
+        """Return the last lines of a remote file: tail [-n <lines> | -c <bytes>] [-f] <remotepath>
+
+            The file is read backwards from its end in blocks until there are enough lines (10 by
+            default), so only its end crosses the network; '-c' returns the last bytes instead.
+            With '-f' the lines are yielded, then those appended to the file as they arrive, checking
+            its size every Peek.FOLLOW_INTERVAL seconds, until interrupted (Ctrl-C).
+        """
+        follow = '-f' in args
+        lines, size, args = self._count_options('tail', [arg for arg in args if arg != '-f'])
+        if len(args) != 1:
+            raise TypeError('Usage: tail [-n <lines> | -c <bytes>] [-f] <remotepath>')
+        sftp = self.connection.sftp_client
+        data, end = Peek.tail(sftp, args[0], lines=lines, size=size)
+        if not follow:
+            text = data.decode('utf-8', 'replace')
+            return text if size is not None else text.splitlines()
+        self.interrupted.clear()
+        return self._lines(itertools.chain([data], Peek.follow(sftp, args[0], end, self.interrupted)))
+
+    @log_history
+    @reconnecting(idempotent=True)
+    def grep(self, args):
+        """Search remote files for lines matching a regular expression:
+            grep [-r] [-i] [--remote] <pattern> <remotepath> [<remotepath> ...]
+
+            Files are read over SFTP, several at once, and matched as their blocks arrive (see
+            Grep.search), so nothing is written to disk and memory use stays bounded. '-r' searches
+            the files below directories. With '--remote' grep -E runs on the server instead, through
+            an exec channel as cp_r does, and only the matching lines cross the network; servers
+            that refuse it or lack GNU grep are searched over SFTP. Returns '<path>:<line number>:<line>' for every
+            match, followed by any files that could not be read.
+        """
+        flags = {arg for arg in args if arg in ('-r', '-i', '--remote')}
+        args = [arg for arg in args if arg not in flags]
+        if len(args) < 2:
+            raise TypeError('Usage: grep [-r] [-i] [--remote] <pattern> <remotepath> [<remotepath> ...]')
+        pattern, paths = args[0], args[1:]
+        if '--remote' in flags:
+            lines = []
+            try:
+                for path, lineno, line in Grep.remote_grep(self.connection, pattern, paths, '-r' in flags,
+                                                           '-i' in flags):
+                    lines.append(path + ':' + str(lineno) + ':' + line.decode('utf-8', 'replace'))
+                return lines
+            except Archive.ExecUnavailable as e:
+                logging.info(str(e) + ', searching over SFTP instead')
+            except IOError as e:
+                return lines + ['grep: FAILED: ' + str(e)]
+        try:
+            regex = re.compile(pattern.encode('utf-8'), re.MULTILINE | (re.IGNORECASE if '-i' in flags else 0))
+        except re.error as e:
+            raise TypeError('grep: invalid pattern ' + repr(pattern) + ': ' + str(e))
+        sftp = self.connection.sftp_client
+        files, errors = Grep.files(sftp, paths, '-r' in flags)
+        found = dict(Grep.search(sftp, files, regex, throttle=self.scheduler.throttle()))
+        lines = []
+        for path, _size in files:
+            if isinstance(found[path], Exception):
+                errors.append((path, found[path]))
+                continue
+            lines.extend(path + ':' + str(lineno) + ':' + line.decode('utf-8', 'replace')
+                         for lineno, line in found[path])
+        return lines + [path + ': FAILED: ' + str(error) for path, error in errors]
+
+    @log_history
+    def limit(self, args):
+        """Show or set the bandwidth limit for all transfers of this session ('limit 20M', 'limit off')
+
+            Transfers share the limit, and ones given their own '--limit' are held to both.
+        """
+        if len(args) > 1:
+            raise TypeError('Usage: limit [<rate> | off]')
+        if args:
+            self.scheduler.set_rate(None if args[0] == 'off' else self._parse_rate(args[0]))
+        rate = self.scheduler.rate
+        return 'limit: ' + ('off' if rate is None else Throttle.format_rate(rate))
+
     @log_history
     def lsl(self, _args):
         '''It does list all files and directories in your local machine. It will start with local folder where the
@@ -363,60 +953,355 @@ class SFTP(object):
             return os.getcwd()
     # endregion
 
+    def _host_key(self):
+        return self.username + '@' + self.hostname + ':' + str(self.port)
+
+    def _mirror_roots(self, localdir, remotedir):
+        """The absolute local and remote directories of a mirror, which key its manifest"""
+        if not posixpath.isabs(remotedir):
+            remotedir = posixpath.join(self.connection.sftp_client.getcwd() or self.connection.normalize('.'),
+                                       remotedir)
+        return os.path.abspath(os.path.expanduser(localdir)), posixpath.normpath(remotedir)
+
+    @staticmethod
+    def _sync_lines(results):
+        """One line per Mirror.Result: '<path>: <action>' or '<path>: FAILED: <error>'"""
+        return [(result.path or '.') + ': '
+                + (result.action if result.error is None else 'FAILED: ' + str(result.error)) for result in results]
+
+    @staticmethod
+    def _sync_counts(results, transferred):
+        counts = collections.Counter(result.action for result in results if result.error is None)
+        return (', '.join(str(counts[action]) + ' ' + action for action in (transferred, 'created', 'deleted'))
+                + ', ' + str(sum(1 for result in results if result.error is not None)) + ' failed')
+
+    @staticmethod
+    def _batch_report(verb, results):
+        """One line per (item, error or None), sorted, followed by a count of successes and failures"""
+        lines = [item + ': ' + (verb if error is None else 'FAILED: ' + str(error))
+                 for item, error in sorted(results, key=lambda result: result[0])]
+        failed = sum(1 for _item, error in results if error is not None)
+        return lines + [str(len(results) - failed) + ' ' + verb + ', ' + str(failed) + ' failed']
+
+    @staticmethod
+    def _count_options(command, args):
+        """Pop '-n <lines>' or '-c <bytes>' from args, returning (lines, bytes, remaining args); 10 lines by default"""
+        lines, args = pop_option(args, '-n')
+        size, args = pop_option(args, '-c')
+        if lines is not None and size is not None:
+            raise TypeError(command + ': -n and -c cannot be combined')
+        try:
+            counts = [None if value is None else int(value) for value in (lines, size)]
+        except ValueError:
+            raise TypeError(command + ': -n and -c take a number, not ' + repr(lines if size is None else size))
+        if any(count is not None and count < 0 for count in counts):
+            raise TypeError(command + ': -n and -c take a number that is not negative')
+        if counts == [None, None]:
+            counts[0] = 10
+        return counts[0], counts[1], args
+
+    @staticmethod
+    def _lines(chunks):
+        """Yield the lines (without their newlines) of a stream of bytes as each one is complete, decoding UTF-8"""
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        partial = ''
+        for data in chunks:
+            lines = (partial + decoder.decode(data)).split('\n')
+            partial = lines.pop()
+            yield from lines
+        partial += decoder.decode(b'', True)
+        if partial:
+            yield partial
+
+    @staticmethod
+    def _parse_rate(text):
+        try:
+            return Throttle.parse_rate(text)
+        except ValueError as e:
+            raise TypeError(str(e))
+
+    def _rate_option(self, args):
+        """Pop '--limit <rate>' from args, returning (bytes/second or None, remaining args)"""
+        rate, args = pop_option(args, '--limit')
+        return (None if rate is None else self._parse_rate(rate)), args
+
+    def _remote_file(self, remotepath):
+        """Raise IOError unless remotepath is a remote file; returns its attributes when caching downloads
+
+            With the download cache the single STAT both checks the path and supplies the size and
+            mtime the cache is keyed by, so an unchanged file costs one round trip.
+        """
+        if self.download_cache is None:
+            if not self.connection.isfile(remotepath):
+                raise IOError(f"The remote path '{remotepath}' is not a file")
+            return None
+        try:
+            attr = self.connection.sftp_client.stat(remotepath)
+        except IOError:
+            attr = None
+        if attr is None or not stat.S_ISREG(attr.st_mode):
+            raise IOError(f"The remote path '{remotepath}' is not a file")
+        return attr
+
+    def _remote_files(self, remotepaths):
+        """Like _remote_file for many paths, with every STAT sent at once; returns their attributes"""
+        attrs = Batch.stat_many(self.connection.sftp_client, remotepaths)
+        for remotepath in remotepaths:
+            if isinstance(attrs[remotepath], Exception) or not stat.S_ISREG(attrs[remotepath].st_mode):
+                raise IOError(f"The remote path '{remotepath}' is not a file")
+        return [attrs[remotepath] for remotepath in remotepaths]
+
+    def _remote_abspath(self, remotepath):
+        # the SFTP working directory is tracked client side, so making the path absolute is free
+        cwd = self.connection.sftp_client.getcwd()
+        return posixpath.normpath(posixpath.join(cwd, remotepath)) if cwd else posixpath.normpath(remotepath)
+
+    def _cache_key(self, remotepath, attr):
+        return Cache.cache_key(self.hostname, self.port, self.username, self._remote_abspath(remotepath),
+                               attr.st_size, attr.st_mtime)
+
+    def _remember_directory(self, remotepath):
+        """Record that a remote directory, and therefore each of its parents, exists"""
+        path = self._remote_abspath(remotepath)
+        while path not in self.known_directories and path not in ('', '.', '/'):
+            self.known_directories.add(path)
+            path = posixpath.dirname(path)
+
+    def _forget_directory(self, remotepath):
+        """Drop a removed or renamed path, and everything below it, from the known directories"""
+        path = self._remote_abspath(remotepath)
+        self.known_directories = set(known for known in self.known_directories
+                                     if known != path and not known.startswith(path.rstrip('/') + '/'))
+
+    def _ensure_directory(self, remotepath):
+        """Create a remote directory and any missing parents, like "mkdir -p"
+
+            Directories known to exist cost no round trip. Otherwise the directory is stat'ed, and
+            if it is missing its parent is ensured the same way before a single MKDIR, so an
+            existing directory costs one request and each missing level a STAT and a MKDIR.
+        """
+        if self._remote_abspath(remotepath) in self.known_directories:
+            return
+        sftp = self.connection.sftp_client
+        try:
+            attr = sftp.stat(remotepath)
+        except IOError:
+            parent = posixpath.dirname(remotepath.rstrip('/'))
+            if parent not in ('', '.', '/'):
+                self._ensure_directory(parent)
+            try:
+                sftp.mkdir(remotepath, 0o775)
+            except IOError:
+                # created by someone else in the meantime?
+                attr = sftp.stat(remotepath)
+                if not stat.S_ISDIR(attr.st_mode):
+                    raise
+        else:
+            if not stat.S_ISDIR(attr.st_mode):
+                raise IOError(f"The remote path '{remotepath}' is not a directory")
+        self._remember_directory(remotepath)
+
+    def _download(self, remotepath, localpath, algorithm=None, attr=None, throttle=None):
+        """Download a file, hashing it inline and checking it against the server if an algorithm is given"""
+        self._download_many([(remotepath, localpath, attr)], algorithm, throttle)
+
+    def _download_many(self, files, algorithm=None, throttle=None):
+        """Download (remotepath, localpath, attr) files, hashing and checking each as _download does
+
+            With the download cache (and attr from _remote_file), an unchanged file is cloned from the
+            cache instead of transferred, and a transferred file is added to it. Several files to
+            transfer share one pipeline (Transfer.download_many, which needs their attr), so the link
+            is not idle between them. throttle (from Throttle.Scheduler.throttle) paces the transfers.
+        """
+        transfers = []
+        for remotepath, localpath, attr in files:
+            hasher = Integrity.StreamHasher(algorithm) if algorithm is not None else None
+            key = self._cache_key(remotepath, attr) if self.download_cache is not None and attr is not None else None
+            if key is not None and self.download_cache.fetch(key, localpath):
+                # as a transfer's (below); a hardlinked object shared by content_hash may carry another mtime
+                os.utime(localpath, (time.time(), attr.st_mtime))
+                if hasher is not None:
+                    # the server's digest is still checked, against the cached copy
+                    with open(localpath, 'rb') as f:
+                        for block in iter(lambda: f.read(Cache.HASH_BLOCK_SIZE), b''):
+                            hasher.update(hasher.position, block)
+                self._check_download(remotepath, localpath, attr, hasher, key, cached=True)
+            else:
+                transfers.append((remotepath, localpath, attr, hasher, key))
+
+        def done(index):
+            remotepath, localpath, attr, hasher, key = transfers[index]
+            self._check_download(remotepath, localpath, attr, hasher, key, cached=False)
+
+        # with the cache, downloads keep the remote mtime, as the copies served from it do
+        preserve_mtime = self.download_cache is not None
+        if len(transfers) == 1:
+            remotepath, localpath, _attr, hasher, _key = transfers[0]
+            Transfer.download(self.connection.sftp_client, remotepath, localpath, preserve_mtime=preserve_mtime,
+                              hasher=hasher, reconnect=self._reconnected_sftp, throttle=throttle)
+            done(0)
+        elif transfers:
+            Transfer.download_many(self.connection.sftp_client, [transfer[:4] for transfer in transfers],
+                                   preserve_mtime=preserve_mtime, reconnect=self._reconnected_sftp, throttle=throttle,
+                                   on_done=done)
+
+    def _check_download(self, remotepath, localpath, attr, hasher, key, cached):
+        """Check a downloaded (or cached) file against the server's digest and record it; cache a transfer"""
+        if hasher is not None:
+            try:
+                digest, verified = Integrity.verify(self.connection, remotepath, hasher)
+            except IOError:
+                os.remove(localpath)
+                if cached:
+                    # changed on the server without changing size or mtime
+                    self.download_cache.discard(key)
+                raise
+            Integrity.record(MANIFEST_FILE, hasher.algorithm, digest, remotepath, localpath, verified)
+        if key is not None and not cached:
+            self.download_cache.store(key, localpath)
+
+    def _put_files(self, files, throttle=None):
+        """Upload (localpath, remotepath, algorithm) files, over one pipeline if there are several
+
+            A file with an algorithm is hashed as it is sent and checked against the server's digest.
+            throttle paces the transfers, as in _download_many.
+        """
+        hashers = [Integrity.StreamHasher(algorithm) if algorithm is not None else None
+                   for _localpath, _remotepath, algorithm in files]
+
+        def done(index):
+            localpath, remotepath, algorithm = files[index]
+            if algorithm is not None:
+                digest, verified = Integrity.verify(self.connection, remotepath, hashers[index])
+                Integrity.record(MANIFEST_FILE, algorithm, digest, localpath, remotepath, verified)
+
+        if len(files) == 1:
+            localpath, remotepath, _algorithm = files[0]
+            Transfer.mmap_put(self.connection.sftp_client, localpath, remotepath, preserve_mtime=True,
+                              hasher=hashers[0], reconnect=self._reconnected_sftp, throttle=throttle)
+            done(0)
+        elif files:
+            Transfer.put_many(self.connection.sftp_client,
+                              [(localpath, remotepath, hasher) for (localpath, remotepath, _algorithm), hasher
+                               in zip(files, hashers)],
+                              preserve_mtime=True, reconnect=self._reconnected_sftp, throttle=throttle, on_done=done)
+
+    def _put_archive(self, localdir, target, compression):
+        """Stream a local directory into target (or the working directory), falling back to put_r"""
+        try:
+            Archive.upload_tree(self.connection, localdir, target, compression)
+        except Archive.ExecUnavailable as e:
+            logging.warning(str(e) + ', putting ' + localdir + ' file by file instead')
+            remotedir = posixpath.join(target or '.', os.path.basename(os.path.normpath(localdir)))
+            self._ensure_directory(remotedir)
+            self.connection.put_r(localdir, remotedir, preserve_mtime=True)
+
+    def _get_archive(self, remotedir, localdir, compression):
+        """Stream a remote directory into localdir, falling back to get_r"""
+        try:
+            Archive.download_tree(self.connection, remotedir, localdir, compression)
+        except Archive.ExecUnavailable as e:
+            logging.warning(str(e) + ', getting ' + remotedir + ' file by file instead')
+            name = posixpath.basename(self.connection.normalize(remotedir))
+            os.makedirs(localdir, exist_ok=True)
+            with tempfile.TemporaryDirectory(dir=localdir) as staging:
+                # get_r recreates the whole remote path under the local directory
+                self.connection.get_r(remotedir, staging, preserve_mtime=True)
+                # move (not copy) the files into place, merging with an existing directory as tar does
+                shutil.copytree(pysftp.helpers.reparent(staging, remotedir), os.path.join(localdir, name),
+                                copy_function=os.replace, dirs_exist_ok=True)
+
+    def _get_r(self, remotedir, localdir, algorithm=None, throttle=None):
+        """Like get_r(preserve_mtime=True), with every file fetched by Transfer.download (paced by throttle)
+
+            With an algorithm every file is hashed inline and checked against the server. Returns a
+            dict of remote file path -> (Integrity.StreamHasher, verified) of the hashed files.
+        """
+        sources = {}
+
+        def get_file(remotepath):
+            hasher = Integrity.StreamHasher(algorithm) if algorithm is not None else None
+            Transfer.download(self.connection.sftp_client, remotepath, pysftp.helpers.reparent(localdir, remotepath),
+                              preserve_mtime=True, hasher=hasher, reconnect=self._reconnected_sftp, throttle=throttle)
+            if hasher is not None:
+                sources[remotepath] = (hasher, Integrity.verify(self.connection, remotepath, hasher)[1])
+
+        def make_dir(remotepath):
+            os.makedirs(pysftp.helpers.reparent(localdir, remotepath), exist_ok=True)
+
+        make_dir(remotedir)
+        self.connection.walktree(remotedir, get_file, make_dir, lambda _path: None)
+        return sources
+
+    def _put_r(self, localdir, remotedir, throttle=None):
+        """Like put_r(preserve_mtime=True), with every file sent by Transfer.mmap_put (paced by throttle)"""
+        for dirpath, _dirnames, filenames in os.walk(localdir):
+            relative = os.path.relpath(dirpath, localdir)
+            remote = remotedir if relative == os.curdir else posixpath.join(remotedir, *relative.split(os.sep))
+            self._ensure_directory(remote)
+            for name in sorted(filenames):
+                Transfer.mmap_put(self.connection.sftp_client, os.path.join(dirpath, name),
+                                  posixpath.join(remote, name), preserve_mtime=True,
+                                  reconnect=self._reconnected_sftp, throttle=throttle)
+
     def __del__(self):
         try:
             self.connection.close()
         except Exception:
             pass
 
-    def initiate_connection(self):
+    def initiate_connection(self, **options):
         # Connect, checking hostkey or caching on first connect
         # Based off of this stackoverflow question:
         #     https://stackoverflow.com/questions/53666106/use-paramiko-autoaddpolicy-with-pysftp
 
-        # configure pysftp CnOpts
-        hostkeys = None
-        cnopts = pysftp.CnOpts()  # loads hostkeys from known_hosts.ssh
-        if cnopts.hostkeys.lookup(self.hostname) is None:
+        # known_hosts is only parsed again when it has changed since the last connection
+        hostkeys = Connect.known_host_keys()
+        if hostkeys.lookup(self.hostname) is None:
             logging.debug('Key for host: ' + self.hostname + ' was not found in known_hosts')
-            hostkeys = cnopts.hostkeys
-            cnopts.hostkeys = None
+            hostkeys = None
+
+        # explicit preferences win over the profile saved by 'bench --save'; options override both
+        profile = Connect.load_profile(self.hostname, self.port)
+        settings = {'ciphers': self.ciphers or profile.get('ciphers', Connect.PREFERRED_CIPHERS),
+                    'kex': self.kex or Connect.PREFERRED_KEX,
+                    'macs': self.macs or profile.get('macs'),
+                    'compression': profile.get('compression', False) if self.compression is None else self.compression}
+        settings.update(options)
+        cnopts = Connect.ConnectionOptions(hostkeys, **settings)
 
         args = {'host': self.hostname,
+                'port': self.port,
                 'username': self.username,
                 'cnopts': cnopts}
 
         # Determine what type of authentication to use based on parameters provided
-        ssh_key = os.path.expanduser('~') + '/.ssh/id_rsa'
         if self.password is not None:
             logging.debug('Using plaintext authentication')
-            args['password'] = self.password
-        elif os.path.isfile(ssh_key):
-            logging.debug('Got SSH key: ' + ssh_key)
-            # the file at ~/.ssh/id_rsa exists - use it as the (default) private key
-            args['private_key'] = ssh_key
-            if self.private_key_password is not None:
-                logging.debug('Using public key authentication with DER-encoded private key')
-                args['private_key_pass'] = self.private_key_password
-            else:
-                logging.debug('Using public key authentication with plaintext private key')
+            keys = []
         else:
-            raise ssh_exception.BadAuthenticationType('No supported authentication methods available',
-                                                      ['password', 'public_key'])
+            # key files are decrypted once and kept in memory for reconnects
+            keys = Connect.private_keys(self.private_key_password)
+            if not keys:
+                raise ssh_exception.BadAuthenticationType('No supported authentication methods available',
+                                                          ['password', 'public_key'])
+            logging.debug('Using public key authentication (' + str(len(keys)) + ' key(s) available)')
 
         # connect using the authentication type determined above
         logging.debug('Connecting using arguments: ' + str(args))
         try:
-            connection = pysftp.Connection(**args)
+            # the keys are tried in turn over one transport
+            connection = Connect.Connection(password=self.password, private_keys=keys, **args)
         except paramiko.SSHException as e:
             logging.critical(e)
             raise
+        if self.keepalive:
+            # keep idle sessions from being dropped by NAT/firewalls, and notice dead peers sooner
+            connection.sftp_client.get_channel().get_transport().set_keepalive(self.keepalive)
 
-        # On first connect, Save the new hostkey to known_hosts
-        if hostkeys is not None:
-            logging.debug('Appending new hostkey for ' + self.hostname + ' to known_hosts, and writing to disk...')
-            hostkeys.add(self.hostname, connection.remote_server_key.get_name(),
-                         connection.remote_server_key)
-            hostkeys.save(pysftp.helpers.known_hosts())
+        # On first connect, add the new hostkey to known_hosts
+        if hostkeys is None:
+            logging.debug('Appending new hostkey for ' + self.hostname + ' to known_hosts...')
+            Connect.add_known_host(self.hostname, connection.remote_server_key)
 
         return connection
@@ -5,6 +5,7 @@ from unittest.mock import patch, MagicMock, call, ANY
 # fix for running as script?
 import sys
 import os
+import stat
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 import SFTPClient
@@ -71,6 +72,81 @@ class Testping(Test_Client):
         self.assertEqual(actual, "nothing happened")
 
 
+class Testreconnect(Test_Client):
+    def test_idempotent_command_retried(self):
+        # setup
+        self.myClass.connection_alive = MagicMock(side_effect=[True, False])
+        self.myClass.reconnect = MagicMock()
+        self.myClass.connection.listdir.side_effect = [EOFError(), ['file']]
+        # actual
+        actual = self.myClass.ls([])
+        # verify
+        self.myClass.reconnect.assert_called_once_with()
+        self.assertEqual(actual, ['file'])
+
+    def test_non_idempotent_command_not_retried(self):
+        # setup
+        self.myClass.connection_alive = MagicMock(side_effect=[True, False])
+        self.myClass.reconnect = MagicMock()
+        self.myClass.connection.isfile.side_effect = EOFError()
+        # verify
+        with self.assertRaises(EOFError):
+            self.myClass.rm(['file'])
+        self.myClass.reconnect.assert_not_called()
+
+    def test_reconnect_before_command(self):
+        # setup
+        self.myClass.connection_alive = MagicMock(return_value=False)
+        self.myClass.reconnect = MagicMock()
+        # actual
+        self.myClass.mkdir(['dir'])
+        # verify
+        self.myClass.reconnect.assert_called_once_with()
+
+    @patch('SFTPClient.Client.time.sleep')
+    def test_reconnect_backoff(self, mock_sleep):
+        # setup
+        connection = MagicMock()
+        self.myClass.connection.sftp_client.getcwd.return_value = '/home/user/dir'
+        self.myClass.initiate_connection = MagicMock(side_effect=[EOFError(), EOFError(), connection])
+        # actual
+        actual = self.myClass.reconnect()
+        # verify
+        self.assertIs(actual, connection)
+        mock_sleep.assert_has_calls([call(1.0), call(2.0)])
+        connection.chdir.assert_called_once_with('/home/user/dir')
+
+    @patch('SFTPClient.Client.time.sleep')
+    def test_reconnect_gives_up(self, mock_sleep):
+        # setup
+        self.myClass.reconnect_attempts = 2
+        self.myClass.initiate_connection = MagicMock(side_effect=EOFError())
+        # verify
+        with self.assertRaises(EOFError):
+            self.myClass.reconnect()
+        self.assertEqual(self.myClass.initiate_connection.call_count, 2)
+
+
+class Testbench(Test_Client):
+    def test_bench_usage(self):
+        # verify
+        with self.assertRaises(TypeError):
+            self.myClass.bench(['--fast'])
+
+    @patch('SFTPClient.Client.Connect.save_profile')
+    @patch('SFTPClient.Client.Bench.run')
+    def test_bench_save(self, mock_run, mock_save):
+        # setup
+        mock_run.return_value = [{'setting': 'cipher', 'value': 'aes128-ctr', 'rtt': 0.001,
+                                  'requests_per_second': 1000.0, 'upload_bps': 1e6, 'download_bps': 1e6}]
+        # actual
+        actual = self.myClass.bench(['--size', '1024', '--save'])
+        # verify
+        mock_run.assert_called_once_with(self.myClass.initiate_connection, 1024)
+        mock_save.assert_called_once_with('hostname', 22, {'ciphers': ['aes128-ctr']})
+        self.assertIn('Recommended profile: {"ciphers": ["aes128-ctr"]}', actual)
+
+
 class Testls(Test_Client):
     def test_ls(self):
         # actual
@@ -130,6 +206,18 @@ class Testchmod(Test_Client):
         # verify
         self.assertRaises(TypeError, self.myClass.chmod, ['car', 'boat', 'train'])
 
+    def test_chmod_ambiguous(self):
+        # verify
+        self.assertRaises(TypeError, self.myClass.chmod, ['755', '644'])
+        self.assertRaises(TypeError, self.myClass.chmod, ['-R', 'u+x', '700'])
+        self.myClass.connection.chmod.assert_not_called()
+
+    def test_chmod_dotted_path(self):
+        # actual
+        self.myClass.chmod(['755', './644'])
+        # verify
+        self.myClass.connection.chmod.assert_called_once_with('./644', 755)
+
 
 class Testrm(Test_Client):
     def test_rm(self):
@@ -153,16 +241,43 @@ class Testrm(Test_Client):
         self.assertRaises(TypeError, self.myClass.rm, "Usage: rm [filename | path/to/filename]")
 
 
+class Testrename(Test_Client):
+    def test_rename(self):
+        self.myClass.rename(['a', 'b'])
+        self.myClass.connection.rename.assert_called_once_with('a', 'b')
+
+    def test_rename_dry_run(self):
+        self.assertEqual(self.myClass.rename(['-n', 'a', 'b']), ['would rename a -> b'])
+        self.myClass.connection.rename.assert_not_called()
+
+    def test_rename_usage(self):
+        self.assertRaises(TypeError, self.myClass.rename, ['-r', 'a'])
+
+
 class Testmkdir(Test_Client):
     def test_mkdir(self):
         # verify
         self.assertRaises(TypeError, self.myClass.mkdir, "Usage: mkdir [dirname | path/to/dirname]")
 
     def test_mkdir1(self):
+        # setup
+        self.myClass.connection.sftp_client.stat.return_value.st_mode = stat.S_IFDIR | 0o755
         # actual
         self.myClass.mkdir("/")
         # verify
-        self.myClass.connection.makedirs.assert_called_once_with("/", mode=775)
+        self.myClass.connection.sftp_client.stat.assert_called_once_with("/")
+        self.myClass.connection.sftp_client.mkdir.assert_not_called()
+
+    def test_mkdir_parents(self):
+        # setup
+        self.myClass.connection.sftp_client.getcwd.return_value = None
+        self.myClass.connection.sftp_client.stat.side_effect = IOError()
+        # actual
+        self.myClass.mkdir(['-p', 'a/b'])
+        self.myClass.mkdir(['-p', 'a/b'])
+        # verify
+        self.myClass.connection.sftp_client.mkdir.assert_has_calls([call('a', 0o775), call('a/b', 0o775)])
+        self.assertEqual(self.myClass.connection.sftp_client.mkdir.call_count, 2)
 
 
 class Testget(Test_Client):
@@ -170,13 +285,107 @@ class Testget(Test_Client):
         # verify
         self.assertRaises(TypeError, self.myClass.get, "get() takes 1 or 2 arguments ("" given)")
 
-    def test_get1(self):
+    @patch("SFTPClient.Client.Transfer.download", autospec=True)
+    def test_get1(self, mock_download):
         # setup
         self.myClass.connection.isfile.return_value = True
+        SFTPClient.Client.os.path.join.return_value = "downloads/1"
+        # actual
+        self.myClass.get("1")
+        # verify
+        mock_download.assert_called_once_with(self.myClass.connection.sftp_client, "1", "downloads/1",
+                                              preserve_mtime=False, hasher=None,
+                                              reconnect=self.myClass._reconnected_sftp, throttle=ANY)
+
+    @patch("SFTPClient.Client.os.utime", autospec=True)
+    @patch("SFTPClient.Client.Transfer.download", autospec=True)
+    def test_get_cached(self, mock_download, mock_utime):
+        # setup
+        self.myClass.download_cache = MagicMock()
+        self.myClass.download_cache.fetch.return_value = True
+        self.myClass.connection.sftp_client.stat.return_value = MagicMock(st_mode=0o100644, st_size=5, st_mtime=7)
+        self.myClass.connection.sftp_client.getcwd.return_value = None
+        SFTPClient.Client.os.path.join.return_value = "downloads/1"
         # actual
         self.myClass.get("1")
         # verify
-        self.myClass.connection.get("1", "downloads")
+        key = SFTPClient.Cache.cache_key("hostname", 22, "username", "1", 5, 7)
+        self.myClass.download_cache.fetch.assert_called_once_with(key, "downloads/1")
+        self.myClass.download_cache.store.assert_not_called()
+        mock_download.assert_not_called()
+        mock_utime.assert_called_once_with("downloads/1", (ANY, 7))
+
+
+class Testcache(Test_Client):
+    def test_cache_disabled(self):
+        self.assertRaises(TypeError, self.myClass.cache, [])
+
+
+class Testlimit(Test_Client):
+    def test_limit(self):
+        self.assertEqual(self.myClass.limit([]), 'limit: off')
+        self.assertEqual(self.myClass.limit(['20M']), 'limit: 20M/s')
+        self.assertEqual(self.myClass.scheduler.rate, 20 * 1024 * 1024)
+        self.assertEqual(self.myClass.limit(['off']), 'limit: off')
+
+    def test_limit_invalid(self):
+        self.assertRaises(TypeError, self.myClass.limit, ['fast'])
+        self.assertRaises(TypeError, self.myClass.limit, ['1M', '2M'])
+
+
+class Testdiff(Test_Client):
+    def test_diff_usage(self):
+        self.assertRaises(TypeError, self.myClass.diff, ['only_one'])
+        self.assertRaises(TypeError, self.myClass.diff, ['--checksum', 'a', 'b', 'c'])
+
+
+class Testmirror(Test_Client):
+    def test_mirror_usage(self):
+        self.assertRaises(TypeError, self.myClass.mirror, ['sync', 'a', 'b'])
+        self.assertRaises(TypeError, self.myClass.mirror, ['push', '--delete', 'a'])
+
+
+class Testwatch(Test_Client):
+    def test_watch_usage(self):
+        self.assertRaises(TypeError, self.myClass.watch, ['--delete', 'only_one'])
+        self.assertRaises(TypeError, self.myClass.watch, ['--poll', 'often', 'a', 'b'])
+
+
+class Testpeek(Test_Client):
+    def test_peek_usage(self):
+        self.assertRaises(TypeError, self.myClass.cat, [])
+        self.assertRaises(TypeError, self.myClass.head, ['a', 'b'])
+        self.assertRaises(TypeError, self.myClass.head, ['-n', 'ten', 'a'])
+        self.assertRaises(TypeError, self.myClass.tail, ['-n', '-1', 'a'])
+        self.assertRaises(TypeError, self.myClass.tail, ['-n', '1', '-c', '1', 'a'])
+        self.assertRaises(TypeError, self.myClass.tail, ['-f'])
+
+    def test_lines(self):
+        # a line and a character split across chunks, and a last line without a newline
+        chunks = [b'one\ntw', b'o \xc3', b'\xa9\n\nthree']
+        self.assertEqual(list(SFTPClient.Client.SFTP._lines(chunks)), ['one', 'two \u00e9', '', 'three'])
+
+
+class Testgrep(Test_Client):
+    def test_grep_usage(self):
+        self.assertRaises(TypeError, self.myClass.grep, ['-r', 'pattern'])
+        self.assertRaises(TypeError, self.myClass.grep, ['(unclosed', 'file'])
+
+
+class Testopen(Test_Client):
+    def test_open_not_a_command(self):
+        self.assertRaises(TypeError, self.myClass.open, ['remote_file'])
+
+
+class Testpop_option(unittest.TestCase):
+    def test_pop_option(self):
+        self.assertEqual(SFTPClient.Client.pop_option(['--hash', 'sha256', 'a'], '--hash'), ('sha256', ['a']))
+
+    def test_pop_option_absent(self):
+        self.assertEqual(SFTPClient.Client.pop_option(['a', 'b'], '--hash'), (None, ['a', 'b']))
+
+    def test_pop_option_missing_value(self):
+        self.assertRaises(TypeError, SFTPClient.Client.pop_option, ['a', '--hash'], '--hash')
 
 
 @patch("SFTPClient.Client.os.getcwd", autospec=True)
@@ -199,11 +408,14 @@ class Testput(Test_Client):
         with self.assertRaises(FileNotFoundError):
             self.myClass.put(['test.file'])
 
-    def test_put_file(self):
+    @patch("SFTPClient.Client.Transfer.mmap_put", autospec=True)
+    def test_put_file(self, mock_mmap_put):
         SFTPClient.Client.os.path.isfile.return_value = True
         SFTPClient.Client.os.path.isdir.return_value = False
         self.myClass.put(['test.file'])
-        self.myClass.connection.put.assert_called_once_with('test.file', preserve_mtime=True)
+        mock_mmap_put.assert_called_once_with(self.myClass.connection.sftp_client, 'test.file', 'test.file',
+                                              preserve_mtime=True, hasher=None,
+                                              reconnect=self.myClass._reconnected_sftp, throttle=ANY)
 
     def test_put_dir(self):
         SFTPClient.Client.os.path.isfile.return_value = False
@@ -211,12 +423,26 @@ class Testput(Test_Client):
         with self.assertRaises(IOError):
             self.myClass.put(['test_dir'])
 
-    def test_put_file_path(self):
+    @patch("SFTPClient.Client.Transfer.mmap_put", autospec=True)
+    def test_put_file_path(self, mock_mmap_put):
         SFTPClient.Client.os.path.isfile.return_value = True
         SFTPClient.Client.os.path.isdir.return_value = False
+        self.myClass.connection.sftp_client.stat.return_value.st_mode = stat.S_IFDIR | 0o755
         self.myClass.put(['-t', 'random_path/to_the', 'local/file.txt'])
-        self.myClass.connection.put.assert_called_once_with('local/file.txt', 'random_path/to_the/file.txt',
-                                                            preserve_mtime=True)
+        mock_mmap_put.assert_called_once_with(self.myClass.connection.sftp_client, 'local/file.txt',
+                                              'random_path/to_the/file.txt', preserve_mtime=True, hasher=None,
+                                              reconnect=self.myClass._reconnected_sftp, throttle=ANY)
+
+    @patch("SFTPClient.Client.Transfer.mmap_put", autospec=True)
+    def test_put_file_mmap(self, mock_mmap_put):
+        SFTPClient.Client.os.path.isfile.return_value = True
+        SFTPClient.Client.os.path.isdir.return_value = False
+        self.myClass.connection.sftp_client.stat.return_value.st_mode = stat.S_IFDIR | 0o755
+        self.myClass.put(['--mmap', '-t', 'random_path', 'local/file.txt'])
+        mock_mmap_put.assert_called_once_with(self.myClass.connection.sftp_client, 'local/file.txt',
+                                              'random_path/file.txt', preserve_mtime=True, hasher=None,
+                                              reconnect=self.myClass._reconnected_sftp, throttle=ANY)
+        self.myClass.connection.put.assert_not_called()
 
 
 class Testcp(Test_Client):
@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import socket
+import threading
+
+import paramiko
+import pysftp
+
+from SFTPClient.Flow import MAX_WINDOW
+
+# Preferred algorithms, fastest first. Names the installed paramiko does not implement are skipped,
+# and every other algorithm it supports stays enabled (after these) so negotiation still succeeds
+# with servers that support none of them.
+PREFERRED_CIPHERS = ('aes128-gcm@openssh.com', 'aes256-gcm@openssh.com', 'chacha20-poly1305@openssh.com',
+                     'aes128-ctr', 'aes256-ctr')
+PREFERRED_KEX = ('curve25519-sha256', 'curve25519-sha256@libssh.org', 'ecdh-sha2-nistp256')
+
+# Per-host connection profiles (preferred ciphers, MACs and compression) saved by the bench command
+PROFILE_FILE = '~/.sftp_profiles.json'
+
+# Private keys tried, in order, when no password is given
+DEFAULT_KEY_FILES = ('~/.ssh/id_ed25519', '~/.ssh/id_ecdsa', '~/.ssh/id_rsa')
+KEY_CLASSES = (paramiko.Ed25519Key, paramiko.ECDSAKey, paramiko.RSAKey)
+
+_lock = threading.Lock()
+# known_hosts path -> ((mtime, size), paramiko.HostKeys)
+_host_keys = {}
+# (key path, mtime) -> decrypted paramiko.PKey
+_private_keys = {}
+
+
+def ordered(preferred, supported):
+    """Return supported with the names in preferred moved to the front (in preferred's order)"""
+    first = [name for name in preferred if name in supported]
+    return tuple(first + [name for name in supported if name not in first])
+
+
+def known_host_keys(path=None):
+    """Return the parsed known_hosts file, parsing it again only when it has changed on disk"""
+    path = path or pysftp.helpers.known_hosts()
+    try:
+        stat = os.stat(path)
+        version = (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        version = None
+    with _lock:
+        cached = _host_keys.get(path)
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        hostkeys = paramiko.HostKeys()
+        if version is not None:
+            hostkeys.load(path)
+        _host_keys[path] = (version, hostkeys)
+        return hostkeys
+
+
+def add_known_host(hostname, key, path=None):
+    """Append a host key to known_hosts (rather than rewriting the file) and to the cached copy
+
+        Safe to call from connections opened in parallel; a key that is already known is not added again.
+    """
+    path = path or pysftp.helpers.known_hosts()
+    hostkeys = known_host_keys(path)
+    with _lock:
+        if key.get_name() in (hostkeys.lookup(hostname) or {}):
+            return
+        directory = os.path.dirname(path)
+        if not os.path.isdir(directory):
+            os.makedirs(directory, mode=0o700)
+        with open(path, 'a') as f:
+            f.write(paramiko.hostkeys.HostKeyEntry([hostname], key).to_line())
+        hostkeys.add(hostname, key.get_name(), key)
+        stat = os.stat(path)
+        _host_keys[path] = ((stat.st_mtime_ns, stat.st_size), hostkeys)
+
+
+def load_private_key(path, password=None):
+    """Load (and decrypt) a private key file of any supported type, caching the result in memory
+
+        Later connections (reconnects, other hosts) reuse the decrypted key without reading or
+        decrypting the file again. Raises paramiko.SSHException if the file cannot be loaded.
+    """
+    path = os.path.expanduser(path)
+    cache_key = (path, os.stat(path).st_mtime_ns)
+    with _lock:
+        if cache_key in _private_keys:
+            return _private_keys[cache_key]
+    error = None
+    for key_class in KEY_CLASSES:
+        try:
+            key = key_class.from_private_key_file(path, password)
+            break
+        except paramiko.PasswordRequiredException:
+            raise
+        except (paramiko.SSHException, ValueError) as e:
+            error = e
+    else:
+        raise paramiko.SSHException('Unable to load private key ' + path + ': ' + str(error))
+    with _lock:
+        _private_keys[cache_key] = key
+    return key
+
+
+def private_keys(password=None):
+    """Return the keys to try for public key authentication: key files first, then ssh-agent keys"""
+    keys = []
+    for path in DEFAULT_KEY_FILES:
+        if os.path.isfile(os.path.expanduser(path)):
+            try:
+                keys.append(load_private_key(path, password))
+                logging.debug('Using private key ' + path)
+            except paramiko.SSHException as e:
+                logging.debug('Skipping private key ' + path + ': ' + str(e))
+    if os.environ.get('SSH_AUTH_SOCK'):
+        try:
+            agent_keys = paramiko.Agent().get_keys()
+        except paramiko.SSHException as e:
+            logging.debug('ssh-agent unavailable: ' + str(e))
+        else:
+            logging.debug('Got ' + str(len(agent_keys)) + ' key(s) from ssh-agent')
+            keys.extend(agent_keys)
+    return keys
+
+
+def profile_key(hostname, port=22):
+    return hostname if port == 22 else hostname + ':' + str(port)
+
+
+def load_profile(hostname, port=22, path=PROFILE_FILE):
+    """Return the saved connection profile for a host (keys: ciphers, macs, compression), or {}"""
+    try:
+        with open(os.path.expanduser(path)) as f:
+            return json.load(f).get(profile_key(hostname, port), {})
+    except (OSError, ValueError):
+        return {}
+
+
+def save_profile(hostname, port, profile, path=PROFILE_FILE):
+    """Store the connection profile for a host, keeping the other hosts' profiles"""
+    path = os.path.expanduser(path)
+    with _lock:
+        try:
+            with open(path) as f:
+                profiles = json.load(f)
+        except (OSError, ValueError):
+            profiles = {}
+        profiles[profile_key(hostname, port)] = profile
+        with open(path, 'w') as f:
+            json.dump(profiles, f, indent=2, sort_keys=True)
+
+
+class ConnectionOptions(pysftp.CnOpts):
+    """pysftp connection options that reuse already-parsed host keys and carry algorithm preferences
+
+        pysftp.CnOpts() reads and parses known_hosts every time it is created; these options take
+        the (cached) HostKeys instead, or None to accept an unknown host's key.
+    """
+
+    def __init__(self, hostkeys, ciphers=PREFERRED_CIPHERS, kex=PREFERRED_KEX, macs=None, compression=False):
+        self.log = False
+        self.compression = compression
+        self.ciphers = ciphers
+        self.kex = kex
+        self.macs = macs
+        self.hostkeys = hostkeys
+
+
+class Connection(pysftp.Connection):
+    """pysftp.Connection that applies algorithm preferences and accepts any paramiko key object
+
+        pysftp only sets the cipher list and only takes RSA keys (or paths) for private_key; here
+        the ciphers, MACs and key exchanges are ordered by the options' preferences, and
+        private_key may be any paramiko.PKey, including keys held by ssh-agent. Without a password
+        or private_key, the private_keys are tried in turn over the one transport, so a key the
+        server refuses costs a round trip rather than a new connection and key exchange. Channels
+        are opened with a Flow.MAX_WINDOW receive window.
+    """
+
+    def __init__(self, host, private_keys=(), **kwargs):
+        self._private_keys = list(private_keys)
+        super(Connection, self).__init__(host, **kwargs)
+        if not self._transport.is_authenticated():
+            try:
+                self._authenticate()
+            except Exception:
+                self.close()
+                raise
+
+    def _authenticate(self):
+        for i, key in enumerate(self._private_keys):
+            try:
+                self._transport.auth_publickey(self._tconnect['username'], key)
+                return
+            except paramiko.AuthenticationException:
+                if i + 1 == len(self._private_keys):
+                    raise
+                logging.debug('Authentication failed, trying the next key')
+
+    def _start_transport(self, host, port):
+        try:
+            self._transport = paramiko.Transport((host, port))
+        except (AttributeError, socket.gaierror):
+            raise pysftp.ConnectionException(host, port)
+        # channels advertise a receive window as large as a FlowController may keep in flight
+        # (paramiko's 2 MB default caps downloads at 2 MB per round trip)
+        self._transport.default_window_size = MAX_WINDOW
+        options = self._transport.get_security_options()
+        if self._cnopts.ciphers is not None:
+            options.ciphers = ordered(self._cnopts.ciphers, options.ciphers)
+        if getattr(self._cnopts, 'kex', None) is not None:
+            options.kex = ordered(self._cnopts.kex, options.kex)
+        if getattr(self._cnopts, 'macs', None) is not None:
+            options.digests = ordered(self._cnopts.macs, options.digests)
+
+    def _set_authentication(self, password, private_key, private_key_pass):
+        if password is None and private_key is None and self._private_keys:
+            # transport.connect only negotiates and checks the host key; __init__ authenticates
+            return
+        if password is None and isinstance(private_key, paramiko.PKey):
+            self._tconnect['pkey'] = private_key
+        else:
+            super(Connection, self)._set_authentication(password, private_key, private_key_pass)
@@ -0,0 +1,142 @@
+import collections
+import os
+import posixpath
+import stat
+import threading
+
+from SFTPClient import Batch
+from SFTPClient import Integrity
+from SFTPClient import Transfer
+
+# Block size used to hash local files
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# A difference between a local and a remote tree. status is 'added' (only local), 'removed' (only remote)
+# or 'changed'; path is relative to both roots, with '/' separators; reason is 'type', 'size', 'mtime' or
+# 'checksum' for a changed path (else None); local and remote are the entries' os.stat_result and
+# SFTPAttributes (None on the side the path is missing from)
+Change = collections.namedtuple('Change', ['status', 'path', 'reason', 'local', 'remote'])
+
+
+def walk_local(top):
+    """Yield (path relative to top, os.stat_result) for everything below the local directory top
+
+        Directories are read with os.scandir, whose entries carry their type, so only the
+        lstat of each entry is needed (symbolic links are reported, not followed). Paths use '/'
+        separators, like remote ones.
+    """
+    waiting = ['']
+    while waiting:
+        relative = waiting.pop()
+        with os.scandir(os.path.join(top, relative) if relative else top) as entries:
+            for entry in entries:
+                path = relative + '/' + entry.name if relative else entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    waiting.append(path)
+                yield path, entry.stat(follow_symlinks=False)
+
+
+def local_digest(path, algorithm):
+    digest = Integrity.new_hash(algorithm)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def remote_digest(connection, remotepath, size, algorithm):
+    """The server's digest of remotepath, or one computed from reading it if the server has none"""
+    digest = Integrity.remote_digest(connection, remotepath, algorithm)
+    if digest is None:
+        sftp = connection.sftp_client
+        hasher = Integrity.StreamHasher(algorithm)
+        with sftp.open(remotepath, 'rb') as remote_file:
+            Transfer.read_pipelined(sftp, remote_file.handle, size, hasher.update)
+        digest = hasher.hexdigest()
+    return digest
+
+
+def compare_entries(path, local, remote):
+    """Return the Change between the local and remote entries at path, or None if they match"""
+    if remote is None:
+        return Change('added', path, None, local, None)
+    if local is None:
+        return Change('removed', path, None, None, remote)
+    if stat.S_IFMT(local.st_mode) != stat.S_IFMT(remote.st_mode):
+        return Change('changed', path, 'type', local, remote)
+    if stat.S_ISDIR(local.st_mode):
+        return None
+    if local.st_size != remote.st_size:
+        return Change('changed', path, 'size', local, remote)
+    # SFTP carries whole seconds
+    if int(local.st_mtime) != int(remote.st_mtime):
+        return Change('changed', path, 'mtime', local, remote)
+    return None
+
+
+def compare(connection, localdir, remotedir, checksum=None):
+    """Yield a Change for every path that differs between localdir and the remote directory remotedir
+
+        Both trees are walked at the same time: the local one with walk_local in a background
+        thread, the remote one with Batch.walk (directories listed concurrently over one
+        pipeline). Remote entries are compared as they arrive once the local walk, which is
+        normally far quicker, has finished, so changes stream out while the remote tree is still
+        being listed; paths found only locally follow at the end. Files differ by type, size or
+        mtime. With checksum (one of Integrity.ALGORITHMS) files of the same size are compared by
+        digest instead of mtime, the remote digests being computed on the server in batches
+        (Integrity.remote_digests) once the listing is complete.
+
+        :param connection: a pysftp.Connection
+    """
+    local = {}
+    failure = []
+    local_done = threading.Event()
+
+    def walk():
+        try:
+            local.update(walk_local(localdir))
+        except Exception as e:
+            failure.append(e)
+        finally:
+            local_done.set()
+
+    walker = threading.Thread(target=walk, name='diff local walk', daemon=True)
+    walker.start()
+    waiting = []
+    # files of the same size to compare by digest: path -> (local attributes, remote attributes)
+    same_size = {}
+
+    def decide(path, remote):
+        attr = local.pop(path, None)
+        if checksum is not None and attr is not None and stat.S_ISREG(attr.st_mode) \
+                and stat.S_ISREG(remote.st_mode) and attr.st_size == remote.st_size:
+            same_size[path] = (attr, remote)
+            return None
+        return compare_entries(path, attr, remote)
+
+    def drain():
+        if failure:
+            raise failure[0]
+        for path, remote in waiting:
+            change = decide(path, remote)
+            if change is not None:
+                yield change
+        del waiting[:]
+
+    for path, remote in Batch.walk(connection.sftp_client, remotedir):
+        waiting.append((posixpath.relpath(path, remotedir), remote))
+        if local_done.is_set():
+            yield from drain()
+    walker.join()
+    yield from drain()
+    for path in sorted(local):
+        yield Change('added', path, None, local[path], None)
+    if same_size:
+        remote_paths = {path: posixpath.join(remotedir, path) for path in same_size}
+        digests = Integrity.remote_digests(connection, list(remote_paths.values()), checksum)
+        for path in sorted(same_size):
+            attr, remote = same_size[path]
+            remote_path = remote_paths[path]
+            expected = digests.get(remote_path) or remote_digest(connection, remote_path, remote.st_size, checksum)
+            if local_digest(os.path.join(localdir, *path.split('/')), checksum) != expected:
+                yield Change('changed', path, 'checksum', attr, remote)
@@ -0,0 +1,164 @@
+import collections
+import math
+import time
+
+# Request sizes the controller chooses between (the largest is also capped by the server's limits)
+MIN_BLOCK_SIZE = 8 * 1024
+# Requests the window is split into, so one slow reply does not stall the pipe
+TARGET_REQUESTS = 16
+MIN_IN_FLIGHT = 4
+INITIAL_WINDOW = 512 * 1024
+# Most data kept outstanding; Connect asks for SSH channel windows this large
+MAX_WINDOW = 16 * 1024 * 1024
+# Data in flight kept as a multiple of the bandwidth-delay product, to absorb jitter
+GAIN = 2.0
+# Slow start ends after this many rounds without the delivery rate growing by SLOW_START_GROWTH,
+# or once the smallest RTT of a round exceeds SLOW_START_DELAY times the smallest seen (a queue formed)
+SLOW_START_ROUNDS = 3
+SLOW_START_GROWTH = 1.25
+SLOW_START_DELAY = 1.5
+# Rounds the bandwidth estimate (the largest delivery rate seen) is kept for
+BANDWIDTH_ROUNDS = 10
+# Round trips shorter than this (fast links) count as this long: rates are not sampled from noise,
+# and the window stays large enough for big requests, which cost the client less CPU per byte
+MIN_ROUND_TIME = 0.01
+# Seconds before the smallest RTT is measured again with an almost empty pipe
+MIN_RTT_EXPIRY = 10.0
+
+
+class FlowController(object):
+    """Chooses the request size and number of requests in flight for transfers in one direction
+
+        It works like TCP congestion control: the data in flight starts at INITIAL_WINDOW and
+        doubles every round trip while the delivery rate keeps growing (slow start), then tracks
+        GAIN times the bandwidth-delay product, i.e. the largest delivery rate of the last
+        BANDWIDTH_ROUNDS rounds times the smallest round-trip time. Every MIN_RTT_EXPIRY seconds
+        the window drops to MIN_IN_FLIGHT requests for one round, so the RTT is measured without
+        our own queue in it. Requests grow with the window (up to max_block_size), which keeps the
+        per-request overhead down on fast links and the window fine grained on slow ones.
+
+        Transfers report every request with sent() and its reply with received(). With in_flight
+        given, the controller is fixed at in_flight requests of max_block_size.
+    """
+
+    def __init__(self, max_block_size, in_flight=None, max_window=MAX_WINDOW):
+        self.max_block_size = max_block_size
+        self.max_window = max_window
+        self.fixed = in_flight is not None
+        self.block_size = max_block_size
+        self.in_flight = in_flight
+        self.state = 'fixed' if self.fixed else 'slow start'
+        self.outstanding = 0
+        # bytes confirmed so far, when the last of them was, and when that request had been sent
+        self.delivered = 0
+        self._delivered_time = None
+        self._first_sent_time = None
+        self.min_rtt = None
+        self.bandwidth = 0.0
+        self._min_rtt_stamp = None
+        self._rates = collections.deque(maxlen=BANDWIDTH_ROUNDS)
+        self._best_rate = 0.0
+        self._stalled_rounds = 0
+        self._round_start = None
+        self._round_rate = 0.0
+        self._round_peak = 0
+        self._round_min_rtt = None
+        self._probe_start = None
+        if not self.fixed:
+            self._set_window(INITIAL_WINDOW)
+
+    @property
+    def window(self):
+        """Bytes the controller currently allows in flight"""
+        return self.block_size * self.in_flight
+
+    def _set_window(self, target):
+        target = min(max(target, MIN_IN_FLIGHT * MIN_BLOCK_SIZE), self.max_window)
+        block_size = MIN_BLOCK_SIZE
+        while block_size * 2 <= target / TARGET_REQUESTS:
+            block_size *= 2
+        self.block_size = min(block_size, self.max_block_size)
+        self.in_flight = max(MIN_IN_FLIGHT, int(math.ceil(target / float(self.block_size))))
+
+    def limit_block_size(self, size):
+        """Cap the request size, e.g. when the server answered a READ with less than was asked"""
+        self.max_block_size = max(min(size, self.max_block_size), 1)
+        self.block_size = min(self.block_size, self.max_block_size)
+
+    def sent(self, length):
+        """Record a request carrying (or asking for) length bytes; returns a token to pass to received()"""
+        now = time.monotonic()
+        if self._round_start is None:
+            self._round_start = now
+            self._delivered_time = now
+            self._first_sent_time = now
+        self.outstanding += length
+        self._round_peak = max(self._round_peak, self.outstanding)
+        return now, self.delivered, self._delivered_time, self._first_sent_time
+
+    def received(self, token, length):
+        """Record the reply to a request, adjusting the window once per round
+
+            As in BBR, the delivery rate is the data confirmed between the last reply before the
+            request was sent and its own reply, over the longer of the time between those replies and
+            the time taken to send the data, so replies read in a burst (e.g. after a send blocked
+            on the SSH window) do not inflate it.
+        """
+        sent_at, delivered, delivered_time, first_sent_time = token
+        now = time.monotonic()
+        self.outstanding = max(self.outstanding - length, 0)
+        self.delivered += length
+        self._delivered_time = now
+        self._first_sent_time = sent_at
+        rtt = now - sent_at
+        if self.min_rtt is None or rtt <= self.min_rtt:
+            self.min_rtt = rtt
+            self._min_rtt_stamp = now
+        if self.fixed or (self.state == 'probe rtt' and sent_at < self._probe_start):
+            # replies to requests sent before the window was emptied still carry its queueing delay
+            return
+        if self._round_min_rtt is None or rtt < self._round_min_rtt:
+            self._round_min_rtt = rtt
+        interval = max(now - delivered_time, sent_at - first_sent_time)
+        if interval > 0:
+            self._round_rate = max(self._round_rate, (self.delivered - delivered) / interval)
+        if now - self._round_start >= max(self.min_rtt, MIN_ROUND_TIME):
+            self._end_round(now)
+
+    def _target(self):
+        return GAIN * self.bandwidth * max(self.min_rtt, MIN_ROUND_TIME)
+
+    def _end_round(self, now):
+        rate = self._round_rate
+        window_limited = self._round_peak >= self.window * 3 // 4
+        self._rates.append(rate)
+        self.bandwidth = max(self._rates)
+        target = self.window
+        if self.state == 'probe rtt':
+            self.min_rtt = self._round_min_rtt
+            self._min_rtt_stamp = now
+            self.state = 'steady'
+            target = self._target()
+        elif self.state == 'slow start':
+            if rate >= self._best_rate * SLOW_START_GROWTH:
+                self._best_rate = rate
+                self._stalled_rounds = 0
+            elif window_limited:
+                self._stalled_rounds += 1
+            if (self._stalled_rounds >= SLOW_START_ROUNDS
+                    or self._round_min_rtt > SLOW_START_DELAY * self.min_rtt):
+                self.state = 'steady'
+                target = self._target()
+            elif window_limited:
+                target = self.window * 2
+        elif now - self._min_rtt_stamp > MIN_RTT_EXPIRY:
+            self.state = 'probe rtt'
+            self._probe_start = now
+            target = 0
+        else:
+            target = self._target()
+        self._set_window(target)
+        self._round_start = now
+        self._round_rate = 0.0
+        self._round_peak = self.outstanding
+        self._round_min_rtt = None
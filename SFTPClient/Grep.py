@@ -0,0 +1,277 @@
+import collections
+import logging
+import posixpath
+import shlex
+import stat
+
+import paramiko
+from paramiko.sftp import (CMD_CLOSE, CMD_DATA, CMD_HANDLE, CMD_OPEN, CMD_READ, CMD_STATUS, SFTP_FLAG_READ, SFTPError,
+                          int64)
+from paramiko.sftp_attr import SFTPAttributes
+
+from SFTPClient import Archive
+from SFTPClient import Batch
+from SFTPClient.Transfer import Pipeline, flow_controller
+
+# Files searched at the same time, over one pipeline
+FILES_AT_ONCE = 4
+# READs outstanding per file; replies that arrive out of order are held until the gap before them is filled
+READS_PER_FILE = 16
+# Longest line kept whole; only the first MAX_LINE bytes of a longer line are searched and returned
+MAX_LINE = 1024 * 1024
+# Exit status of grep when it found no match
+NO_MATCH = 1
+# Run before the search: only GNU grep has -Z end file names with a NUL (BSD grep's -Z decompresses)
+GNU_CHECK = ("grep --version 2>/dev/null | grep -q 'GNU grep' || { echo 'grep is not GNU grep' >&2; exit "
+             + str(Archive.COMMAND_NOT_FOUND) + '; }')
+
+
+class LineMatcher(object):
+    """Finds the lines matching a compiled bytes regex in a stream fed in blocks of any size
+
+        The regex is searched across each block's complete lines at once, so lines without a
+        match cost no Python work; a line split between blocks is held until its end arrives.
+        matches is the list of (line number, line) found so far.
+    """
+
+    def __init__(self, regex, max_line=MAX_LINE):
+        self.regex = regex
+        self.max_line = max_line
+        self.matches = []
+        # lines completed so far
+        self.lineno = 0
+        self._partial = bytearray()
+        self._overlong = False
+
+    def feed(self, data):
+        last = data.rfind(b'\n')
+        if last < 0:
+            self._hold(data)
+            return
+        first = data.find(b'\n')
+        self._hold(data[:first])
+        self._end_line()
+        if first < last:
+            self._search(data, first + 1, last)
+        self._hold(data[last + 1:])
+
+    def finish(self):
+        """Match the last line, if the stream did not end with a newline"""
+        if self._partial or self._overlong:
+            self._end_line()
+
+    def _hold(self, data):
+        if self._overlong:
+            return
+        room = self.max_line - len(self._partial)
+        if len(data) > room:
+            data, self._overlong = data[:room], True
+        self._partial += data
+
+    def _end_line(self):
+        self.lineno += 1
+        if self.regex.search(self._partial):
+            self.matches.append((self.lineno, bytes(self._partial)))
+        self._partial, self._overlong = bytearray(), False
+
+    def _search(self, data, start, end):
+        """Match the lines of data[start:end], which begins after a newline and ends before one"""
+        lineno, counted, position = self.lineno, start, start
+        while position <= end:
+            match = self.regex.search(data, position, end)
+            if match is None:
+                break
+            line_start = max(data.rfind(b'\n', start, match.start()) + 1, start)
+            line_end = data.find(b'\n', match.start(), end)
+            line_end = end if line_end < 0 else line_end
+            lineno += data.count(b'\n', counted, line_start)
+            counted = line_start
+            line = data[line_start:min(line_end, line_start + self.max_line)]
+            # a match running on past the end of its line (e.g. "a\sb") or max_line must also match within it
+            if match.end() <= line_start + len(line) or self.regex.search(line):
+                self.matches.append((lineno + 1, line))
+            position = line_end + 1
+        self.lineno += data.count(b'\n', start, end) + 1
+
+
+class _FileSearch(object):
+    """The state of one file being searched"""
+
+    def __init__(self, path, size, matcher):
+        self.path = path
+        self.size = size
+        self.matcher = matcher
+        self.handle = None
+        self.error = None
+        # next offset to request, and next offset to feed to the matcher
+        self.requested = 0
+        self.position = 0
+        # offset -> data received ahead of position; (offset, length) to request again after short reads
+        self.held = {}
+        self.retry = collections.deque()
+        self.outstanding = 0
+        self.opening = True
+
+    def wants_read(self):
+        return (self.handle is not None and self.error is None and self.outstanding < READS_PER_FILE
+                and (self.retry or self.requested < self.size))
+
+    def done(self):
+        return not self.opening and self.outstanding == 0 and (self.error is not None or self.position >= self.size)
+
+    def received(self, offset, data):
+        self.held[offset] = data
+        while self.position in self.held:
+            data = self.held.pop(self.position)
+            self.matcher.feed(data)
+            self.position += len(data)
+
+
+def search(sftp, files, regex, max_line=MAX_LINE, throttle=None):
+    """Search remote files for the lines matching a compiled bytes regex, without storing them
+
+        files is a list of (path, size). FILES_AT_ONCE files are read at the same time over one
+        pipeline (their OPENs and READs interleaved, sized by the connection's read
+        FlowController), and each file's blocks are fed to a LineMatcher in order as they arrive.
+        Memory use is bounded by the READs outstanding (READS_PER_FILE per file) and max_line,
+        whatever the size of the files. Yields (path, [(line number, line)] or IOError) as each
+        file is finished, which need not be in the order given. throttle(length) is called before
+        each READ is sent.
+    """
+    flow = flow_controller(sftp, 'read')
+    pipeline = Pipeline(sftp)
+    waiting = collections.deque(files)
+    searches = []
+    # request number -> (search, offset or None for the OPEN, length, flow token)
+    pending = {}
+    while waiting or searches:
+        while waiting and len(searches) < FILES_AT_ONCE:
+            path, size = waiting.popleft()
+            item = _FileSearch(path, size, LineMatcher(regex, max_line))
+            searches.append(item)
+            pending[pipeline.send(CMD_OPEN, sftp._adjust_cwd(path), SFTP_FLAG_READ, SFTPAttributes())] = \
+                (item, None, None, None)
+        # one READ per file in turn, so every file keeps moving
+        while len(pending) < flow.in_flight and any(item.wants_read() for item in searches):
+            for item in searches:
+                if not item.wants_read() or len(pending) >= flow.in_flight:
+                    continue
+                if item.retry:
+                    offset, length = item.retry.popleft()
+                else:
+                    offset, length = item.requested, min(flow.block_size, item.size - item.requested)
+                    item.requested += length
+                if throttle is not None:
+                    throttle(length)
+                item.outstanding += 1
+                pending[pipeline.send(CMD_READ, item.handle, int64(offset), length)] = \
+                    (item, offset, length, flow.sent(length))
+        num, t, msg = pipeline.wait_any(list(pending))
+        item, offset, length, token = pending.pop(num)
+        if offset is None:
+            item.opening = False
+            try:
+                if t == CMD_STATUS:
+                    sftp._convert_status(msg)
+                if t != CMD_HANDLE:
+                    raise SFTPError('Expected handle')
+                item.handle = msg.get_binary()
+            except (IOError, SFTPError) as e:
+                item.error = e
+        else:
+            item.outstanding -= 1
+            try:
+                if t == CMD_STATUS:
+                    sftp._convert_status(msg)
+                if t != CMD_DATA:
+                    raise SFTPError('Expected data')
+                data = msg.get_string()
+                flow.received(token, length)
+                if not data:
+                    raise EOFError()
+                if len(data) < length:
+                    flow.limit_block_size(len(data))
+                    item.retry.append((offset + len(data), length - len(data)))
+                item.received(offset, data)
+            except EOFError:
+                # the file shrank since it was listed: search what it still holds
+                item.size = min(item.size, offset)
+                item.retry = collections.deque(request for request in item.retry if request[0] < item.size)
+            except (IOError, SFTPError) as e:
+                item.error = e
+        if item.done():
+            searches.remove(item)
+            if item.handle is not None:
+                pipeline.send(CMD_CLOSE, item.handle)
+            item.matcher.finish()
+            yield item.path, item.error if item.error is not None else item.matcher.matches
+
+
+def files(sftp, paths, recursive=False):
+    """Resolve paths to the files to search: ([(path, size)], [(path, IOError)])
+
+        Directories are searched (every regular file below them, in path order) only if
+        recursive, as grep -r does; symbolic links found while walking them are not followed.
+    """
+    found, errors = [], []
+    for path, attr in Batch.stat_many(sftp, paths).items():
+        if isinstance(attr, Exception):
+            errors.append((path, attr))
+        elif not stat.S_ISDIR(attr.st_mode):
+            found.append((path, attr.st_size))
+        elif not recursive:
+            errors.append((path, IOError('Is a directory')))
+        else:
+            tree = sorted((child, child_attr.st_size) for child, child_attr in
+                          Batch.walk(sftp, path, onerror=lambda directory, e: errors.append((directory, e)))
+                          if stat.S_ISREG(child_attr.st_mode))
+            found.extend(tree)
+    return found, errors
+
+
+def remote_grep(connection, pattern, paths, recursive=False, ignore_case=False, max_line=MAX_LINE):
+    """Run grep -E on the server through an exec channel, yielding (path, line number, line) as its output arrives
+
+        Only the matching lines cross the network, but the pattern is a POSIX extended regular
+        expression rather than a Python one. Relative paths are taken from the SFTP working
+        directory and reported as given. Lines are read at most max_line bytes at a time, and
+        stderr as it arrives (see Archive.StderrReader), so memory use stays bounded. Raises
+        Archive.ExecUnavailable if the server does not allow remote commands or has no GNU grep,
+        and IOError (after yielding every match) if grep could not read some of the paths.
+
+        :param connection: a pysftp.Connection
+    """
+    command = ('grep -E -H -n -Z' + (' -r' if recursive else '') + (' -i' if ignore_case else '') + ' -e '
+               + shlex.quote(pattern) + ' -- ' + ' '.join(shlex.quote(path) for path in paths))
+    # exec channels start in the home directory, not the SFTP working directory
+    cwd = connection.sftp_client.getcwd()
+    if cwd is not None:
+        command = 'cd ' + shlex.quote(cwd) + ' && ' + command
+    command = GNU_CHECK + '; ' + command
+    logging.debug('Searching on the server: ' + command)
+    channel = Archive.open_exec(connection, command)
+    stderr = Archive.StderrReader(channel)
+    try:
+        channel.shutdown_write()
+        reader = channel.makefile('rb')
+        while True:
+            line = reader.readline(max_line)
+            if not line:
+                break
+            rest = line
+            while not rest.endswith(b'\n') and rest:
+                rest = reader.readline(max_line)
+            # -Z ends the file name with a NUL, so names containing ':' are not ambiguous
+            path, _, numbered = line.rstrip(b'\n').partition(b'\0')
+            lineno, _, text = numbered.partition(b':')
+            yield posixpath.normpath(path.decode('utf-8', 'replace')), int(lineno), text
+        status = channel.recv_exit_status()
+        errors = stderr.text()
+    except (OSError, ValueError, paramiko.SSHException) as e:
+        raise IOError('remote grep failed: ' + str(e))
+    finally:
+        channel.close()
+    if status == Archive.COMMAND_NOT_FOUND:
+        raise Archive.ExecUnavailable('GNU grep not found on the server: ' + errors)
+    if status not in (0, NO_MATCH):
+        raise IOError('remote grep: ' + errors)
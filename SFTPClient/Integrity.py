@@ -0,0 +1,164 @@
+import binascii
+import datetime
+import hashlib
+import logging
+import posixpath
+import re
+import shlex
+import threading
+
+import paramiko
+
+# Hash algorithms accepted by --hash. xxh64 needs the optional "xxhash" package.
+ALGORITHMS = ('sha256', 'sha512', 'blake2b', 'xxh64', 'sha1', 'md5')
+
+# Algorithms the server can compute with the "check-file" SFTP extension (names from the draft)
+CHECK_FILE_ALGORITHMS = ('sha256', 'sha512', 'sha1', 'md5')
+
+# Files hashed per command run by remote_digests
+DIGEST_BATCH = 100
+
+# Commands used to hash a file on the server when check-file is not available
+REMOTE_COMMANDS = {'sha256': 'sha256sum',
+                   'sha512': 'sha512sum',
+                   'blake2b': 'b2sum',
+                   'xxh64': 'xxhsum',
+                   'sha1': 'sha1sum',
+                   'md5': 'md5sum'}
+
+
+def new_hash(algorithm):
+    """Return a new hash object for one of ALGORITHMS"""
+    if algorithm not in ALGORITHMS:
+        raise ValueError('Unsupported hash algorithm ' + repr(algorithm) + ', use one of: ' + ', '.join(ALGORITHMS))
+    if algorithm == 'xxh64':
+        try:
+            import xxhash
+        except ImportError:
+            raise ValueError('xxh64 hashing requires the xxhash package ("pip install xxhash")')
+        return xxhash.xxh64()
+    return hashlib.new(algorithm)
+
+
+class StreamHasher(object):
+    """Hashes a file from the blocks passing through a transfer, in whatever order they arrive
+
+        Blocks that arrive ahead of the current position are held until the gap before them has
+        been filled, so a pipelined download is hashed without reading the file a second time.
+        Data before the current position (sent again when a transfer resumes) is ignored.
+    """
+
+    def __init__(self, algorithm):
+        self.algorithm = algorithm
+        self.position = 0
+        self._hash = new_hash(algorithm)
+        self._early = {}
+        self._lock = threading.Lock()
+
+    def update(self, offset, data):
+        with self._lock:
+            if offset < self.position:
+                skip = self.position - offset
+                if skip >= len(data):
+                    return
+                offset, data = self.position, data[skip:]
+            if offset != self.position:
+                self._early[offset] = bytes(data)
+                return
+            self._hash.update(data)
+            self.position += len(data)
+            while self.position in self._early:
+                data = self._early.pop(self.position)
+                self._hash.update(data)
+                self.position += len(data)
+
+    def hexdigest(self):
+        with self._lock:
+            if self._early:
+                raise ValueError('hash is incomplete: no data received at offset ' + str(self.position))
+            return self._hash.hexdigest()
+
+
+def remote_digest(connection, remotepath, algorithm):
+    """Ask the server for the hex digest of remotepath, or return None if it cannot provide one
+
+        The "check-file" SFTP extension is tried first; otherwise the matching *sum command is run
+        through connection.execute(), which requires remote shell access.
+
+        :param connection: a pysftp.Connection
+    """
+    if algorithm in CHECK_FILE_ALGORITHMS:
+        try:
+            with connection.sftp_client.open(remotepath, 'rb') as f:
+                return binascii.hexlify(f.check(algorithm)).decode()
+        except IOError as e:
+            logging.debug('check-file ' + algorithm + ' unavailable for ' + remotepath + ': ' + str(e))
+
+    command = REMOTE_COMMANDS.get(algorithm)
+    if command is None:
+        return None
+    try:
+        output = connection.execute(command + ' ' + shlex.quote(connection.normalize(remotepath)))
+    except (paramiko.SSHException, IOError) as e:
+        logging.debug('Unable to run ' + command + ' on the server: ' + str(e))
+        return None
+    fields = b''.join(output[:1]).decode('utf-8', 'replace').split()
+    digest_length = 2 * new_hash(algorithm).digest_size
+    if fields and re.fullmatch('[0-9a-fA-F]{' + str(digest_length) + '}', fields[0]):
+        return fields[0].lower()
+    logging.debug(command + ' did not produce a digest: ' + repr(output[:1]))
+    return None
+
+
+def verify(connection, remotepath, hasher):
+    """Compare a StreamHasher's digest with the server's digest of remotepath
+
+        Returns the digest and whether it was verified (False if the server could not provide a
+        digest). Raises IOError if the digests differ.
+    """
+    digest = hasher.hexdigest()
+    expected = remote_digest(connection, remotepath, hasher.algorithm)
+    if expected is not None and expected != digest:
+        raise IOError(remotepath + ': ' + hasher.algorithm + ' mismatch (transferred ' + digest
+                      + ', server has ' + expected + ')')
+    return digest, expected is not None
+
+
+def remote_digests(connection, remotepaths, algorithm):
+    """Ask the server for the hex digests of many files, with one *sum command per DIGEST_BATCH files
+
+        Returns a dict of remote path -> hex digest, without the files the command could not hash
+        (or any file, if the server has no shell access or the command). Relative paths are taken
+        from the SFTP working directory, which is tracked client side, so no path costs a round trip.
+
+        :param connection: a pysftp.Connection
+    """
+    digests = {}
+    command = REMOTE_COMMANDS.get(algorithm)
+    digest_length = 2 * new_hash(algorithm).digest_size
+    cwd = connection.sftp_client.getcwd()
+    for start in range(0, len(remotepaths), DIGEST_BATCH):
+        batch = {posixpath.join(cwd, path) if cwd else path: path
+                 for path in remotepaths[start:start + DIGEST_BATCH]}
+        try:
+            output = connection.execute(command + ' -- ' + ' '.join(shlex.quote(path) for path in batch))
+        except (paramiko.SSHException, IOError) as e:
+            logging.debug('Unable to run ' + command + ' on the server: ' + str(e))
+            return digests
+        for line in output:
+            line = line.decode('utf-8', 'replace').rstrip('\n')
+            # names containing a backslash or newline are escaped, and their line starts with a backslash
+            escaped = line.startswith('\\')
+            digest, _, name = (line[1:] if escaped else line).partition('  ')
+            if escaped:
+                name = re.sub(r'\\(.)', lambda match: '\n' if match.group(1) == 'n' else match.group(1), name)
+            if name in batch and re.fullmatch('[0-9a-fA-F]{' + str(digest_length) + '}', digest):
+                digests[batch[name]] = digest.lower()
+    return digests
+
+
+def record(manifest, algorithm, digest, source, destination, verified):
+    """Append a transfer to the manifest file (one tab-separated line per file)"""
+    with open(manifest, 'a') as f:
+        f.write('\t'.join([datetime.datetime.now().isoformat(timespec='seconds'), algorithm, digest,
+                           'verified' if verified else 'unverified', source, destination]) + '\n')
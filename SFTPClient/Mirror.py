@@ -0,0 +1,532 @@
+import collections
+import itertools
+import os
+import posixpath
+import shutil
+import sqlite3
+import stat
+
+from SFTPClient import Batch
+from SFTPClient import Diff
+from SFTPClient import Integrity
+from SFTPClient import Transfer
+from SFTPClient.Cache import DEFAULT_CACHE_DIRECTORY
+
+DEFAULT_MANIFEST = os.path.join(DEFAULT_CACHE_DIRECTORY, 'mirror.sqlite')
+
+# The synced state of a path as recorded in the manifest, shaped like os.stat_result and SFTPAttributes so it
+# can be compared with either (see Diff.compare_entries); hash is the digest taken while transferring it, or None
+Entry = collections.namedtuple('Entry', ['st_mode', 'st_size', 'st_mtime', 'hash'])
+
+# One step of a sync: action is 'uploaded', 'downloaded', 'created', 'deleted' or 'skipped', path is relative to
+# both roots ('' is the root itself), error an exception if the step failed (None for a dry run)
+Result = collections.namedtuple('Result', ['action', 'path', 'error'])
+
+
+def _join(directory, name):
+    return directory + '/' + name if directory else name
+
+
+def _parent(path):
+    return posixpath.dirname(path)
+
+
+def _depth(path):
+    return path.count('/') + 1 if path else 0
+
+
+def _by_depth(paths, deepest_first=False):
+    """Group paths by depth, so each group can be created (or removed) concurrently"""
+    ordered = sorted(paths, key=_depth, reverse=deepest_first)
+    return [list(group) for _depth_, group in itertools.groupby(ordered, key=_depth)]
+
+
+class Manifest(object):
+    """The state of mirrored trees after their last sync, kept in an SQLite database
+
+        Each mirror (host, local directory, remote directory) has a row per path below its roots
+        (relative, '/' separated, '' for the roots themselves) with the type, size and mtime the
+        path had on both sides once synced (mtimes are copied with the files) and the digest taken
+        while transferring it. Directories also record a version (the mtime) of each side's copy:
+        a directory whose version has not moved has had no entries added, removed or renamed, so
+        the next sync does not need to list it.
+    """
+
+    def __init__(self, path=DEFAULT_MANIFEST):
+        self.path = os.path.expanduser(path)
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        self.db = sqlite3.connect(self.path, timeout=30)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS mirrors (id INTEGER PRIMARY KEY, host TEXT NOT NULL, '
+                            'localdir TEXT NOT NULL, remotedir TEXT NOT NULL, UNIQUE (host, localdir, remotedir))')
+            self.db.execute('CREATE TABLE IF NOT EXISTS entries (mirror INTEGER NOT NULL, path TEXT NOT NULL, '
+                            'parent TEXT, mode INTEGER NOT NULL, size INTEGER, mtime INTEGER, '
+                            'local_version INTEGER, remote_version INTEGER, hash TEXT, PRIMARY KEY (mirror, path))')
+            self.db.execute('CREATE INDEX IF NOT EXISTS entries_parent ON entries (mirror, parent)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def mirror(self, host, localdir, remotedir):
+        """The id of a mirror, which is created (empty) the first time it is asked for"""
+        with self.db:
+            self.db.execute('INSERT OR IGNORE INTO mirrors (host, localdir, remotedir) VALUES (?, ?, ?)',
+                            (host, localdir, remotedir))
+            return self.db.execute('SELECT id FROM mirrors WHERE host = ? AND localdir = ? AND remotedir = ?',
+                                   (host, localdir, remotedir)).fetchone()[0]
+
+    def directories(self, mirror):
+        """{path: (local version, remote version)} of a mirror's directories; a version is None if unknown"""
+        rows = self.db.execute('SELECT path, local_version, remote_version FROM entries WHERE mirror = ? AND mode = ?',
+                               (mirror, stat.S_IFDIR))
+        return {path: (local_version, remote_version) for path, local_version, remote_version in rows}
+
+    def entry(self, mirror, path):
+        row = self.db.execute('SELECT mode, size, mtime, hash FROM entries WHERE mirror = ? AND path = ?',
+                              (mirror, path)).fetchone()
+        return Entry(*row) if row is not None else None
+
+    def children(self, mirror, directory):
+        """{path: Entry} of the entries directly in a directory"""
+        rows = self.db.execute('SELECT path, mode, size, mtime, hash FROM entries WHERE mirror = ? AND parent = ?',
+                               (mirror, directory))
+        return {row[0]: Entry(*row[1:]) for row in rows}
+
+    def subtree(self, mirror, path):
+        """{path: Entry} of path and everything recorded below it"""
+        if path:
+            pattern = path.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '/%'
+            rows = self.db.execute('SELECT path, mode, size, mtime, hash FROM entries WHERE mirror = ? '
+                                   "AND (path = ? OR path LIKE ? ESCAPE '\\')", (mirror, path, pattern))
+        else:
+            rows = self.db.execute('SELECT path, mode, size, mtime, hash FROM entries WHERE mirror = ?', (mirror,))
+        return {row[0]: Entry(*row[1:]) for row in rows}
+
+    def update(self, mirror, record, forget, versions):
+        """Record {path: Entry}, forget paths and set {directory: (local version, remote version)}
+
+            The digest of a recorded file is kept if the file was recorded before with the same
+            size and mtime and is recorded now without one.
+        """
+        with self.db:
+            self.db.executemany(
+                'INSERT INTO entries (mirror, path, parent, mode, size, mtime, hash) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                'ON CONFLICT (mirror, path) DO UPDATE SET mode = excluded.mode, size = excluded.size, '
+                'mtime = excluded.mtime, hash = COALESCE(excluded.hash, CASE WHEN entries.size = excluded.size '
+                'AND entries.mtime = excluded.mtime THEN entries.hash END)',
+                [(mirror, path, _parent(path) if path else None, stat.S_IFMT(entry.st_mode), entry.st_size,
+                  int(entry.st_mtime), entry.hash) for path, entry in record.items()])
+            self.db.executemany('DELETE FROM entries WHERE mirror = ? AND path = ?',
+                                [(mirror, path) for path in forget])
+            self.db.executemany('UPDATE entries SET local_version = ?, remote_version = ? '
+                                'WHERE mirror = ? AND path = ?',
+                                [(local_version, remote_version, mirror, path)
+                                 for path, (local_version, remote_version) in versions.items()])
+
+    def clear(self, mirror):
+        with self.db:
+            self.db.execute('DELETE FROM entries WHERE mirror = ?', (mirror,))
+
+
+class _LocalTree(object):
+    """The local side of a mirror; paths are relative to root"""
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, relative):
+        return os.path.join(self.root, *relative.split('/')) if relative else self.root
+
+    @staticmethod
+    def version(attr):
+        # nanoseconds, so an entry added within the second of the last sync still moves it
+        return attr.st_mtime_ns
+
+    def stat_directories(self, paths):
+        """{path: os.stat_result, or None if it is not a directory (any more)}"""
+        directories = {}
+        for path in paths:
+            try:
+                attr = os.stat(self.path(path))
+            except OSError:
+                attr = None
+            directories[path] = attr if attr is not None and stat.S_ISDIR(attr.st_mode) else None
+        return directories
+
+    def list_directories(self, paths):
+        """Yield (directory, {path: attributes}) for each directory in paths"""
+        for directory in paths:
+            with os.scandir(self.path(directory)) as entries:
+                yield directory, {_join(directory, entry.name): entry.stat(follow_symlinks=False) for entry in entries}
+
+    def walk(self, paths):
+        for directory in paths:
+            for path, attr in Diff.walk_local(self.path(directory)):
+                yield _join(directory, path), attr
+
+    def make_directories(self, paths):
+        for path in sorted(paths):
+            try:
+                os.makedirs(self.path(path), exist_ok=True)
+                yield path, None
+            except OSError as e:
+                yield path, e
+
+    def remove(self, files, directories):
+        """Remove files, then directories (deepest first); yields (path, error or None)"""
+        for path in files:
+            try:
+                os.remove(self.path(path))
+                yield path, None
+            except OSError as e:
+                yield path, e
+        for path in sorted(directories, key=_depth, reverse=True):
+            try:
+                os.rmdir(self.path(path))
+                yield path, None
+            except OSError as e:
+                yield path, e
+
+    def remove_tree(self, path):
+        if os.path.isdir(self.path(path)) and not os.path.islink(self.path(path)):
+            shutil.rmtree(self.path(path))
+        else:
+            os.remove(self.path(path))
+
+
+class _RemoteTree(object):
+    """The remote side of a mirror; every batch of requests is pipelined (see Batch)"""
+
+    def __init__(self, sftp, root):
+        self.sftp = sftp
+        self.root = root
+
+    def path(self, relative):
+        return posixpath.join(self.root, relative) if relative else self.root
+
+    def relative(self, path):
+        relative = posixpath.relpath(path, self.root)
+        return '' if relative == '.' else relative
+
+    @staticmethod
+    def version(attr):
+        # SFTP carries whole seconds
+        return int(attr.st_mtime)
+
+    def stat_directories(self, paths):
+        paths = list(paths)
+        attrs = Batch.stat_many(self.sftp, [self.path(path) for path in paths])
+        return {path: attr if not isinstance(attr, Exception) and stat.S_ISDIR(attr.st_mode) else None
+                for path, attr in zip(paths, (attrs[self.path(path)] for path in paths))}
+
+    def list_directories(self, paths):
+        listings = {directory: {} for directory in paths}
+        if listings:
+            for path, attr in Batch.walk(self.sftp, [self.path(directory) for directory in listings], recursive=False):
+                path = self.relative(path)
+                listings[_parent(path)][path] = attr
+        return listings.items()
+
+    def walk(self, paths):
+        if paths:
+            for path, attr in Batch.walk(self.sftp, [self.path(directory) for directory in paths]):
+                yield self.relative(path), attr
+
+    def make_directories(self, paths):
+        for level in _by_depth(paths):
+            for path, error in Batch.mkdir(self.sftp, [self.path(path) for path in level]):
+                yield self.relative(path), error
+
+    def remove(self, files, directories):
+        for path, error in Batch.remove(self.sftp, [self.path(path) for path in files]):
+            yield self.relative(path), error
+        for level in _by_depth(directories, deepest_first=True):
+            for path, error in Batch.rmdir(self.sftp, [self.path(path) for path in level]):
+                yield self.relative(path), error
+
+    def remove_tree(self, path):
+        attr = self.sftp.lstat(self.path(path))
+        if not stat.S_ISDIR(attr.st_mode):
+            self.sftp.remove(self.path(path))
+            return
+        files, directories = [], [path]
+        for child, attr in self.walk([path]):
+            (directories if stat.S_ISDIR(attr.st_mode) else files).append(child)
+        for _path, error in self.remove(files, directories):
+            if error is not None:
+                raise error
+
+
+class _Scan(object):
+    """What one side of a mirror holds now, where it may differ from the manifest
+
+        Only the directories whose version moved since the last sync are listed, concurrently,
+        and new directories found in them are walked whole. found maps every path seen (or seen
+        to have gone) to its attributes or None; complete holds the directories all of whose
+        entries are in found. Any other path is as the manifest recorded it. Files changed in
+        place do not move their directory's version, so they are only seen in listed directories;
+        the directories in force are listed whatever their version. A trusted side is not looked
+        at all, and taken to be as the manifest has it.
+    """
+
+    def __init__(self, tree, manifest, mirror, versions, force=(), trusted=False):
+        self.tree = tree
+        self.manifest = manifest
+        self.mirror = mirror
+        self.found = {}
+        self.complete = set()
+        # directory -> version when scanned
+        self.versions = {}
+        self.listed = 0
+        # walked whole: nothing is as the manifest recorded it
+        self.everything = '' not in versions
+        if self.everything:
+            self._add('', self.tree.stat_directories(['']).get(''))
+            if self.found[''] is not None:
+                self._walk([''])
+            return
+        if trusted:
+            self.versions = dict(versions)
+            return
+        now = self.tree.stat_directories(versions)
+        for path, attr in sorted(now.items()):
+            if attr is None:
+                if path not in self.found:
+                    self._forget(path)
+            else:
+                self.versions[path] = self.tree.version(attr)
+        changed = [path for path, attr in now.items()
+                   if attr is not None and (path in force or self.versions.get(path) != versions[path])]
+        new = []
+        for directory, children in self.tree.list_directories(changed):
+            self.listed += 1
+            self._add(directory, now[directory])
+            old = self.manifest.children(self.mirror, directory)
+            for path, attr in children.items():
+                self._add(path, attr)
+                before = old.get(path)
+                was_directory = before is not None and stat.S_ISDIR(before.st_mode)
+                if stat.S_ISDIR(attr.st_mode) and not was_directory:
+                    new.append(path)
+                elif was_directory and not stat.S_ISDIR(attr.st_mode):
+                    self._forget(path, keep=True)
+            for path in old:
+                if path not in children:
+                    self._forget(path)
+        self._walk(new)
+
+    def _add(self, path, attr):
+        self.found[path] = attr
+        if attr is not None and stat.S_ISDIR(attr.st_mode):
+            self.complete.add(path)
+            self.versions[path] = self.tree.version(attr)
+
+    def _walk(self, directories):
+        self.listed += len(directories)
+        for path, attr in self.tree.walk(directories):
+            self._add(path, attr)
+            if stat.S_ISDIR(attr.st_mode):
+                self.listed += 1
+
+    def _forget(self, path, keep=False):
+        """Mark what the manifest has at (with keep, below) path as gone"""
+        for stale, entry in self.manifest.subtree(self.mirror, path).items():
+            if keep and stale == path:
+                continue
+            self.found.setdefault(stale, None)
+            if stat.S_ISDIR(entry.st_mode):
+                self.complete.add(stale)
+                self.versions.pop(stale, None)
+
+    def state(self, path):
+        """The attributes of path on this side now, or None if it does not exist"""
+        if path in self.found:
+            return self.found[path]
+        if path:
+            if _parent(path) in self.complete or self.everything:
+                return None
+            parent = self.state(_parent(path))
+            if parent is None or not stat.S_ISDIR(parent.st_mode):
+                return None
+        return self.manifest.entry(self.mirror, path)
+
+
+def _entry(attr, digest=None):
+    """attr (os.stat_result, SFTPAttributes or an Entry) as an Entry"""
+    if isinstance(attr, Entry):
+        return attr
+    return Entry(attr.st_mode, attr.st_size, int(attr.st_mtime), digest)
+
+
+def _mirrored(attr):
+    return attr is None or stat.S_ISREG(attr.st_mode) or stat.S_ISDIR(attr.st_mode)
+
+
+def sync(sftp, manifest, host, direction, localdir, remotedir, delete=False, full=False, dry_run=False,
+         algorithm=None, reconnect=None, throttle=None, changed=None):
+    """Make remotedir a copy of localdir (direction 'push') or localdir a copy of remotedir ('pull')
+
+        Both sides are scanned against the manifest's record of the last sync (see _Scan), so
+        an unchanged tree costs one pipelined STAT per directory and no listing; full ignores the
+        record and walks both trees. The paths that differ are then fixed on the destination:
+        directories are created level by level with pipelined requests and files transferred
+        over one pipeline (Transfer.put_many / download_many, mtimes preserved, hashed with
+        algorithm if given). Paths only on the destination are deleted only with delete, which is
+        also needed to replace a file by a directory or the reverse. Only regular files and
+        directories are mirrored. Returns (list of Result, directories listed, directories in the
+        mirror); with dry_run nothing is changed.
+
+        changed, the source paths known to have changed since the last sync (see Watch), narrows
+        the scan down to listing the directories that hold them: the destination is then taken
+        to be as the last sync left it.
+
+        :param sftp: a paramiko.SFTPClient
+        :param reconnect: called by transfers to get a new paramiko.SFTPClient once the connection
+            is lost; the rest of the sync then uses it
+    """
+    local, remote = _LocalTree(localdir), _RemoteTree(sftp, remotedir)
+    if reconnect is not None:
+        reconnect = _following(remote, reconnect)
+    source, destination = (local, remote) if direction == 'push' else (remote, local)
+    mirror = manifest.mirror(host, localdir, remotedir)
+    versions = {} if full else manifest.directories(mirror)
+    force = set()
+    for path in changed or ():
+        # a path's own listing (if it is a directory) and its parent's, or the nearest one the manifest knows
+        for directory in (path, _parent(path)) if path else (path,):
+            while directory and directory not in versions:
+                directory = _parent(directory)
+            force.add(directory)
+    scans = {}
+    for tree, side in ((local, 0), (remote, 1)):
+        scans[tree] = _Scan(tree, manifest, mirror, {path: version[side] for path, version in versions.items()},
+                            force if tree is source else (), changed is not None and tree is destination)
+
+    results = []
+    record, forget = {}, []
+    create, transfer, remove_files, remove_directories, replace = [], [], [], [], []
+    for path in sorted(set(scans[source].found) | set(scans[destination].found)):
+        new, old = scans[source].state(path), scans[destination].state(path)
+        if not _mirrored(new) or not _mirrored(old):
+            continue
+        change = Diff.compare_entries(path, new, old)
+        if change is None:
+            record[path] = new
+        elif change.status == 'removed':
+            if delete:
+                (remove_directories if stat.S_ISDIR(old.st_mode) else remove_files).append(path)
+            forget.append(path)
+        elif change.reason == 'type' and not delete:
+            results.append(Result('skipped', path, IOError('the destination is a ' + (
+                'directory' if stat.S_ISDIR(old.st_mode) else 'file') + ', use --delete to replace it')))
+        else:
+            if change.reason == 'type':
+                replace.append(path)
+            (create if stat.S_ISDIR(new.st_mode) else transfer).append(path)
+    if dry_run:
+        return (results + [Result('deleted', path, None) for path in remove_files + remove_directories + replace]
+                + [Result('created', path, None) for path in create]
+                + [Result('uploaded' if direction == 'push' else 'downloaded', path, None) for path in transfer],
+                scans[local].listed + scans[remote].listed, len(scans[source].versions))
+
+    if full:
+        manifest.clear(mirror)
+    failed = {result.path for result in results}
+    touched = set()
+
+    def report(action, path, error):
+        results.append(Result(action, path, error))
+        touched.add(_parent(path))
+        if error is not None:
+            failed.add(path)
+
+    for path, error in destination.remove(remove_files, remove_directories):
+        report('deleted', path, error)
+    for path in replace:
+        try:
+            destination.remove_tree(path)
+            report('deleted', path, None)
+        except (IOError, OSError) as e:
+            report('deleted', path, e)
+    for path, error in destination.make_directories(path for path in create if path not in failed):
+        report('created', path, error)
+        if error is None:
+            record[path] = scans[source].state(path)
+            touched.add(path)
+    transfer = [path for path in transfer if path not in failed and _parent(path) not in failed]
+    for path, (attr, error) in zip(transfer, _transfer(direction, local, remote, transfer, scans[source],
+                                                       algorithm, reconnect, throttle)):
+        report('uploaded' if direction == 'push' else 'downloaded', path, error)
+        if error is None:
+            record[path] = attr
+    results.sort(key=lambda result: result.path)
+
+    # a directory holding a failure is recorded without versions, so the next sync lists it again
+    retry = {_parent(path) for path in failed}
+    touched = [path for path in touched if path not in failed and path not in retry]
+    after = dict(versions)
+    for tree in (local, remote):
+        now = dict(scans[tree].versions)
+        if tree is destination:
+            now.update((path, tree.version(attr)) for path, attr in tree.stat_directories(touched).items()
+                       if attr is not None)
+        for path, version in now.items():
+            pair = list(after.get(path, (None, None)))
+            pair[tree is remote] = version
+            after[path] = tuple(pair)
+    after.update((path, (None, None)) for path in retry)
+    manifest.update(mirror, {path: _entry(attr) for path, attr in record.items() if path not in failed}, forget,
+                    {path: pair for path, pair in after.items()
+                     if (path in record or path in versions) and pair != versions.get(path)})
+    return results, scans[local].listed + scans[remote].listed, len(scans[source].versions)
+
+
+def _following(remote, reconnect):
+    """Wrap reconnect so that the remote tree follows the transfers onto the new connection"""
+    def reconnected():
+        remote.sftp = reconnect()
+        return remote.sftp
+    return reconnected
+
+
+def _transfer(direction, local, remote, paths, scan, algorithm, reconnect, throttle):
+    """Send paths from the source to the destination over one pipeline; returns [(Entry, error or None)]"""
+    sftp = remote.sftp
+    hashers = [Integrity.StreamHasher(algorithm) if algorithm is not None else None for _path in paths]
+    outcome = [None] * len(paths)
+    if direction == 'pull':
+        # the listing may be the manifest's, and the download needs the file's size now
+        attrs = Batch.stat_many(sftp, [remote.path(path) for path in paths])
+        files = []
+        for index, path in enumerate(paths):
+            attr = attrs[remote.path(path)]
+            if isinstance(attr, Exception):
+                outcome[index] = (None, attr)
+            else:
+                files.append((index, (remote.path(path), local.path(path), attr, hashers[index])))
+    else:
+        files = [(index, (local.path(path), remote.path(path), hashers[index])) for index, path in enumerate(paths)]
+
+    def done(position):
+        index, file = files[position]
+        attr = file[2] if direction == 'pull' else scan.state(paths[index])
+        digest = hashers[index].hexdigest() if hashers[index] is not None else None
+        outcome[index] = (_entry(attr, digest), None)
+
+    if files:
+        transfer = Transfer.download_many if direction == 'pull' else Transfer.put_many
+        try:
+            transfer(sftp, [file for _index, file in files], preserve_mtime=True, reconnect=reconnect,
+                     throttle=throttle, on_done=done)
+        except (IOError, OSError) as e:
+            for index, _file in files:
+                if outcome[index] is None:
+                    outcome[index] = (None, e)
+    return outcome
@@ -0,0 +1,73 @@
+import re
+import stat
+
+# Bits each "who" letter of a symbolic mode may change
+WHO_BITS = {'u': stat.S_ISUID | stat.S_IRWXU,
+            'g': stat.S_ISGID | stat.S_IRWXG,
+            'o': stat.S_ISVTX | stat.S_IRWXO}
+WHO_BITS['a'] = WHO_BITS['u'] | WHO_BITS['g'] | WHO_BITS['o']
+PERMISSION_BITS = {'r': 0o444, 'w': 0o222, 'x': 0o111, 's': stat.S_ISUID | stat.S_ISGID, 't': stat.S_ISVTX}
+CLAUSE = re.compile(r'([ugoa]*)((?:[-+=][rwxXst]*)+)')
+ACTION = re.compile(r'([-+=])([rwxXst]*)')
+
+
+def is_mode(text):
+    """Whether text is a valid mode (see ModeChange)"""
+    try:
+        ModeChange(text)
+    except ValueError:
+        return False
+    return True
+
+
+class ModeChange(object):
+    """A chmod mode, either octal ("755") or symbolic ("u+x,go-w", "a=rX")
+
+        new_mode() gives the permission bits a file ends up with, so callers can skip files that
+        already have them. Symbolic modes without a "who" apply to everyone (no umask is applied).
+    """
+
+    def __init__(self, text):
+        text = str(text)
+        self.text = text
+        self.octal = None
+        self.clauses = []
+        if re.fullmatch('[0-7]{1,4}', text):
+            self.octal = int(text, 8)
+            return
+        for clause in text.split(','):
+            match = CLAUSE.fullmatch(clause)
+            if match is None:
+                raise ValueError('Invalid mode: ' + repr(text))
+            mask = 0
+            for who in match.group(1) or 'a':
+                mask |= WHO_BITS[who]
+            self.clauses.extend((mask, op, perms) for op, perms in ACTION.findall(match.group(2)))
+
+    @property
+    def absolute(self):
+        """Whether the result does not depend on the current mode"""
+        return self.octal is not None
+
+    def new_mode(self, mode=0, is_dir=False):
+        """Return the permission bits (stat.S_IMODE) for a file currently in mode"""
+        if self.octal is not None:
+            return self.octal
+        mode = stat.S_IMODE(mode)
+        for mask, op, perms in self.clauses:
+            bits = 0
+            for perm in perms:
+                if perm == 'X':
+                    # execute only for directories and files already executable by someone
+                    if is_dir or mode & 0o111:
+                        bits |= 0o111
+                else:
+                    bits |= PERMISSION_BITS[perm]
+            bits &= mask
+            if op == '+':
+                mode |= bits
+            elif op == '-':
+                mode &= ~bits
+            else:
+                mode = (mode & ~mask) | bits
+        return mode
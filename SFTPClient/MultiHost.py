@@ -0,0 +1,189 @@
+import collections
+import logging
+import ntpath
+import os
+import re
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+from SFTPClient.Client import SFTP, DOWNLOADS_DIRECTORY, HISTORY_FILE, pop_option
+
+# Number of hosts worked on at the same time
+DEFAULT_MAX_WORKERS = 8
+
+# Commands that only touch the local machine, so they run once rather than once per host
+LOCAL_COMMANDS = ('history', 'lsl', 'cdl', 'pwdl', 'renamel', 'cache')
+
+Host = collections.namedtuple('Host', ['hostname', 'port', 'username'])
+
+_HOST_PATTERN = re.compile(r'^(?:(?P<username>[^@]+)@)?(?:\[(?P<ipv6>[^\]]+)\]|(?P<hostname>[^:]+))(?::(?P<port>\d+))?$')
+
+
+def parse_host(text, port=22, username=None):
+    """Parse "[user@]host[:port]" (IPv6 addresses in brackets) into a Host"""
+    match = _HOST_PATTERN.match(text.strip())
+    if match is None:
+        raise ValueError('Invalid host: ' + repr(text))
+    return Host(match.group('ipv6') or match.group('hostname'),
+                int(match.group('port') or port),
+                match.group('username') or username)
+
+
+def read_inventory(path, port=22, username=None):
+    """Read one "[user@]host[:port]" per line; blank lines and # comments are ignored"""
+    hosts = []
+    with open(os.path.expanduser(path)) as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                hosts.append(parse_host(line, port, username))
+    return hosts
+
+
+def host_label(host):
+    return host.hostname if host.port == 22 else host.hostname + ':' + str(host.port)
+
+
+class MultiSFTP(object):
+    """Runs SFTP commands against several hosts at once
+
+        Connections are opened in parallel, and every command runs on up to max_workers hosts
+        concurrently. put sends the same files to every host, and get downloads a path from
+        every host into a per-host local directory. Commands return one line per host saying
+        whether it succeeded, so one unreachable or failing host does not stop the others.
+        Extra keyword arguments (e.g. keepalive) are passed to every SFTP connection.
+    """
+
+    def __init__(self, hosts, username, password=None, private_key_password=None, max_workers=DEFAULT_MAX_WORKERS,
+                 **options):
+        self.hosts = list(hosts)
+        self.labels = [host_label(host) for host in self.hosts]
+        self.max_workers = max_workers
+        self.clients = {}
+        self.errors = {}
+
+        # SFTP() creates these; do it once up front rather than racing in every thread
+        if not os.path.exists(DOWNLOADS_DIRECTORY):
+            os.mkdir(DOWNLOADS_DIRECTORY)
+        if os.path.exists(HISTORY_FILE):
+            os.remove(HISTORY_FILE)
+
+        def connect(label, host):
+            return SFTP(host.hostname, host.username or username, password, private_key_password, port=host.port,
+                        **options)
+
+        for label, client, error in self._run(connect, list(zip(self.labels, self.hosts))):
+            if error is None:
+                self.clients[label] = client
+            else:
+                logging.error('Unable to connect to ' + label + ': ' + str(error))
+                self.errors[label] = error
+
+    def __getattr__(self, name):
+        command = getattr(SFTP, name, None)
+        if name.startswith('_') or not callable(command) or name in ('log_history', 'reconnecting',
+                                                                     'initiate_connection', 'is_connected',
+                                                                     'connection_alive', 'reconnect'):
+            raise AttributeError(name)
+        if name in LOCAL_COMMANDS:
+            return lambda args: command(self._any_client(), args)
+
+        # call the undecorated command on each host so that history is only written once
+        command_func = getattr(command, '__wrapped__', command)
+
+        def run_everywhere(self, args):
+            return self._report(self._run_on_clients(lambda label, client: command_func(client, args)))
+
+        run_everywhere.__name__ = name
+        return lambda args: SFTP.log_history(run_everywhere)(self, args)
+
+    @SFTP.log_history
+    def put(self, args):
+        """Put the same file(s) to every host (same arguments as SFTP.put)"""
+        put = SFTP.put.__wrapped__
+        return self._report(self._run_on_clients(lambda label, client: put(client, args)))
+
+    @SFTP.log_history
+    def get(self, args):
+        """Download a remote file from every host into <localdir>/<host>/ (localdir defaults to downloads)"""
+        algorithm, paths = pop_option(args, '--hash')
+        rate, paths = pop_option(paths, '--limit')
+        if len(paths) < 1 or len(paths) > 2:
+            raise TypeError("get() takes 1 or 2 arguments (" + str(len(paths)) + " given)")
+        remotepath = paths[0]
+        localdir = os.path.expanduser(paths[1]) if len(paths) == 2 else DOWNLOADS_DIRECTORY
+        head, tail = ntpath.split(remotepath)
+        filename = tail or ntpath.basename(head)
+        get = SFTP.get.__wrapped__
+
+        def get_from(label, client):
+            host_dir = os.path.join(localdir, label.replace(':', '_'))
+            os.makedirs(host_dir, exist_ok=True)
+            options = ['--hash', algorithm] if algorithm is not None else []
+            options += ['--limit', rate] if rate is not None else []
+            get(client, options + [remotepath, os.path.join(host_dir, filename)])
+            return os.path.join(host_dir, filename)
+
+        return self._report(self._run_on_clients(get_from))
+
+    @SFTP.log_history
+    def close(self, _args):
+        for client in self.clients.values():
+            try:
+                client.connection.close()
+            except Exception:
+                pass
+        exit()
+
+    def _any_client(self):
+        if not self.clients:
+            raise IOError('Not connected to any host')
+        return self.clients[next(label for label in self.labels if label in self.clients)]
+
+    def _run(self, func, items):
+        """Call func(label, item) for every (label, item) with bounded concurrency
+
+            Returns (label, result, error) tuples in the order of items.
+        """
+        def call(label, item):
+            try:
+                result = func(label, item)
+                if isinstance(result, types.GeneratorType):
+                    # streamed output (cat, tail -f) is collected per host, until interrupted
+                    result = list(result)
+                return label, result, None
+            except Exception as e:
+                return label, None, e
+
+        if not items:
+            return []
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, len(items))) as pool:
+            futures = [pool.submit(call, label, item) for label, item in items]
+            while True:
+                try:
+                    return [future.result() for future in futures]
+                except KeyboardInterrupt:
+                    # Ctrl-C stops long-running commands (watch), which then return as usual
+                    for client in self.clients.values():
+                        client.interrupted.set()
+
+    def _run_on_clients(self, func):
+        results = self._run(func, [(label, self.clients[label]) for label in self.labels if label in self.clients])
+        results.extend((label, None, IOError('not connected: ' + str(error))) for label, error in self.errors.items())
+        order = {label: i for i, label in enumerate(self.labels)}
+        return sorted(results, key=lambda result: order[result[0]])
+
+    @staticmethod
+    def _report(results):
+        """Format per-host results as lines of "<host>: ok|<result>|FAILED: <error>" """
+        lines = []
+        for label, result, error in results:
+            if error is not None:
+                lines.append(label + ': FAILED: ' + (str(error) or error.__class__.__name__))
+            elif isinstance(result, list):
+                lines.extend(label + ': ' + str(item) for item in result)
+            elif result is None:
+                lines.append(label + ': ok')
+            else:
+                lines.append(label + ': ' + str(result))
+        return lines
@@ -0,0 +1,107 @@
+import collections
+import logging
+
+from SFTPClient import Transfer
+
+# Bytes cat reads (with pipelined READs) and hands on at a time
+CAT_WINDOW = 4 * 1024 * 1024
+# head and tail read blocks of BLOCK_SIZE bytes, doubling up to MAX_BLOCK_SIZE until they have their lines
+BLOCK_SIZE = 64 * 1024
+MAX_BLOCK_SIZE = 4 * 1024 * 1024
+# Seconds between the size checks of follow
+FOLLOW_INTERVAL = 1.0
+
+
+def read_range(sftp, handle, offset, length, throttle=None):
+    """Read length bytes at offset of an open remote handle with pipelined READs"""
+    buffer = bytearray(length)
+
+    def write(position, data):
+        buffer[position - offset:position - offset + len(data)] = data
+
+    Transfer.read_pipelined(sftp, handle, offset + length, write, ranges=[(offset, length)], throttle=throttle)
+    return bytes(buffer)
+
+
+def cat(sftp, remotepath, throttle=None):
+    """Yield the whole of remotepath, in order, CAT_WINDOW bytes at a time
+
+        Each window is read with pipelined READs, so memory use is bounded by the window and the
+        link stays busy within it.
+    """
+    with sftp.open(remotepath, 'rb') as remote_file:
+        size = remote_file.stat().st_size
+        for offset in range(0, size, CAT_WINDOW):
+            yield read_range(sftp, remote_file.handle, offset, min(CAT_WINDOW, size - offset), throttle)
+
+
+def head(sftp, remotepath, lines=None, size=None):
+    """The first lines lines (or size bytes) of remotepath, read in blocks until there are enough"""
+    with sftp.open(remotepath, 'rb') as remote_file:
+        end = remote_file.stat().st_size
+        if size is not None:
+            return read_range(sftp, remote_file.handle, 0, min(size, end))
+        data, block = bytearray(), BLOCK_SIZE
+        while data.count(b'\n') < lines and len(data) < end:
+            data += read_range(sftp, remote_file.handle, len(data), min(block, end - len(data)))
+            block = min(block * 2, MAX_BLOCK_SIZE)
+        cut = -1
+        for _ in range(lines):
+            cut = data.find(b'\n', cut + 1)
+            if cut < 0:
+                return bytes(data)
+        return bytes(data[:cut + 1])
+
+
+def tail(sftp, remotepath, lines=None, size=None):
+    """The last lines lines (or size bytes) of remotepath and the file's size
+
+        The file is read backwards from its end in blocks that double in size, until they hold
+        enough lines (a final newline does not start another line), so a long file costs only
+        the blocks at its end.
+    """
+    with sftp.open(remotepath, 'rb') as remote_file:
+        end = remote_file.stat().st_size
+        if size is not None:
+            start = max(end - size, 0)
+            return read_range(sftp, remote_file.handle, start, end - start), end
+        blocks, start, block, newlines = collections.deque(), end, BLOCK_SIZE, 0
+        while start > 0:
+            length = min(block, start)
+            start -= length
+            data = read_range(sftp, remote_file.handle, start, length)
+            blocks.appendleft(data)
+            newlines += data.count(b'\n')
+            if start + length == end and data.endswith(b'\n'):
+                newlines -= 1
+            if newlines >= lines:
+                break
+            block = min(block * 2, MAX_BLOCK_SIZE)
+        data = b''.join(blocks)
+        cut = len(data) - 1 if data.endswith(b'\n') else len(data)
+        for _ in range(lines):
+            cut = data.rfind(b'\n', 0, cut)
+            if cut < 0:
+                return data, end
+        return data[cut + 1:] if lines else b'', end
+
+
+def follow(sftp, remotepath, offset, stop, interval=FOLLOW_INTERVAL):
+    """Yield whatever is appended to remotepath past offset, until stop is set
+
+        The open file's size is checked (FSTAT) every interval seconds and only the bytes added
+        since are read. A file that shrinks has been truncated, and is followed from its start
+        again.
+    """
+    with sftp.open(remotepath, 'rb') as remote_file:
+        while True:
+            size = remote_file.stat().st_size
+            if size < offset:
+                logging.warning(remotepath + ': file truncated')
+                offset = 0
+            while offset < size:
+                length = min(size - offset, CAT_WINDOW)
+                yield read_range(sftp, remote_file.handle, offset, length)
+                offset += length
+            if stop.wait(interval):
+                return
@@ -0,0 +1,149 @@
+import bisect
+import errno
+import logging
+import os
+import threading
+
+
+def create_temp_file(localpath, suffix='.part'):
+    """Create a new hidden file next to localpath: (fd, path)
+
+        Unlike tempfile.mkstemp, which creates files readable by the owner only, the file is
+        created with the mode a regular open() would give it, the umask applied by the kernel
+        (reading the umask means setting it, which other threads could see).
+    """
+    directory = os.path.dirname(os.path.abspath(localpath))
+    prefix = '.' + os.path.basename(localpath) + '.'
+    while True:
+        path = os.path.join(directory, prefix + os.urandom(4).hex() + suffix)
+        try:
+            return os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0), 0o666), path
+        except FileExistsError:
+            continue
+
+
+def preallocate(fd, size):
+    """Reserve size bytes for the file behind fd, so that it is not grown (and fragmented) piecemeal
+
+        Falls back to extending the file with ftruncate() where fallocate is not supported.
+    """
+    if size <= 0:
+        return
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError as e:
+            if e.errno not in (errno.EOPNOTSUPP, errno.ENOSYS, errno.EINVAL):
+                raise
+            logging.debug('fallocate not supported here, extending the file instead')
+    os.ftruncate(fd, size)
+
+
+class PreallocatedSink(object):
+    """Local destination for a download whose blocks may arrive in any order
+
+        The file is written under a temporary name in the destination directory, preallocated to
+        its final size, and filled with positional writes (pwrite), so any number of threads or
+        out-of-order responses can write to it at once. Completed byte ranges are tracked, and
+        commit() atomically renames the file into place only once every byte has been written.
+        Readers of localpath therefore never see a partially written file.
+
+        Used as a context manager, the temporary file is removed unless commit() was called.
+    """
+
+    def __init__(self, localpath, size):
+        self.localpath = localpath
+        self.size = size
+        fd, self.temp_path = create_temp_file(localpath)
+        self._fd = fd
+        self._lock = threading.Lock()
+        # completed ranges as two sorted, parallel lists of non-overlapping [start, end) bounds
+        self._starts = []
+        self._ends = []
+        self.committed = False
+        try:
+            preallocate(fd, size)
+        except OSError:
+            self.abort()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_exc):
+        if not self.committed:
+            self.abort()
+
+    def write(self, offset, data):
+        """Write data at offset (thread-safe) and record the range as complete"""
+        if offset < 0 or offset + len(data) > self.size:
+            raise ValueError('write of ' + str(len(data)) + ' bytes at ' + str(offset) + ' is outside the file')
+        view = memoryview(data)
+        written = 0
+        while written < len(view):
+            written += self._pwrite(view[written:], offset + written)
+        self._mark(offset, offset + written)
+
+    def _pwrite(self, data, offset):
+        if hasattr(os, 'pwrite'):
+            return os.pwrite(self._fd, data, offset)
+        with self._lock:  # no positional writes on this platform; seek and write atomically
+            os.lseek(self._fd, offset, os.SEEK_SET)
+            return os.write(self._fd, data)
+
+    def _mark(self, start, end):
+        if start == end:
+            return
+        with self._lock:
+            # merge with every range that overlaps or touches [start, end)
+            first = bisect.bisect_left(self._ends, start)
+            last = bisect.bisect_right(self._starts, end)
+            if first < last:
+                start = min(start, self._starts[first])
+                end = max(end, self._ends[last - 1])
+            self._starts[first:last] = [start]
+            self._ends[first:last] = [end]
+
+    @property
+    def completed(self):
+        """Number of bytes written so far"""
+        with self._lock:
+            return sum(end - start for start, end in zip(self._starts, self._ends))
+
+    @property
+    def is_complete(self):
+        with self._lock:
+            return self.size == 0 or (self._starts == [0] and self._ends == [self.size])
+
+    def missing_ranges(self):
+        """Return the (offset, length) ranges that have not been written yet"""
+        missing = []
+        position = 0
+        with self._lock:
+            for start, end in zip(self._starts, self._ends):
+                if start > position:
+                    missing.append((position, start - position))
+                position = end
+        if position < self.size:
+            missing.append((position, self.size - position))
+        return missing
+
+    def commit(self, mtime=None):
+        """Close the file and atomically move it to localpath (optionally setting its mtime)"""
+        if not self.is_complete:
+            raise IOError(self.localpath + ': incomplete download, missing ' + str(self.missing_ranges()))
+        os.close(self._fd)
+        self._fd = None
+        if mtime is not None:
+            os.utime(self.temp_path, (mtime, mtime))
+        os.replace(self.temp_path, self.localpath)
+        self.committed = True
+
+    def abort(self):
+        """Discard the partially written file"""
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
@@ -0,0 +1,336 @@
+import collections
+import io
+
+from paramiko.sftp import CMD_DATA, CMD_READ, CMD_STATUS, CMD_WRITE, SFTPError, int64
+
+from SFTPClient.Transfer import Pipeline, flow_controller
+
+# Most bytes requested ahead of the position while a file is read sequentially
+READAHEAD = 1024 * 1024
+# Most bytes written but not yet confirmed by the server before write() waits for replies
+WRITE_BEHIND = 1024 * 1024
+MODE_CHARACTERS = set('rwax+bt')
+
+
+def open(sftp, remotepath, mode='r', readahead=READAHEAD, write_behind=WRITE_BEHIND, throttle=None,
+         encoding=None, errors=None, newline=None):
+    """Open a remote file as a Python file object, like the built-in open()
+
+        'r', 'w', 'a' and 'x' open a file for reading, writing (truncated), appending or exclusive
+        creation, '+' for reading and writing, and 'b' in binary mode (a RemoteFile); otherwise
+        the RemoteFile is wrapped in an io.TextIOWrapper decoding with encoding, errors and newline.
+
+        :param sftp: a paramiko.SFTPClient
+    """
+    if (not mode or mode[0] not in 'rwax' or not set(mode) <= MODE_CHARACTERS or len(set(mode)) != len(mode)
+            or sum(mode.count(character) for character in 'rwax') != 1 or ('b' in mode and 't' in mode)):
+        raise ValueError('invalid mode: ' + repr(mode))
+    binary = RemoteFile(sftp, remotepath, mode.replace('t', '') + ('' if 'b' in mode else 'b'), readahead,
+                        write_behind, throttle)
+    if 'b' in mode:
+        return binary
+    try:
+        return io.TextIOWrapper(binary, encoding or 'utf-8', errors, newline)
+    except Exception:
+        binary.close()
+        raise
+
+
+class RemoteFile(io.BufferedIOBase):
+    """A binary file on the server with buffered, pipelined reads and writes (see open())
+
+        Reads are served from READs sent ahead of the position: the window requested ahead
+        starts at one request and doubles up to readahead bytes while the file is read in order,
+        so a sequential reader never waits a round trip per request, and falls back to one
+        request after a seek elsewhere (the READs no longer wanted are dropped). Writes are
+        gathered into requests of the server's WRITE size and sent without waiting for their
+        replies while less than write_behind bytes are unconfirmed; flush() (and close()) waits
+        for them all and raises the first error. Like a Pipeline, a RemoteFile must not be
+        shared between threads, and it does not survive a reconnect.
+    """
+
+    def __init__(self, sftp, remotepath, mode='rb', readahead=READAHEAD, write_behind=WRITE_BEHIND, throttle=None):
+        super().__init__()
+        self.name = remotepath
+        self.mode = mode
+        self._sftp = sftp
+        self._readahead = readahead
+        self._write_behind = write_behind
+        self._throttle = throttle
+        self._readable = mode[0] == 'r' or '+' in mode
+        self._writable = mode[0] != 'r' or '+' in mode
+        self._pipeline = Pipeline(sftp)
+        self._read_size = flow_controller(sftp, 'read').block_size
+        self._write_size = flow_controller(sftp, 'write').block_size
+        # bytes at buffer_offset, served to read(); chunks received ahead of them, by offset
+        self._buffer = b''
+        self._buffer_offset = 0
+        self._chunks = {}
+        # READs outstanding (request number -> (offset, length)), the end of what they ask for, and the window
+        self._reads = {}
+        self._read_end = 0
+        self._window = self._read_size
+        # written data not yet sent (at pending_offset), and the WRITEs sent (request number, length)
+        self._pending = bytearray()
+        self._pending_offset = 0
+        self._writes = collections.deque()
+        self._unconfirmed = 0
+        try:
+            self._file = sftp.open(remotepath, mode.replace('b', ''))
+            self._size = self._file.stat().st_size
+        except Exception:
+            # nothing is left to flush or close when the object is collected
+            super().close()
+            raise
+        self._position = self._size if mode[0] == 'a' else 0
+
+    def readable(self):
+        return self._readable
+
+    def writable(self):
+        return self._writable
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        self._check_closed()
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        self._check_closed()
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self._position + offset
+        elif whence == io.SEEK_END:
+            position = self._size + offset
+        else:
+            raise ValueError('invalid whence: ' + repr(whence))
+        if position < 0:
+            raise ValueError('negative seek position ' + str(position))
+        self._position = position
+        return position
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            parts = []
+            while True:
+                data = self.read1()
+                if not data:
+                    return b''.join(parts)
+                parts.append(data)
+        parts, wanted = [], size
+        while wanted > 0:
+            data = self.read1(wanted)
+            if not data:
+                break
+            parts.append(data)
+            wanted -= len(data)
+        return b''.join(parts)
+
+    def read1(self, size=-1):
+        """Up to size bytes (all that is buffered if size < 0), waiting for at most one READ"""
+        self._check_readable()
+        if not self._fill():
+            return b''
+        start = self._position - self._buffer_offset
+        end = len(self._buffer) if size is None or size < 0 else min(start + size, len(self._buffer))
+        self._position += end - start
+        return self._buffer[start:end]
+
+    def readline(self, size=-1):
+        self._check_readable()
+        parts, length = [], 0
+        while size is None or size < 0 or length < size:
+            if not self._fill():
+                break
+            start = self._position - self._buffer_offset
+            end = self._buffer.find(b'\n', start) + 1 or len(self._buffer)
+            if size is not None and size >= 0:
+                end = min(end, start + size - length)
+            parts.append(self._buffer[start:end])
+            length += end - start
+            self._position += end - start
+            if parts[-1].endswith(b'\n'):
+                break
+        return b''.join(parts)
+
+    def peek(self, size=0):
+        self._check_readable()
+        if not self._fill():
+            return b''
+        return self._buffer[self._position - self._buffer_offset:]
+
+    def _fill(self):
+        """Make the buffer hold the byte at the position, waiting for its READ; False at the end of the file"""
+        if self._buffer_offset <= self._position < self._buffer_offset + len(self._buffer):
+            return True
+        self._flush_writes()
+        self._buffer = b''
+        if self._position >= self._size:
+            return self._probe()
+        if (self._position != self._read_end and self._find(self._chunks) is None
+                and self._find(self._reads.values()) is None):
+            # a seek away from what was read ahead: drop it and start again with one request
+            self._drop_reads()
+            self._read_end = self._position
+            self._window = self._read_size
+        else:
+            self._window = min(self._window * 2, max(self._readahead, self._read_size))
+        while True:
+            self._request()
+            offset = self._find(self._chunks)
+            if offset is not None:
+                self._buffer_offset, self._buffer = offset, self._chunks.pop(offset)
+                # chunks before the position will not be read again in order
+                for stale in [start for start in self._chunks if start < offset]:
+                    del self._chunks[stale]
+                return True
+            if self._position >= self._size:
+                # the file shrank since it was opened
+                return self._probe()
+            self._receive()
+
+    def _find(self, ranges):
+        """The start of the (offset, length) range or chunk (offset -> data) holding the position, or None"""
+        items = ranges.items() if isinstance(ranges, dict) else ranges
+        for offset, data in items:
+            length = data if isinstance(data, int) else len(data)
+            if offset <= self._position < offset + length:
+                return offset
+        return None
+
+    def _request(self):
+        """Send READs up to the window past the position, as far as the file goes"""
+        end = min(self._position + self._window, self._size)
+        self._read_end = max(self._read_end, self._position)
+        while self._read_end < end:
+            length = min(self._read_size, end - self._read_end)
+            self._send_read(self._read_end, length)
+            self._read_end += length
+
+    def _send_read(self, offset, length):
+        if self._throttle is not None:
+            self._throttle(length)
+        self._reads[self._pipeline.send(CMD_READ, self._file.handle, int64(offset), length)] = (offset, length)
+
+    def _receive(self):
+        """Wait for the next READ reply and keep its data"""
+        num, t, msg = self._pipeline.wait_any(list(self._reads))
+        offset, length = self._reads.pop(num)
+        if t == CMD_STATUS:
+            try:
+                self._sftp._convert_status(msg)
+            except EOFError:
+                self._size = min(self._size, offset)
+                return
+        if t != CMD_DATA:
+            raise SFTPError('Expected data')
+        data = msg.get_string()
+        if not data:
+            self._size = min(self._size, offset)
+            return
+        self._chunks[offset] = data
+        if len(data) < length:
+            # the server returns less than asked for: ask for less, and for the rest again
+            self._read_size = min(self._read_size, len(data))
+            self._send_read(offset + len(data), length - len(data))
+
+    def _probe(self):
+        """Read at the position past the known end of the file, which may have grown"""
+        self._drop_reads()
+        self._read_end = self._position
+        self._send_read(self._position, self._read_size)
+        self._receive()
+        if self._position not in self._chunks:
+            return False
+        self._buffer_offset, self._buffer = self._position, self._chunks.pop(self._position)
+        self._size = max(self._size, self._position + len(self._buffer))
+        self._read_end = self._size
+        return True
+
+    def _drop_reads(self):
+        self._pipeline.discard(list(self._reads))
+        self._reads.clear()
+        self._chunks.clear()
+
+    def write(self, data):
+        self._check_closed()
+        if not self._writable:
+            raise io.UnsupportedOperation('File not open for writing')
+        data = memoryview(data).cast('B')
+        if self._buffer or self._reads or self._chunks:
+            # what was read (ahead) may be about to change
+            self._drop_reads()
+            self._buffer = b''
+        if self._pending and self._pending_offset + len(self._pending) != self._position:
+            self._send_pending()
+        if not self._pending:
+            self._pending_offset = self._position
+        self._pending += data
+        self._position += len(data)
+        self._size = max(self._size, self._position)
+        if len(self._pending) >= self._write_size:
+            self._send_pending(whole=True)
+        return len(data)
+
+    def flush(self):
+        self._check_closed()
+        self._flush_writes()
+
+    def _send_pending(self, whole=False):
+        """Send the written data as WRITEs (with whole, only full-sized ones)"""
+        view = memoryview(self._pending)
+        sent = 0
+        while len(view) - sent >= (self._write_size if whole else 1):
+            with view[sent:sent + self._write_size] as chunk:
+                if self._throttle is not None:
+                    self._throttle(len(chunk))
+                self._writes.append((self._pipeline.send(CMD_WRITE, self._file.handle,
+                                                         int64(self._pending_offset + sent), chunk), len(chunk)))
+                self._unconfirmed += len(chunk)
+                sent += len(chunk)
+            while self._unconfirmed > self._write_behind:
+                self._confirm()
+        view.release()
+        del self._pending[:sent]
+        self._pending_offset += sent
+
+    def _confirm(self):
+        num, length = self._writes.popleft()
+        self._unconfirmed -= length
+        try:
+            self._pipeline.check_status(num)
+        except (IOError, SFTPError):
+            # the file's contents are now unknown: nothing else sent is waited for
+            self._pipeline.discard([write for write, _length in self._writes])
+            self._writes.clear()
+            self._unconfirmed = 0
+            self._pending.clear()
+            raise
+
+    def _flush_writes(self):
+        if self._pending:
+            self._send_pending()
+        while self._writes:
+            self._confirm()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._flush_writes()
+        finally:
+            self._drop_reads()
+            self._file.close()
+            super().close()
+
+    def _check_closed(self):
+        if self.closed:
+            raise ValueError('I/O operation on closed file.')
+
+    def _check_readable(self):
+        self._check_closed()
+        if not self._readable:
+            raise io.UnsupportedOperation('File not open for reading')
@@ -0,0 +1,86 @@
+import re
+import threading
+import time
+
+from SFTPClient.Transfer import MAX_REQUEST_SIZE
+
+RATE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+RATE = re.compile(r'(\d+(?:\.\d*)?)\s*([KMG]?)(?:I?B)?(?:/S)?', re.IGNORECASE)
+# Tokens a bucket saves up while idle, in seconds at its rate (but always room for one request)
+BURST_SECONDS = 0.25
+
+
+def parse_rate(text):
+    """Parse a rate such as 500K, 20M or 1.5MB/s into bytes/second (units are binary, as in sizes)"""
+    match = RATE.fullmatch(str(text).strip())
+    if match is None or float(match.group(1)) <= 0:
+        raise ValueError('Invalid rate: ' + repr(text) + ' (e.g. 500K, 20M)')
+    return int(float(match.group(1)) * RATE_UNITS[match.group(2).upper()])
+
+
+def format_rate(rate):
+    for unit in ('G', 'M', 'K'):
+        if rate >= RATE_UNITS[unit]:
+            return ('%.1f' % (rate / float(RATE_UNITS[unit]))).rstrip('0').rstrip('.') + unit + '/s'
+    return str(int(rate)) + '/s'
+
+
+class TokenBucket(object):
+    """Limits a flow of bytes to rate bytes/second, allowing bursts of burst bytes
+
+        consume() may run the bucket into debt (a request larger than what is saved up is not
+        split), and the caller then sleeps until the debt is repaid. Thread-safe.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst if burst is not None else max(int(rate * BURST_SECONDS), MAX_REQUEST_SIZE)
+        self.tokens = float(self.burst)
+        self._stamp = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, length):
+        """Take length tokens, sleeping as long as the bucket is in debt"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self._stamp) * self.rate)
+            self._stamp = now
+            self.tokens -= length
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Scheduler(object):
+    """Paces the bulk data of transfers over one connection
+
+        Bulk data (READ/WRITE requests of get, put, ...) takes tokens from the session-wide bucket
+        (rate bytes/second, None for no limit) and from its transfer's own bucket, see throttle().
+        Metadata requests are never limited.
+    """
+
+    def __init__(self, rate=None):
+        self.bucket = None
+        self.set_rate(rate)
+
+    @property
+    def rate(self):
+        return None if self.bucket is None else self.bucket.rate
+
+    def set_rate(self, rate):
+        """Change the session-wide limit (None removes it); transfers already running follow it"""
+        self.bucket = TokenBucket(rate) if rate else None
+
+    def throttle(self, rate=None):
+        """Return the admit(length) function a transfer calls before sending each data request
+
+            rate limits this transfer on its own (bytes/second, shared by all the files it sends),
+            on top of the session-wide limit.
+        """
+        bucket = TokenBucket(rate) if rate else None
+
+        def admit(length):
+            for limit in (bucket, self.bucket):
+                if limit is not None:
+                    limit.consume(length)
+        return admit
@@ -0,0 +1,702 @@
+import collections
+import concurrent.futures
+import contextlib
+import itertools
+import logging
+import mmap
+import os
+import weakref
+
+import paramiko
+from paramiko.sftp import (CMD_ATTRS, CMD_CLOSE, CMD_DATA, CMD_EXTENDED, CMD_EXTENDED_REPLY, CMD_FSETSTAT, CMD_FSTAT,
+                          CMD_HANDLE, CMD_OPEN, CMD_READ, CMD_STATUS, CMD_WRITE, SFTP_FLAG_CREATE, SFTP_FLAG_READ,
+                          SFTP_FLAG_TRUNC, SFTP_FLAG_WRITE, SFTPError, int64)
+from paramiko.sftp_attr import SFTPAttributes
+
+from SFTPClient.Flow import FlowController
+from SFTPClient.Sink import PreallocatedSink
+
+# Largest WRITE payload every server accepts (larger ones only if "limits@openssh.com" allows them)
+REQUEST_SIZE = 32768
+# Upper bound on READ/WRITE request sizes; servers return less data than a READ asks for if they must
+MAX_REQUEST_SIZE = 256 * 1024
+# Number of requests kept outstanding on the channel before waiting for a reply (metadata requests,
+# and transfers given a fixed in_flight; transfers are otherwise sized by a Flow.FlowController)
+MAX_IN_FLIGHT = 64
+# Already-sent pages of a mapped file are dropped after this many bytes, to keep RSS flat
+MMAP_RELEASE_INTERVAL = 8 * 1024 * 1024
+# Times a transfer is resumed after the connection drops before giving up
+RESUME_ATTEMPTS = 10
+# Smallest byte range worth its own channel in a segmented upload
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+# Files of a batch (download_many, put_many) opened ahead of the one whose data is being requested
+PREFETCH_FILES = 4
+
+# transport -> (max READ length, max WRITE length)
+_limits = weakref.WeakKeyDictionary()
+# SFTP client -> {'read': FlowController, 'write': FlowController}
+_flow_controllers = weakref.WeakKeyDictionary()
+
+
+def connection_alive(sftp):
+    """Whether the SSH transport under an SFTP client is still up (checked without a round trip)"""
+    channel = sftp.get_channel()
+    transport = channel.get_transport() if channel is not None else None
+    return transport is not None and transport.is_active()
+
+
+def _resumable(sftp, reconnect, attempt, error):
+    """Decide whether a transfer that failed with error can be resumed on a new connection"""
+    if reconnect is None or attempt >= RESUME_ATTEMPTS:
+        return False
+    try:
+        return not connection_alive(sftp)
+    except Exception:
+        return True
+
+
+def server_limits(sftp):
+    """Return (max READ length, max WRITE length) for requests to the server, asked once per connection
+
+        Servers supporting the "limits@openssh.com" extension report them; otherwise writes stay at
+        REQUEST_SIZE, and reads may ask for MAX_REQUEST_SIZE since a server caps them by replying
+        with less data (see read_pipelined).
+    """
+    transport = sftp.get_channel().get_transport()
+    if transport not in _limits:
+        limits = (MAX_REQUEST_SIZE, REQUEST_SIZE)
+        pipeline = Pipeline(sftp)
+        t, msg = pipeline.wait(pipeline.send(CMD_EXTENDED, 'limits@openssh.com'))
+        if t == CMD_EXTENDED_REPLY:
+            _max_packet, max_read, max_write, _max_handles = (msg.get_int64() for _ in range(4))
+            # 0 means the server does not know or does not enforce the limit
+            limits = (min(max_read or MAX_REQUEST_SIZE, MAX_REQUEST_SIZE),
+                      min(max_write or REQUEST_SIZE, MAX_REQUEST_SIZE))
+        logging.debug('Server request size limits: read ' + str(limits[0]) + ', write ' + str(limits[1]))
+        _limits[transport] = limits
+    return _limits[transport]
+
+
+def flow_controller(sftp, direction, in_flight=None):
+    """The FlowController for 'read' or 'write' transfers over sftp
+
+        The controllers are kept for the lifetime of the SFTP client, so every file transferred
+        starts from what was learnt about the link. With in_flight given, a fixed controller of
+        in_flight requests of REQUEST_SIZE is returned instead.
+    """
+    if in_flight is not None:
+        return FlowController(REQUEST_SIZE, in_flight)
+    controllers = _flow_controllers.setdefault(sftp, {})
+    if direction not in controllers:
+        max_read, max_write = server_limits(sftp)
+        controllers[direction] = FlowController(max_read if direction == 'read' else max_write)
+    return controllers[direction]
+
+
+class Pipeline(object):
+    """Sends SFTP requests without waiting for each reply, and collects the replies by request number
+
+        paramiko's SFTPClient dispatches every response to the object registered with the request,
+        so responses to our requests are never lost even if they arrive interleaved with replies
+        to other files (e.g. paramiko's own prefetch). Only one thread may read from a channel at
+        a time, so a Pipeline must not be shared between threads.
+    """
+
+    def __init__(self, sftp):
+        self.sftp = sftp
+        self._responses = {}
+        # requests whose responses are dropped when they arrive
+        self._discarded = set()
+
+    def _async_response(self, t, msg, num):
+        # called by paramiko.SFTPClient._read_response() for requests sent through this pipeline
+        if num in self._discarded:
+            self._discarded.remove(num)
+            return
+        self._responses[num] = (t, msg)
+
+    def discard(self, nums):
+        """Drop the responses to requests no longer wanted, whether they have arrived or not"""
+        for num in nums:
+            if self._responses.pop(num, None) is None:
+                self._discarded.add(num)
+
+    def send(self, t, *args):
+        """Send a request and return its request number"""
+        return self.sftp._async_request(self, t, *args)
+
+    def wait(self, num):
+        """Block until the response to request num has arrived and return (type, message)"""
+        while num not in self._responses:
+            self.sftp._read_response()
+        return self._responses.pop(num)
+
+    def wait_any(self, nums):
+        """Block until a response to any of the request numbers in nums has arrived
+
+            Returns (num, type, message); responses are returned in arrival order.
+        """
+        while True:
+            for num in nums:
+                if num in self._responses:
+                    t, msg = self._responses.pop(num)
+                    return num, t, msg
+            self.sftp._read_response()
+
+    def check_status(self, num):
+        """Wait for a request answered with a STATUS reply, raising IOError on failure"""
+        t, msg = self.wait(num)
+        if t != CMD_STATUS:
+            raise SFTPError('Expected status')
+        self.sftp._convert_status(msg)
+
+
+def write_pipelined(sftp, handle, data, offset=0, in_flight=None, on_chunk=None, on_ack=None, throttle=None):
+    """Write a bytes-like object to an open remote handle with pipelined WRITEs
+
+        The request size and the number of requests outstanding are chosen by the connection's
+        write FlowController, or fixed at in_flight requests of REQUEST_SIZE. Each request payload
+        is a memoryview slice of data, so nothing is copied before paramiko packs the request.
+        on_chunk(position, chunk) is called with each slice once it is sent, and on_ack(position)
+        once the server has confirmed everything before position. throttle(length) (see
+        Throttle.Scheduler.throttle) is called before each request is sent, and may block.
+    """
+    flow = flow_controller(sftp, 'write', in_flight)
+    pipeline = Pipeline(sftp)
+    pending = collections.deque()
+    view = memoryview(data)
+    position = 0
+    try:
+        while position < len(view) or pending:
+            while position < len(view) and len(pending) < flow.in_flight:
+                length = min(flow.block_size, len(view) - position)
+                if throttle is not None:
+                    throttle(length)
+                with view[position:position + length] as chunk:
+                    token = flow.sent(length)
+                    pending.append((pipeline.send(CMD_WRITE, handle, int64(offset + position), chunk),
+                                    position + length, token, length))
+                    if on_chunk is not None:
+                        on_chunk(position, chunk)
+                position += length
+            num, end, token, length = pending.popleft()
+            pipeline.check_status(num)
+            flow.received(token, length)
+            if on_ack is not None:
+                on_ack(end)
+    finally:
+        view.release()
+
+
+def mmap_put(sftp, localpath, remotepath, preserve_mtime=False, in_flight=None, hasher=None,
+             reconnect=None, throttle=None):
+    """Upload localpath by memory-mapping it and sending slices of the mapping directly
+
+        This avoids the read() into a new bytes object per chunk (and paramiko's write buffer)
+        that SFTPClient.put performs, and releases pages once they are sent so that the resident
+        set stays flat for multi-GB files. The remote size is checked once the upload completes.
+        If given, hasher (an Integrity.StreamHasher) is fed the data as it is sent, and throttle
+        paces the requests (see write_pipelined).
+
+        If the connection drops and reconnect (a callable returning a new paramiko.SFTPClient) is
+        given, the upload continues on the new connection from the last offset the server confirmed.
+
+        :param sftp: a paramiko.SFTPClient (pysftp.Connection.sftp_client)
+    """
+    local_stat = os.stat(localpath)
+    logging.debug('mmap upload of ' + localpath + ' (' + str(local_stat.st_size) + ' bytes) to ' + remotepath)
+    with open(localpath, 'rb') as local_file, \
+            contextlib.ExitStack() as stack:
+        mapped = None
+        if local_stat.st_size > 0:
+            mapped = stack.enter_context(mmap.mmap(local_file.fileno(), 0, access=mmap.ACCESS_READ))
+            if hasattr(mapped, 'madvise'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+        released = [0]
+        confirmed = [0]
+
+        def sent(position, chunk):
+            if hasher is not None:
+                hasher.update(confirmed_from + position, chunk)
+            # the request payload has been copied into the outgoing packet, so the pages
+            # behind it will not be touched again
+            end = confirmed_from + position + len(chunk)
+            end -= end % mmap.PAGESIZE
+            if end - released[0] >= MMAP_RELEASE_INTERVAL and hasattr(mapped, 'madvise'):
+                mapped.madvise(mmap.MADV_DONTNEED, released[0], end - released[0])
+                released[0] = end
+
+        def acked(position):
+            confirmed[0] = confirmed_from + position
+
+        for attempt in itertools.count():
+            confirmed_from = confirmed[0]
+            try:
+                # a resumed upload must not truncate what the server already confirmed
+                with sftp.open(remotepath, 'r+b' if confirmed_from else 'wb') as remote_file:
+                    if mapped is not None and confirmed_from < len(mapped):
+                        with memoryview(mapped)[confirmed_from:] as remaining:
+                            write_pipelined(sftp, remote_file.handle, remaining, offset=confirmed_from,
+                                            in_flight=in_flight, on_chunk=sent, on_ack=acked, throttle=throttle)
+                break
+            except Exception as e:
+                if not _resumable(sftp, reconnect, attempt, e):
+                    raise
+                logging.warning('Connection lost during upload of ' + localpath + ' (' + str(e)
+                                + '), resuming at byte ' + str(confirmed[0]))
+                sftp = reconnect()
+
+    remote_size = sftp.stat(remotepath).st_size
+    if remote_size != local_stat.st_size:
+        raise IOError('put: size mismatch for ' + remotepath + ' (' + str(remote_size) + ' of '
+                      + str(local_stat.st_size) + ' bytes written)')
+    if preserve_mtime:
+        sftp.utime(remotepath, (local_stat.st_atime, local_stat.st_mtime))
+
+
+def _put_segment(transport, remotepath, mapped, segment, in_flight, throttle=None):
+    """Write mapped[segment[0]:segment[1]] at the same offsets over a new SFTP channel
+
+        segment[0] is advanced as the server confirms the writes, so an interrupted segment can
+        be resumed from it.
+    """
+    start = segment[0]
+    channel = paramiko.SFTPClient.from_transport(transport)
+    try:
+        with channel.open(remotepath, 'r+b') as remote_file, memoryview(mapped)[start:segment[1]] as view:
+            write_pipelined(channel, remote_file.handle, view, offset=start, in_flight=in_flight,
+                            on_ack=lambda position: segment.__setitem__(0, start + position), throttle=throttle)
+    finally:
+        channel.close()
+
+
+def segmented_put(sftp, localpath, remotepath, segments, preserve_mtime=False, in_flight=None,
+                  reconnect=None, throttle=None):
+    """Upload localpath as disjoint byte ranges written concurrently over separate SFTP channels
+
+        Every channel keeps WRITEs outstanding at its own offsets (sized by its own FlowController),
+        so the data in flight (and the SSH flow-control windows) grow with the number of segments,
+        which lets a single large file fill a long fat pipe. Segments are at least MIN_SEGMENT_SIZE; a file too small
+        for two is sent with mmap_put. The remote size is checked once every segment has finished.
+
+        If the connection drops and reconnect (a callable returning a new paramiko.SFTPClient) is
+        given, each segment continues on the new connection from its last confirmed offset.
+
+        :param sftp: a paramiko.SFTPClient (pysftp.Connection.sftp_client)
+    """
+    local_stat = os.stat(localpath)
+    size = local_stat.st_size
+    segments = max(1, min(segments, size // MIN_SEGMENT_SIZE))
+    if segments == 1:
+        return mmap_put(sftp, localpath, remotepath, preserve_mtime, in_flight, reconnect=reconnect,
+                        throttle=throttle)
+    # segment boundaries fall on request boundaries; each segment is [next unconfirmed offset, end]
+    step = -(-size // segments)
+    step = -(-step // REQUEST_SIZE) * REQUEST_SIZE
+    ranges = [[start, min(start + step, size)] for start in range(0, size, step)]
+    logging.debug('Segmented upload of ' + localpath + ' (' + str(size) + ' bytes) to ' + remotepath
+                  + ' over ' + str(len(ranges)) + ' channels')
+    # the other channels do not share this client's working directory
+    path = sftp._adjust_cwd(remotepath)
+    with open(localpath, 'rb') as local_file, \
+            mmap.mmap(local_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        with sftp.open(remotepath, 'wb'):
+            pass
+        for attempt in itertools.count():
+            transport = sftp.get_channel().get_transport()
+            try:
+                with concurrent.futures.ThreadPoolExecutor(len(ranges)) as executor:
+                    futures = [executor.submit(_put_segment, transport, path, mapped, segment, in_flight, throttle)
+                               for segment in ranges if segment[0] < segment[1]]
+                    for future in futures:
+                        future.result()
+                break
+            except Exception as e:
+                if not _resumable(sftp, reconnect, attempt, e):
+                    raise
+                logging.warning('Connection lost during upload of ' + localpath + ' (' + str(e) + '), resuming '
+                                + str(sum(end - start for start, end in ranges)) + ' unconfirmed bytes')
+                sftp = reconnect()
+
+    remote_size = sftp.stat(remotepath).st_size
+    if remote_size != size:
+        raise IOError('put: size mismatch for ' + remotepath + ' (' + str(remote_size) + ' of '
+                      + str(size) + ' bytes written)')
+    if preserve_mtime:
+        sftp.utime(remotepath, (local_stat.st_atime, local_stat.st_mtime))
+
+
+def read_pipelined(sftp, handle, size, write, in_flight=None, ranges=None, throttle=None):
+    """Read size bytes from an open remote handle with pipelined READs
+
+        The request size and the number of requests outstanding are chosen by the connection's
+        read FlowController, or fixed at in_flight requests of REQUEST_SIZE. write(offset, data) is
+        called for every block as its reply arrives, which need not be in offset order. A short
+        read caps the request size at what the server returned, and the remainder of the block is
+        requested again. If ranges (a list of (offset, length)) is given, only those parts of the
+        file are read. throttle(length) is called before each request is sent, as in write_pipelined.
+    """
+    flow = flow_controller(sftp, 'read', in_flight)
+    pipeline = Pipeline(sftp)
+    pending = {}
+    remaining = collections.deque((start, length) for start, length in ([(0, size)] if ranges is None else ranges)
+                                  if length > 0)
+    while remaining or pending:
+        while remaining and len(pending) < flow.in_flight:
+            offset, length = remaining.popleft()
+            if length > flow.block_size:
+                remaining.appendleft((offset + flow.block_size, length - flow.block_size))
+                length = flow.block_size
+            if throttle is not None:
+                throttle(length)
+            pending[pipeline.send(CMD_READ, handle, int64(offset), length)] = (offset, length, flow.sent(length))
+        num, t, msg = pipeline.wait_any(pending)
+        offset, length, token = pending.pop(num)
+        if t == CMD_DATA:
+            data = msg.get_string()
+            write(offset, data)
+            flow.received(token, length)
+            if 0 < len(data) < length:
+                flow.limit_block_size(len(data))
+                remaining.appendleft((offset + len(data), length - len(data)))
+        elif t == CMD_STATUS:
+            try:
+                sftp._convert_status(msg)
+            except EOFError:
+                raise IOError('remote file shrank during download (EOF at ' + str(offset) + ' of '
+                              + str(size) + ' bytes)')
+            raise SFTPError('Expected data')
+        else:
+            raise SFTPError('Expected data')
+
+
+def download(sftp, remotepath, localpath, preserve_mtime=False, in_flight=None, hasher=None,
+             reconnect=None, throttle=None):
+    """Download remotepath with pipelined READs into a PreallocatedSink at localpath
+
+        Blocks are written at their offsets as they arrive, and localpath only appears (atomically)
+        once the whole file has been received. If given, hasher (an Integrity.StreamHasher) is fed
+        every block as it arrives, and throttle paces the requests (see read_pipelined).
+
+        If the connection drops and reconnect (a callable returning a new paramiko.SFTPClient) is
+        given, only the ranges the sink is still missing are fetched over the new connection,
+        provided the remote file has not changed in the meantime.
+
+        :param sftp: a paramiko.SFTPClient (pysftp.Connection.sftp_client)
+    """
+    attr = sftp.stat(remotepath)
+    logging.debug('Downloading ' + remotepath + ' (' + str(attr.st_size) + ' bytes) to ' + localpath)
+    with PreallocatedSink(localpath, attr.st_size) as sink:
+        def write(offset, data):
+            sink.write(offset, data)
+            if hasher is not None:
+                hasher.update(offset, data)
+
+        for attempt in itertools.count():
+            try:
+                with sftp.open(remotepath, 'rb') as remote_file:
+                    read_pipelined(sftp, remote_file.handle, attr.st_size, write, in_flight=in_flight,
+                                   ranges=sink.missing_ranges(), throttle=throttle)
+                break
+            except Exception as e:
+                if not _resumable(sftp, reconnect, attempt, e):
+                    raise
+                logging.warning('Connection lost during download of ' + remotepath + ' (' + str(e)
+                                + '), resuming with ' + str(sink.completed) + ' of ' + str(attr.st_size)
+                                + ' bytes received')
+                sftp = reconnect()
+                current = sftp.stat(remotepath)
+                if (current.st_size, current.st_mtime) != (attr.st_size, attr.st_mtime):
+                    raise IOError(remotepath + ' changed on the server while reconnecting; download abandoned')
+        sink.commit(mtime=attr.st_mtime if preserve_mtime else None)
+
+
+class _BatchFile(object):
+    """A file of download_many or put_many, with the state of its requests on the current connection"""
+
+    def __init__(self, index, remotepath, localpath, hasher):
+        self.index = index
+        self.remotepath = remotepath
+        self.localpath = localpath
+        self.hasher = hasher
+        self.handle = None
+        self.opening = False
+        # download: (offset, length) ranges still to request; put: the next offset to send
+        self.remaining = collections.deque()
+        self.position = 0
+        # data requests awaiting a reply, and (put) the FSTAT/FSETSTAT/CLOSE that finish the file
+        self.outstanding = 0
+        self.finishing = 0
+
+
+def _open_request(pipeline, job, flags):
+    job.opening = True
+    return pipeline.send(CMD_OPEN, pipeline.sftp._adjust_cwd(job.remotepath), flags, SFTPAttributes())
+
+
+def _opened(sftp, job, t, msg):
+    job.opening = False
+    if t == CMD_STATUS:
+        sftp._convert_status(msg)
+    if t != CMD_HANDLE:
+        raise SFTPError('Expected handle')
+    job.handle = msg.get_binary()
+
+
+def download_many(sftp, files, preserve_mtime=False, reconnect=None, throttle=None, on_done=None,
+                  prefetch=PREFETCH_FILES):
+    """Download many files over one pipeline, so the link does not go idle between them
+
+        files is a list of (remotepath, localpath, attr, hasher): attr is the file's SFTPAttributes
+        (callers STAT the whole batch at once, see Batch.stat_many) and hasher an Integrity.StreamHasher
+        or None. While the current file's READs are outstanding, the OPENs of the next prefetch
+        files are already on the wire, and the next file's READs follow the current file's last
+        READ straight away, so the flow window stays full across file boundaries. Each file is
+        received into a PreallocatedSink as in download(), and on_done(index) is called with its
+        index in files once it has been committed; files complete roughly in order.
+
+        If the connection drops and reconnect is given, the files not yet committed are resumed
+        on the new connection from what their sinks are missing, as in download().
+    """
+    jobs = []
+    for index, (remotepath, localpath, attr, hasher) in enumerate(files):
+        job = _BatchFile(index, remotepath, localpath, hasher)
+        job.attr = attr
+        job.sink = None
+        jobs.append(job)
+    logging.debug('Downloading ' + str(len(jobs)) + ' files over one pipeline')
+    try:
+        for attempt in itertools.count():
+            try:
+                _download_batch(sftp, jobs, preserve_mtime, throttle, on_done, prefetch)
+                break
+            except Exception as e:
+                if not _resumable(sftp, reconnect, attempt, e):
+                    raise
+                logging.warning('Connection lost while downloading ' + str(len(jobs)) + ' remaining files ('
+                                + str(e) + '), resuming')
+                sftp = reconnect()
+                for job in jobs:
+                    if job.sink is not None:
+                        current = sftp.stat(job.remotepath)
+                        if (current.st_size, current.st_mtime) != (job.attr.st_size, job.attr.st_mtime):
+                            raise IOError(job.remotepath + ' changed on the server while reconnecting; '
+                                          'download abandoned')
+    finally:
+        for job in jobs:
+            if job.sink is not None:
+                job.sink.abort()
+
+
+def _download_batch(sftp, jobs, preserve_mtime, throttle, on_done, prefetch):
+    """Run download_many over one connection; committed files are removed from jobs"""
+    flow = flow_controller(sftp, 'read')
+    pipeline = Pipeline(sftp)
+    # request number -> (job, offset, length, flow token); offset is None for an OPEN, job None for a CLOSE
+    pending = {}
+    reads = 0
+    for job in jobs:
+        job.handle, job.opening, job.outstanding = None, False, 0
+    try:
+        while jobs or pending:
+            # keep OPENs going for the files after the one being requested
+            ahead = 0
+            for job in jobs:
+                if ahead > prefetch:
+                    break
+                if job.handle is None and not job.opening:
+                    pending[_open_request(pipeline, job, SFTP_FLAG_READ)] = (job, None, 0, None)
+                if job.handle is None or job.remaining:
+                    ahead += 1
+            for job in jobs:
+                if job.handle is None or reads >= flow.in_flight:
+                    break
+                while job.remaining and reads < flow.in_flight:
+                    offset, length = job.remaining.popleft()
+                    if length > flow.block_size:
+                        job.remaining.appendleft((offset + flow.block_size, length - flow.block_size))
+                        length = flow.block_size
+                    if throttle is not None:
+                        throttle(length)
+                    num = pipeline.send(CMD_READ, job.handle, int64(offset), length)
+                    pending[num] = (job, offset, length, flow.sent(length))
+                    reads += 1
+                    job.outstanding += 1
+            num, t, msg = pipeline.wait_any(pending)
+            job, offset, length, token = pending.pop(num)
+            if job is None:
+                # a file read to the end cannot lose anything if closing it fails
+                continue
+            if offset is None:
+                _opened(sftp, job, t, msg)
+                if job.sink is None:
+                    job.sink = PreallocatedSink(job.localpath, job.attr.st_size)
+                job.remaining = collections.deque(job.sink.missing_ranges())
+            else:
+                reads -= 1
+                job.outstanding -= 1
+                if t == CMD_DATA:
+                    data = msg.get_string()
+                    job.sink.write(offset, data)
+                    if job.hasher is not None:
+                        job.hasher.update(offset, data)
+                    flow.received(token, length)
+                    if 0 < len(data) < length:
+                        flow.limit_block_size(len(data))
+                        job.remaining.appendleft((offset + len(data), length - len(data)))
+                elif t == CMD_STATUS:
+                    try:
+                        sftp._convert_status(msg)
+                    except EOFError:
+                        raise IOError(job.remotepath + ' shrank during download (EOF at ' + str(offset) + ' of '
+                                      + str(job.attr.st_size) + ' bytes)')
+                    raise SFTPError('Expected data')
+                else:
+                    raise SFTPError('Expected data')
+            if not job.remaining and not job.outstanding:
+                pending[pipeline.send(CMD_CLOSE, job.handle)] = (None, None, 0, None)
+                job.handle = None
+                job.sink.commit(mtime=job.attr.st_mtime if preserve_mtime else None)
+                jobs.remove(job)
+                if on_done is not None:
+                    on_done(job.index)
+    finally:
+        for job in jobs:
+            if job.handle is not None:
+                with contextlib.suppress(Exception):
+                    pipeline.send(CMD_CLOSE, job.handle)
+
+
+def put_many(sftp, files, preserve_mtime=False, reconnect=None, throttle=None, on_done=None, prefetch=PREFETCH_FILES):
+    """Upload many files over one pipeline, so the link does not go idle between them
+
+        files is a list of (localpath, remotepath, hasher), hasher being an Integrity.StreamHasher
+        or None. As in download_many, the OPENs of the next prefetch files are sent ahead and the
+        next file's WRITEs follow the current file's last WRITE straight away. Once every WRITE of
+        a file is confirmed, its size is checked with an FSTAT, its mtime set with an FSETSTAT
+        (with preserve_mtime) and it is closed, without waiting: those replies arrive while the
+        next file is being written. Files are sent from memory mappings as in mmap_put, and
+        on_done(index) is called with a file's index in files once it has been closed.
+
+        If the connection drops and reconnect is given, the files not yet closed continue on the
+        new connection from the last offset the server confirmed, as in mmap_put.
+    """
+    jobs = []
+    with contextlib.ExitStack() as stack:
+        for index, (localpath, remotepath, hasher) in enumerate(files):
+            job = _BatchFile(index, remotepath, localpath, hasher)
+            job.local_stat = os.stat(localpath)
+            job.mapped = None
+            job.confirmed = 0
+            jobs.append(job)
+        logging.debug('Uploading ' + str(len(jobs)) + ' files over one pipeline')
+        for attempt in itertools.count():
+            try:
+                _put_batch(sftp, jobs, stack, preserve_mtime, throttle, on_done, prefetch)
+                break
+            except Exception as e:
+                if not _resumable(sftp, reconnect, attempt, e):
+                    raise
+                logging.warning('Connection lost while uploading ' + str(len(jobs)) + ' remaining files ('
+                                + str(e) + '), resuming')
+                sftp = reconnect()
+
+
+def _put_batch(sftp, jobs, stack, preserve_mtime, throttle, on_done, prefetch):
+    """Run put_many over one connection; closed files are removed from jobs (mappings are entered on stack)"""
+    flow = flow_controller(sftp, 'write')
+    pipeline = Pipeline(sftp)
+    # request number -> (job, request type, end of the data written, flow token, length)
+    pending = {}
+    writes = 0
+    for job in jobs:
+        job.handle, job.opening, job.outstanding, job.finishing = None, False, 0, 0
+        job.position = job.confirmed
+        # ends of the WRITEs sent, in order, and those confirmed out of order
+        job.sent, job.acked = collections.deque(), set()
+    try:
+        while jobs or pending:
+            ahead = 0
+            for job in jobs:
+                if ahead > prefetch:
+                    break
+                if job.handle is None and not job.opening and not job.finishing:
+                    if job.mapped is None and job.local_stat.st_size > 0:
+                        # the mapping keeps its own descriptor, so only files in progress hold one
+                        with open(job.localpath, 'rb') as local_file:
+                            job.mapped = stack.enter_context(mmap.mmap(local_file.fileno(), 0,
+                                                                       access=mmap.ACCESS_READ))
+                        if hasattr(job.mapped, 'madvise'):
+                            job.mapped.madvise(mmap.MADV_SEQUENTIAL)
+                    # a resumed upload must not truncate what the server already confirmed
+                    flags = (SFTP_FLAG_READ | SFTP_FLAG_WRITE if job.confirmed
+                             else SFTP_FLAG_WRITE | SFTP_FLAG_CREATE | SFTP_FLAG_TRUNC)
+                    pending[_open_request(pipeline, job, flags)] = (job, CMD_OPEN, 0, None, 0)
+                if (job.handle is None and not job.finishing) or job.position < job.local_stat.st_size:
+                    ahead += 1
+            for job in jobs:
+                if (job.handle is None and not job.finishing) or writes >= flow.in_flight:
+                    break
+                while job.position < job.local_stat.st_size and writes < flow.in_flight:
+                    length = min(flow.block_size, job.local_stat.st_size - job.position)
+                    if throttle is not None:
+                        throttle(length)
+                    with memoryview(job.mapped)[job.position:job.position + length] as chunk:
+                        token = flow.sent(length)
+                        num = pipeline.send(CMD_WRITE, job.handle, int64(job.position), chunk)
+                        if job.hasher is not None:
+                            job.hasher.update(job.position, chunk)
+                    job.position += length
+                    job.sent.append(job.position)
+                    pending[num] = (job, CMD_WRITE, job.position, token, length)
+                    writes += 1
+                    job.outstanding += 1
+            num, t, msg = pipeline.wait_any(pending)
+            job, request, end, token, length = pending.pop(num)
+            if request == CMD_OPEN:
+                _opened(sftp, job, t, msg)
+            elif request == CMD_FSTAT:
+                if t == CMD_STATUS:
+                    sftp._convert_status(msg)
+                if t != CMD_ATTRS:
+                    raise SFTPError('Expected attributes')
+                remote_size = SFTPAttributes._from_msg(msg).st_size
+                if remote_size != job.local_stat.st_size:
+                    raise IOError('put: size mismatch for ' + job.remotepath + ' (' + str(remote_size) + ' of '
+                                  + str(job.local_stat.st_size) + ' bytes written)')
+            else:
+                if t != CMD_STATUS:
+                    raise SFTPError('Expected status')
+                sftp._convert_status(msg)
+            if request == CMD_WRITE:
+                writes -= 1
+                job.outstanding -= 1
+                flow.received(token, length)
+                job.acked.add(end)
+                while job.sent and job.sent[0] in job.acked:
+                    job.confirmed = job.sent.popleft()
+                    job.acked.discard(job.confirmed)
+            elif request != CMD_OPEN:
+                job.finishing -= 1
+                if not job.finishing:
+                    jobs.remove(job)
+                    if job.mapped is not None:
+                        job.mapped.close()
+                    if on_done is not None:
+                        on_done(job.index)
+                continue
+            if job.handle is not None and job.confirmed == job.local_stat.st_size and not job.outstanding:
+                # every WRITE is confirmed: check the size, set the mtime and close, all at once
+                pending[pipeline.send(CMD_FSTAT, job.handle)] = (job, CMD_FSTAT, 0, None, 0)
+                if preserve_mtime:
+                    attr = SFTPAttributes()
+                    attr.st_atime, attr.st_mtime = job.local_stat.st_atime, job.local_stat.st_mtime
+                    pending[pipeline.send(CMD_FSETSTAT, job.handle, attr)] = (job, CMD_FSETSTAT, 0, None, 0)
+                pending[pipeline.send(CMD_CLOSE, job.handle)] = (job, CMD_CLOSE, 0, None, 0)
+                job.finishing = 3 if preserve_mtime else 2
+                job.handle = None
+    finally:
+        for job in jobs:
+            if job.handle is not None:
+                with contextlib.suppress(Exception):
+                    pipeline.send(CMD_CLOSE, job.handle)
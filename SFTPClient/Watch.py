@@ -0,0 +1,227 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import stat
+import struct
+import time
+
+from SFTPClient import Diff
+from SFTPClient import Mirror
+
+# Seconds without a new change before a batch is pushed, and the longest a change waits while changes keep coming
+DEBOUNCE = 0.5
+MAX_DELAY = 5.0
+# Seconds between scans of the polling fallback
+POLL_INTERVAL = 2.0
+# Longest a watcher blocks before the stop event is checked again
+TICK = 0.25
+
+# inotify(7) event bits
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+WATCH_EVENTS = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT_HEADER = struct.Struct('iIII')
+
+
+def _join(directory, name):
+    return directory + '/' + name if directory else name
+
+
+class Inotify(object):
+    """Reports the paths changed below a local directory, from Linux inotify (through ctypes)
+
+        Every directory of the tree is watched, and directories created or moved into it are
+        watched as they appear. If the kernel's event queue overflows, overflowed is set: the
+        events lost can only be recovered by rescanning the tree. Raises OSError where inotify
+        is not available.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.overflowed = False
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self._libc.inotify_init1
+        except (OSError, AttributeError, TypeError) as e:
+            raise OSError('inotify is not available: ' + str(e))
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1: ' + os.strerror(ctypes.get_errno()))
+        # watch descriptor -> directory, relative to root
+        self.watches = {}
+        try:
+            self._watch_tree('')
+        except OSError:
+            self.close()
+            raise
+
+    def close(self):
+        os.close(self.fd)
+
+    def _watch(self, directory):
+        path = os.path.join(self.root, *directory.split('/')) if directory else self.root
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_EVENTS | IN_ONLYDIR)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch ' + path + ': ' + os.strerror(ctypes.get_errno()))
+        self.watches[wd] = directory
+
+    def _watch_tree(self, top):
+        self._watch(top)
+        for path, attr in Diff.walk_local(os.path.join(self.root, *top.split('/')) if top else self.root):
+            if stat.S_ISDIR(attr.st_mode):
+                self._watch(_join(top, path))
+
+    def _unwatch_tree(self, top):
+        for wd, directory in list(self.watches.items()):
+            if directory == top or directory.startswith(top + '/'):
+                self._libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read(self, timeout):
+        """The set of paths changed since the last call, waiting up to timeout seconds for one"""
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, _cookie, length = EVENT_HEADER.unpack_from(data, offset)
+                start = offset + EVENT_HEADER.size
+                name = os.fsdecode(data[start:start + length].rstrip(b'\0'))
+                offset = start + length
+                if mask & IN_Q_OVERFLOW:
+                    self.overflowed = True
+                    changed.add('')
+                    continue
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                directory = self.watches.get(wd)
+                if directory is None or not name:
+                    continue
+                path = _join(directory, name)
+                changed.add(path)
+                if mask & IN_ISDIR:
+                    if mask & IN_MOVED_FROM:
+                        self._unwatch_tree(path)
+                    elif mask & (IN_CREATE | IN_MOVED_TO):
+                        try:
+                            self._watch_tree(path)
+                        except OSError as e:
+                            # gone again, or out of watches (fs.inotify.max_user_watches)
+                            logging.warning('Unable to watch ' + path + ': ' + str(e))
+        return changed
+
+
+class Poller(object):
+    """Reports the paths changed below a local directory by comparing scans taken every interval seconds
+
+        The fallback where inotify is not available; each scan walks the whole tree.
+    """
+
+    def __init__(self, root, interval=POLL_INTERVAL):
+        self.root = root
+        self.interval = interval
+        self.overflowed = False
+        self._snapshot = self._scan()
+        self._next = time.monotonic() + interval
+
+    def close(self):
+        pass
+
+    def _scan(self):
+        return {path: (attr.st_mode, attr.st_size, attr.st_mtime_ns) for path, attr in Diff.walk_local(self.root)}
+
+    def read(self, timeout):
+        wait = self._next - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(wait, 0))
+        self._next = time.monotonic() + self.interval
+        snapshot = self._scan()
+        changed = {path for path in snapshot.keys() | self._snapshot.keys()
+                   if snapshot.get(path) != self._snapshot.get(path)}
+        self._snapshot = snapshot
+        return changed
+
+
+def open_watcher(root, poll=False, interval=POLL_INTERVAL):
+    """An Inotify for root, or a Poller if poll is set or inotify is not available"""
+    if not poll:
+        try:
+            return Inotify(root)
+        except OSError as e:
+            logging.info(str(e) + ', polling every ' + str(interval) + 's instead')
+    return Poller(root, interval)
+
+
+def batches(watcher, stop, debounce=DEBOUNCE, max_delay=MAX_DELAY):
+    """Yield the sets of paths a watcher reports, coalesced into batches, until stop is set
+
+        A batch is complete once debounce seconds pass without a change, or max_delay seconds
+        after its first change while changes keep coming, so a burst of events (a file written
+        in many blocks, a tree unpacked) becomes one push. Changes pending when stop is set are
+        yielded last.
+    """
+    pending, first, last = set(), None, None
+    while not stop.is_set():
+        changed = watcher.read(TICK)
+        now = time.monotonic()
+        if changed:
+            first = first if pending else now
+            pending |= changed
+            last = now
+        if pending and (now - last >= debounce or now - first >= max_delay):
+            yield pending
+            pending = set()
+    if pending:
+        yield pending
+
+
+def watch(sftp, manifest, host, localdir, remotedir, stop, delete=False, poll=False, interval=POLL_INTERVAL,
+          debounce=DEBOUNCE, reconnect=None, throttle=None):
+    """Push localdir to the remote directory remotedir, then push its changes as they happen until stop is set
+
+        The tree is watched (open_watcher) before the first push (a Mirror.sync), so nothing
+        changed meanwhile is missed. Every batch of changed paths is then pushed by Mirror.sync,
+        which lists only the directories holding them and takes the remote tree to be as the
+        last push left it. A lost inotify event queue is made up for with a full sync. Yields
+        the list of Mirror.Result of each push.
+
+        :param sftp: a paramiko.SFTPClient
+    """
+    def reconnected():
+        # the pushes that follow use the connection a transfer reconnected on
+        nonlocal sftp
+        sftp = reconnect()
+        return sftp
+
+    follow = reconnected if reconnect is not None else None
+    watcher = open_watcher(localdir, poll, interval)
+    try:
+        yield Mirror.sync(sftp, manifest, host, 'push', localdir, remotedir, delete=delete, reconnect=follow,
+                          throttle=throttle)[0]
+        for changed in batches(watcher, stop, debounce):
+            full, watcher.overflowed = watcher.overflowed, False
+            if full:
+                logging.warning('Too many changes to follow in ' + localdir + ', rescanning it')
+            yield Mirror.sync(sftp, manifest, host, 'push', localdir, remotedir, delete=delete, full=full,
+                              reconnect=follow, throttle=throttle, changed=None if full else changed)[0]
+    finally:
+        watcher.close()
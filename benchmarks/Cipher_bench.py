@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Benchmark the SSH cipher, MAC and compression settings for a link, and save a connection profile
+
+    Each cipher, each MAC and compression off/on is measured on its own connection: the median
+    round-trip time of small requests, the rate of pipelined small requests, and the throughput of
+    pipelined transfers in each direction. Against a real server:
+
+        python3 benchmarks/Cipher_bench.py -H host -U user [-P password] --save
+
+    --save stores the fastest settings as the host's profile (~/.sftp_profiles.json), which the
+    client uses for later connections to that host. Without -H the in-process LocalSFTPServer from
+    tests/local_server.py is used, optionally with a simulated RTT and bandwidth (--rtt, --bandwidth).
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import warnings
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_ROOT)
+sys.path.append(os.path.join(PROJECT_ROOT, 'tests'))
+from SFTPClient import Bench
+from SFTPClient import Connect
+from SFTPClient.Client import SFTP
+from Transfer_bench import parse_size
+
+
+def benchmark(client, size):
+    results = Bench.run(client.initiate_connection, size)
+    for line in Bench.format_results(results):
+        print(line)
+    profile = Bench.recommend(results)
+    print('Recommended profile: ' + json.dumps(profile))
+    return results, profile
+
+
+def capture_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Compare SSH cipher, MAC and compression throughput')
+    parser.add_argument('-H', '--host', help='Server to measure (default: an in-process test server)')
+    parser.add_argument('-U', '--username', help='Username for --host')
+    parser.add_argument('--port', type=int, default=22, help='SSH port (default 22)')
+    parser.add_argument('-P', '--password', help='Password for --host')
+    parser.add_argument('-p', '--private_key_password', help='Passphrase required to decrypt private key')
+    parser.add_argument('--size', default='8M', help='Bytes transferred in each direction per setting')
+    parser.add_argument('--rtt', type=float, default=0.0, help='Simulated round-trip time for the test server')
+    parser.add_argument('--bandwidth', help='Simulated bandwidth (bytes/second) for the test server, e.g. 10M')
+    parser.add_argument('--save', action='store_true', help="Save the recommended profile for --host")
+    parser.add_argument('-o', '--output', help='Write results to this JSON file')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Verbose logging')
+    args = parser.parse_args(argv)
+    if args.host is not None and args.username is None:
+        parser.error('-U/--username is required with -H/--host')
+    if args.host is None and args.save:
+        parser.error('--save needs -H/--host')
+    args.size = parse_size(args.size)
+    args.bandwidth = parse_size(args.bandwidth) if args.bandwidth else None
+    return args
+
+
+def main(argv=None):
+    args = capture_arguments(argv)
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        # the test server logs every connection the benchmark closes
+        logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    warnings.simplefilter('ignore', UserWarning)
+
+    if args.host is not None:
+        client = SFTP(args.host, args.username, args.password, args.private_key_password, port=args.port)
+        results, profile = benchmark(client, args.size)
+        client.connection.close()
+        if args.save:
+            Connect.save_profile(args.host, args.port, profile)
+            print('Saved to ' + Connect.PROFILE_FILE)
+    else:
+        from local_server import LocalSFTPServer, sandbox
+        with sandbox(), LocalSFTPServer(latency=args.rtt, bandwidth=args.bandwidth, compression=True) as server:
+            client = server.client()
+            results, profile = benchmark(client, args.size)
+            client.connection.close()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'results': results, 'profile': profile}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+"""Benchmark suite for the SFTP client's transfer, listing and tree commands
+
+    Every case runs the real SFTP command methods against an in-process LocalSFTPServer (see
+    tests/local_server.py), optionally with a simulated round-trip time, and records wall time,
+    throughput, per-file latency and peak memory. Each case runs in a process (and against a server)
+    of its own, so its peak memory is not that of the cases before it. Results are written as JSON
+    so that runs can be compared against each other:
+
+        python3 benchmarks/Transfer_bench.py --output before.json
+        python3 benchmarks/Transfer_bench.py --output after.json --compare before.json
+
+    A full sweep (this needs several GB of free disk space and takes a long time):
+
+        python3 benchmarks/Transfer_bench.py --sizes 1K,1M,100M,1G,4G --counts 1,100,10000,100000 \\
+            --rtts 0,0.01,0.05,0.1
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+import traceback
+import tracemalloc
+import warnings
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(PROJECT_ROOT)
+sys.path.append(os.path.join(PROJECT_ROOT, 'tests'))
+from SFTPClient.Client import DOWNLOADS_DIRECTORY
+from local_server import LocalSFTPServer, host_key, sandbox
+
+SIZE_OPERATIONS = ('get', 'put', 'put-mmap')
+COUNT_OPERATIONS = ('getm', 'ls-l', 'rmdir', 'cp', 'cp_r', 'put-archive', 'get-archive')
+# reconnects (handshake and authentication) rather than transfers
+CONNECT_OPERATIONS = ('connect',)
+OPERATIONS = SIZE_OPERATIONS + COUNT_OPERATIONS + CONNECT_OPERATIONS
+
+SIZE_UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+WRITE_BLOCK = 1024 * 1024
+
+
+def parse_size(text):
+    """Parse a size such as 512, 1K, 100M or 4G into a number of bytes"""
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1] if text and text[-1] in SIZE_UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * SIZE_UNITS[unit])
+
+
+def format_size(size):
+    for unit in ('G', 'M', 'K'):
+        if size >= SIZE_UNITS[unit] and size % SIZE_UNITS[unit] == 0:
+            return str(size // SIZE_UNITS[unit]) + unit
+    return str(size)
+
+
+def write_file(path, size):
+    """Create a file of the given size without holding it in memory"""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    block = os.urandom(min(size, WRITE_BLOCK))
+    with open(path, 'wb') as f:
+        remaining = size
+        while remaining > 0:
+            f.write(block[:remaining])
+            remaining -= len(block)
+
+
+def populate(directory, count, size):
+    os.makedirs(directory, exist_ok=True)
+    for i in range(count):
+        write_file(os.path.join(directory, 'f%06d' % i), size)
+
+
+def peak_rss_kb():
+    """High-water mark of this process (client and in-process server) since it was started or forked"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_forked(function, *args):
+    """Return function(*args), a JSON-serializable result, computed in a forked child process
+
+        A child's high-water mark starts from the parent's resident size at the fork, rather than
+        from the largest case run so far.
+    """
+    sys.stdout.flush()
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 0
+        try:
+            payload = json.dumps(function(*args))
+        except BaseException:
+            traceback.print_exc()
+            payload, status = 'null', 1
+        with os.fdopen(write_fd, 'w') as f:
+            f.write(payload)
+        sys.stderr.flush()
+        os._exit(status)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as f:
+        payload = f.read()
+    _, status = os.waitpid(pid, 0)
+    if status:
+        raise RuntimeError('benchmark child process failed (status ' + str(status) + ')')
+    return json.loads(payload)
+
+
+class Case(object):
+    """A single benchmark case: setup and teardown are excluded from the measurement"""
+
+    def __init__(self, operation, rtt, size=None, count=1, file_size=None):
+        self.operation = operation
+        self.rtt = rtt
+        self.size = size
+        self.count = count
+        self.file_size = file_size
+
+    @property
+    def key(self):
+        return '%s size=%s count=%d rtt=%g' % (self.operation, format_size(self.size or self.file_size),
+                                               self.count, self.rtt)
+
+    @property
+    def total_bytes(self):
+        if self.operation in SIZE_OPERATIONS:
+            return self.size
+        if self.operation in ('ls-l', 'rmdir', 'connect'):
+            return 0
+        return self.count * self.file_size
+
+    def setup(self, server, client):
+        remote = server.local_path
+        if self.operation == 'get':
+            write_file(remote('bench.bin'), self.size)
+        elif self.operation in ('put', 'put-mmap'):
+            write_file('bench.bin', self.size)
+        elif self.operation == 'getm':
+            populate(remote('bench_dir'), self.count, self.file_size)
+            self.names = ['bench_dir/' + name for name in sorted(os.listdir(remote('bench_dir')))]
+        elif self.operation == 'connect':
+            pass
+        elif self.operation == 'put-archive':
+            populate('bench_dir', self.count, self.file_size)
+        else:
+            populate(remote('bench_dir'), self.count, self.file_size)
+
+    def run(self, client):
+        if self.operation == 'get':
+            client.get(['bench.bin'])
+        elif self.operation == 'put':
+            client.put(['bench.bin'])
+        elif self.operation == 'put-mmap':
+            client.put(['--mmap', 'bench.bin'])
+        elif self.operation == 'getm':
+            client.getm(self.names)
+        elif self.operation == 'ls-l':
+            client.ls(['-l', 'bench_dir'])
+        elif self.operation == 'rmdir':
+            client.rmdir(['bench_dir'])
+        elif self.operation == 'cp':
+            client.cp(['bench_dir', 'bench_copy'])
+        elif self.operation == 'cp_r':
+            client.cp_r(['bench_dir', 'bench_copy'])
+        elif self.operation == 'put-archive':
+            client.put(['--archive', 'bench_dir'])
+        elif self.operation == 'get-archive':
+            client.get(['--archive', 'bench_dir'])
+        elif self.operation == 'connect':
+            for _ in range(self.count):
+                client.reconnect()
+
+    def teardown(self, server):
+        for name in ('bench.bin', 'bench_dir', 'bench_copy'):
+            path = server.local_path(name)
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        for path in ('bench.bin', 'bench_dir', DOWNLOADS_DIRECTORY):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+        os.mkdir(DOWNLOADS_DIRECTORY)
+
+    def measure(self, server, client, trace_memory=False):
+        self.setup(server, client)
+        try:
+            if trace_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            self.run(client)
+            seconds = time.perf_counter() - start
+            traced_peak = tracemalloc.get_traced_memory()[1] if trace_memory else None
+        finally:
+            if trace_memory:
+                tracemalloc.stop()
+            self.teardown(server)
+        return {'key': self.key,
+                'operation': self.operation,
+                'size': self.size,
+                'file_size': self.file_size,
+                'count': self.count,
+                'rtt': self.rtt,
+                'seconds': seconds,
+                'bytes': self.total_bytes,
+                'throughput_bps': self.total_bytes / seconds if seconds and self.total_bytes else None,
+                'latency_s': seconds / self.count,
+                'peak_traced_bytes': traced_peak}
+
+
+def build_cases(args):
+    cases = []
+    for rtt in args.rtts:
+        for operation in args.operations:
+            if operation in SIZE_OPERATIONS:
+                cases.extend(Case(operation, rtt, size=size) for size in args.sizes)
+            elif operation in CONNECT_OPERATIONS:
+                cases.append(Case(operation, rtt, count=args.connects, file_size=0))
+            else:
+                cases.extend(Case(operation, rtt, count=count, file_size=args.file_size) for count in args.counts)
+    return cases
+
+
+def run_case(case, repeat, trace_memory):
+    with LocalSFTPServer(latency=case.rtt) as server:
+        client = server.client()
+        try:
+            runs = [case.measure(server, client, trace_memory) for _ in range(repeat)]
+        finally:
+            client.connection.close()
+    # keep the fastest run; the slower ones are mostly scheduling noise
+    best = min(runs, key=lambda r: r['seconds'])
+    best['runs'] = [r['seconds'] for r in runs]
+    best['peak_rss_kb'] = peak_rss_kb()
+    return best
+
+
+def run_cases(cases, repeat, trace_memory):
+    results = []
+    # generated once, before forking, so that every child's server matches known_hosts
+    host_key()
+    for case in sorted(cases, key=lambda c: c.rtt):
+        # the server's threads are started in the child, which has only the thread that forked it
+        result = run_forked(run_case, case, repeat, trace_memory)
+        results.append(result)
+        print_result(result)
+    return results
+
+
+def print_result(result):
+    throughput = result['throughput_bps']
+    print('{:<45s} {:>10.4f} s {:>12s} {:>12.6f} s/file {:>10d} KB'.format(
+        result['key'], result['seconds'],
+        '%.2f MB/s' % (throughput / 1e6) if throughput else '-',
+        result['latency_s'], result['peak_rss_kb']))
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=PROJECT_ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold):
+    """Return the cases that got slower than the baseline by more than threshold (a fraction)"""
+    previous = {r['key']: r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get(result['key'])
+        if before is None:
+            continue
+        change = (result['seconds'] - before['seconds']) / before['seconds'] if before['seconds'] else 0.0
+        print('{:<45s} {:>10.4f} s -> {:>10.4f} s {:>+8.1%}'.format(result['key'], before['seconds'],
+                                                                   result['seconds'], change))
+        if change > threshold:
+            regressions.append((result['key'], change))
+    return regressions
+
+
+def capture_arguments(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark SFTP transfers against a local server')
+    parser.add_argument('--operations', default=','.join(OPERATIONS),
+                        help='Comma separated operations to run (' + ', '.join(OPERATIONS) + ')')
+    parser.add_argument('--sizes', default='1K,1M,64M', help='File sizes for get/put, e.g. 1K,1M,1G')
+    parser.add_argument('--counts', default='1,100,1000', help='File counts for the tree operations')
+    parser.add_argument('--file-size', default='1K', help='Size of each file in the tree operations')
+    parser.add_argument('--connects', type=int, default=10, help='Connections opened by the connect operation')
+    parser.add_argument('--rtts', default='0,0.02', help='Simulated round-trip times in seconds')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per case (the fastest is kept)')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Also record the tracemalloc peak (slows the run down)')
+    parser.add_argument('-o', '--output', help='Write results to this JSON file')
+    parser.add_argument('--compare', help='Compare with the results in this JSON file')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='Slowdown (fraction) reported as a regression by --compare')
+    parser.add_argument('-v', '--verbose', action='store_true', help='Verbose logging')
+    args = parser.parse_args(argv)
+    args.operations = [op.strip() for op in args.operations.split(',') if op.strip()]
+    unknown = set(args.operations) - set(OPERATIONS)
+    if unknown:
+        parser.error('unknown operations: ' + ', '.join(sorted(unknown)))
+    args.sizes = [parse_size(s) for s in args.sizes.split(',')]
+    args.counts = [int(c) for c in args.counts.split(',')]
+    args.file_size = parse_size(args.file_size)
+    args.rtts = [float(r) for r in args.rtts.split(',')]
+    return args
+
+
+def main(argv=None):
+    args = capture_arguments(argv)
+    if args.verbose:
+        logging.basicConfig(level=logging.DEBUG)
+    warnings.simplefilter('ignore', UserWarning)
+
+    output = os.path.abspath(args.output) if args.output else None
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    with sandbox():
+        results = run_cases(build_cases(args), args.repeat, args.trace_memory)
+
+    report = {'meta': {'date': datetime.datetime.now().isoformat(),
+                       'revision': git_revision(),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'repeat': args.repeat},
+              'results': results}
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.threshold)
+        for key, change in regressions:
+            print('REGRESSION: ' + key + ' is {:.1%} slower'.format(change))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
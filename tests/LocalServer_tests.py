@@ -0,0 +1,1797 @@
+#!/usr/bin/env python3
+import sys
+import os
+import re
+import shutil
+import hashlib
+import io
+import socket
+import stat
+import threading
+import time
+import unittest
+import warnings
+from unittest.mock import patch
+
+import paramiko
+
+# fix for running as script(if project root not in PYTHONPATH)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from SFTPClient.Client import SFTP
+from SFTPClient.Client import DOWNLOADS_DIRECTORY, MANIFEST_FILE
+from SFTPClient import Archive
+from SFTPClient import Batch
+from SFTPClient import Bench
+from SFTPClient import Cache
+from SFTPClient import Connect
+from SFTPClient import Diff
+from SFTPClient import Flow
+from SFTPClient import Grep
+from SFTPClient import Integrity
+from SFTPClient import Mirror
+from SFTPClient import Modes
+from SFTPClient import MultiHost
+from SFTPClient import Peek
+from SFTPClient import Throttle
+from SFTPClient import Transfer
+from SFTPClient import Watch
+from SFTPClient.Sink import PreallocatedSink
+from local_server import LocalSFTPServer, sandbox
+
+
+def make_tree(root, count):
+    """Create count small files under root, half of them in a sub directory"""
+    for i in range(count):
+        path = os.path.join(root, 'sub' if i % 2 else '', 'f%d.txt' % i)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(b'file %d' % i)
+        os.utime(path, (1000000000 + i, 1000000000 + i))
+
+
+class LocalServerTestCase(unittest.TestCase):
+    """LocalServerTestCase provides a base unittest class that runs the SFTP class against a LocalSFTPServer
+
+        Unlike FTP_tests.py these tests need no network access or credentials. They can be run using
+        the following command:
+
+        python3 -m unittest -v LocalServer_tests.py
+    """
+
+    # keyword arguments passed to LocalSFTPServer by subclasses
+    server_options = {}
+
+    @classmethod
+    def setUpClass(cls):
+        warnings.simplefilter("ignore", UserWarning)
+        cls._sandbox = sandbox()
+        cls.workdir = cls._sandbox.__enter__()
+        cls.server = LocalSFTPServer(**cls.server_options).start()
+        cls.sftp_client = cls.server.client()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.sftp_client.connection.close()
+        cls.sftp_client = None
+        cls.server.stop()
+        cls._sandbox.__exit__(None, None, None)
+
+    def write_remote(self, name, data):
+        """Create a file on the server (bypassing SFTP) and return its local backing path"""
+        path = self.server.local_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def read_local(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def wrap_command(self, name, prelude):
+        """Put a <name> first on the PATH (of the server's shell too) that runs prelude, then the real command"""
+        directory = os.path.abspath('wrapped_' + name)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, name)
+        with open(path, 'w') as f:
+            f.write('#!/bin/sh\n' + prelude + '\nexec ' + shutil.which(name) + ' "$@"\n')
+        os.chmod(path, 0o755)
+        patcher = patch.dict(os.environ, {'PATH': directory + os.pathsep + os.environ['PATH']})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_briefly(self, function, *args, timeout=60):
+        """Return function(*args), failing (rather than hanging) if it takes longer than timeout seconds"""
+        result = []
+        thread = threading.Thread(target=lambda: result.append(function(*args)), daemon=True)
+        thread.start()
+        thread.join(timeout)
+        self.assertFalse(thread.is_alive(), function.__name__ + ' did not finish')
+        self.assertTrue(result, function.__name__ + ' failed')
+        return result[0]
+
+
+class LocalServerSmokeTestCase(LocalServerTestCase):
+    """Exercises the real client code paths against the local server"""
+
+    def test_connect(self):
+        """Test that the client connects and the known_hosts entry is cached in the sandbox"""
+        self.assertIsInstance(self.sftp_client, SFTP)
+        self.assertEqual(self.sftp_client.pwd([]), self.server.root)
+        self.assertTrue(os.path.isfile(os.path.join(os.environ['HOME'], '.ssh', 'known_hosts')))
+
+    def test_ls_and_get(self):
+        """Test that files created on the server are listed and downloaded intact"""
+        self.write_remote('local_server_get.txt', b'local server')
+        self.assertIn('local_server_get.txt', self.sftp_client.ls([]))
+        self.sftp_client.get(['local_server_get.txt'])
+        self.assertEqual(self.read_local(os.path.join(DOWNLOADS_DIRECTORY, 'local_server_get.txt')), b'local server')
+
+    def test_put(self):
+        """Test that put uploads a file and preserves its mtime"""
+        with open('local_server_put.txt', 'wb') as f:
+            f.write(b'x' * 100000)
+        os.utime('local_server_put.txt', (1000000000, 1000000000))
+        self.sftp_client.put(['local_server_put.txt'])
+        remote = self.server.local_path('local_server_put.txt')
+        self.assertEqual(self.read_local(remote), b'x' * 100000)
+        self.assertEqual(int(os.stat(remote).st_mtime), 1000000000)
+
+    def test_exec(self):
+        """Test that cp_r runs through the exec channel"""
+        self.write_remote('local_server_src/a.txt', b'a')
+        self.sftp_client.cp_r(['local_server_src', 'local_server_dst'])
+        self.assertEqual(self.read_local(self.server.local_path('local_server_dst/a.txt')), b'a')
+
+    def test_check_file_extension(self):
+        """Test that the advertised check-file extension answers with a sha256 digest"""
+        self.write_remote('local_server_check.bin', b'y' * 70000)
+        with self.sftp_client.connection.open('local_server_check.bin', 'rb') as f:
+            digest = f.check('sha256')
+        self.assertEqual(digest, hashlib.sha256(b'y' * 70000).digest())
+
+
+class PutMmapCommandTestCase(LocalServerTestCase):
+    """Uploads through the memory-mapped, pipelined write path"""
+
+    def put_mmap(self, name, data):
+        with open(name, 'wb') as f:
+            f.write(data)
+        os.utime(name, (1000000000, 1000000000))
+        self.sftp_client.put(['--mmap', name])
+        return self.server.local_path(name)
+
+    def test_put_mmap(self):
+        """Test that a multi-request file arrives intact with its mtime preserved"""
+        data = os.urandom(5 * 1024 * 1024 + 123)
+        remote = self.put_mmap('mmap_put.bin', data)
+        self.assertEqual(self.read_local(remote), data)
+        self.assertEqual(int(os.stat(remote).st_mtime), 1000000000)
+
+    def test_put_mmap_empty(self):
+        """Test that an empty file (which cannot be mapped) is still created"""
+        remote = self.put_mmap('mmap_empty.bin', b'')
+        self.assertEqual(self.read_local(remote), b'')
+
+    def test_put_mmap_target(self):
+        """Test that --mmap combines with -t"""
+        with open('mmap_target.bin', 'wb') as f:
+            f.write(b'target')
+        self.sftp_client.put(['-t', 'mmap_dir', '--mmap', 'mmap_target.bin'])
+        self.assertEqual(self.read_local(self.server.local_path('mmap_dir/mmap_target.bin')), b'target')
+
+
+class GetCommandTestCase(LocalServerTestCase):
+    """Downloads through the pipelined READ path into a PreallocatedSink"""
+
+    def test_get_large(self):
+        """Test that a file spanning many READ requests arrives intact"""
+        data = os.urandom(3 * 1024 * 1024 + 17)
+        self.write_remote('get_large.bin', data)
+        self.sftp_client.get(['get_large.bin', 'get_large_copy.bin'])
+        self.assertEqual(self.read_local('get_large_copy.bin'), data)
+
+    def test_get_empty(self):
+        """Test that an empty remote file produces an empty local file"""
+        self.write_remote('get_empty.bin', b'')
+        self.sftp_client.get(['get_empty.bin'])
+        self.assertEqual(self.read_local(os.path.join(DOWNLOADS_DIRECTORY, 'get_empty.bin')), b'')
+
+    def test_getm(self):
+        """Test that getm downloads every file and leaves no temporary files behind"""
+        for i in range(3):
+            self.write_remote('getm_dir/f%d.txt' % i, b'%d' % i)
+        self.sftp_client.getm(['getm_dir/f0.txt', 'getm_dir/f1.txt', 'getm_dir/f2.txt'])
+        for i in range(3):
+            self.assertEqual(self.read_local(os.path.join(DOWNLOADS_DIRECTORY, 'f%d.txt' % i)), b'%d' % i)
+        self.assertFalse([name for name in os.listdir(DOWNLOADS_DIRECTORY) if name.endswith('.part')])
+
+
+class HashOptionTestCase(LocalServerTestCase):
+    """Transfers with --hash are hashed inline, verified against the server and logged to the manifest"""
+
+    def manifest(self):
+        with open(MANIFEST_FILE) as f:
+            return [line.rstrip('\n').split('\t') for line in f]
+
+    def test_get_hash_check_file(self):
+        """Test that get --hash sha256 is verified through the check-file extension"""
+        data = os.urandom(200000)
+        self.write_remote('hash_get.bin', data)
+        self.sftp_client.get(['--hash', 'sha256', 'hash_get.bin', 'hash_get_copy.bin'])
+        self.assertEqual(self.read_local('hash_get_copy.bin'), data)
+        entry = self.manifest()[-1]
+        self.assertEqual(entry[1:], ['sha256', hashlib.sha256(data).hexdigest(), 'verified', 'hash_get.bin',
+                                     'hash_get_copy.bin'])
+
+    def test_getm_hash_exec(self):
+        """Test that getm --hash blake2b is verified by running b2sum on the server"""
+        self.write_remote('hash_getm/a.bin', b'a' * 1000)
+        self.write_remote('hash_getm/b.bin', b'b' * 1000)
+        self.sftp_client.getm(['--hash', 'blake2b', 'hash_getm/a.bin', 'hash_getm/b.bin'])
+        entries = self.manifest()[-2:]
+        self.assertEqual([e[2] for e in entries], [hashlib.blake2b(b'a' * 1000).hexdigest(),
+                                                   hashlib.blake2b(b'b' * 1000).hexdigest()])
+        self.assertEqual([e[3] for e in entries], ['verified', 'verified'])
+
+    def test_get_hash_mismatch(self):
+        """Test that a digest mismatch raises IOError and removes the local file"""
+        self.write_remote('hash_bad.bin', b'bad')
+        with patch('SFTPClient.Integrity.remote_digest', return_value='0' * 64):
+            with self.assertRaises(IOError):
+                self.sftp_client.get(['--hash', 'sha256', 'hash_bad.bin', 'hash_bad_copy.bin'])
+        self.assertFalse(os.path.exists('hash_bad_copy.bin'))
+
+    def test_get_hash_unknown_algorithm(self):
+        """Test that an unknown algorithm is rejected before anything is transferred"""
+        with self.assertRaises(ValueError):
+            self.sftp_client.get(['--hash', 'crc32', 'whatever.bin'])
+
+    def test_put_hash(self):
+        """Test that put --hash sha256 hashes the upload and verifies it"""
+        data = os.urandom(100000)
+        with open('hash_put.bin', 'wb') as f:
+            f.write(data)
+        self.sftp_client.put(['--hash', 'sha256', 'hash_put.bin'])
+        self.assertEqual(self.read_local(self.server.local_path('hash_put.bin')), data)
+        self.assertEqual(self.manifest()[-1][2:4], [hashlib.sha256(data).hexdigest(), 'verified'])
+
+    def test_cp_hash(self):
+        """Test that cp --hash verifies the source and the copy of every file"""
+        self.write_remote('hash_cp_src/a.txt', b'a')
+        self.write_remote('hash_cp_src/sub/b.txt', b'b')
+        self.sftp_client.cp(['--hash', 'sha256', 'hash_cp_src', 'hash_cp_dst'])
+        self.assertEqual(self.read_local(self.server.local_path('hash_cp_dst/sub/b.txt')), b'b')
+        entries = {e[4]: e for e in self.manifest() if e[4].startswith('hash_cp_src')}
+        self.assertEqual(sorted(entries), ['hash_cp_src/a.txt', 'hash_cp_src/sub/b.txt'])
+        self.assertTrue(entries['hash_cp_src/sub/b.txt'][5].endswith('hash_cp_dst/sub/b.txt'))
+        self.assertEqual(set(e[3] for e in entries.values()), {'verified'})
+
+
+class MultiHostTestCase(unittest.TestCase):
+    """MultiSFTP fans put out to, and get in from, several servers and reports each host separately"""
+
+    @classmethod
+    def setUpClass(cls):
+        warnings.simplefilter("ignore", UserWarning)
+        cls._sandbox = sandbox()
+        cls._sandbox.__enter__()
+        cls.servers = [LocalSFTPServer().start() for _ in range(3)]
+        # a port nobody listens on
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        cls.dead_port = sock.getsockname()[1]
+        sock.close()
+        hosts = [MultiHost.Host(server.host, server.port, None) for server in cls.servers]
+        hosts.append(MultiHost.Host('127.0.0.1', cls.dead_port, None))
+        cls.multi = MultiHost.MultiSFTP(hosts, cls.servers[0].username, cls.servers[0].password, max_workers=2)
+
+    @classmethod
+    def tearDownClass(cls):
+        for client in cls.multi.clients.values():
+            client.connection.close()
+        for server in cls.servers:
+            server.stop()
+        cls._sandbox.__exit__(None, None, None)
+
+    def test_connect(self):
+        """Test that reachable hosts are connected and the unreachable one is recorded"""
+        self.assertEqual(len(self.multi.clients), 3)
+        self.assertEqual(list(self.multi.errors), ['127.0.0.1:' + str(self.dead_port)])
+
+    def test_put(self):
+        """Test that put uploads to every host and reports per-host results"""
+        with open('multi_put.txt', 'wb') as f:
+            f.write(b'release')
+        results = self.multi.put(['-t', 'releases', 'multi_put.txt'])
+        self.assertEqual([line.split(': ', 1)[1] for line in results], ['ok', 'ok', 'ok', 'FAILED: not connected: '
+                                                                        + str(self.multi.errors[self.multi.labels[3]])])
+        for server in self.servers:
+            with open(server.local_path('releases/multi_put.txt'), 'rb') as f:
+                self.assertEqual(f.read(), b'release')
+
+    def test_get(self):
+        """Test that get downloads each host's copy into its own directory"""
+        for i, server in enumerate(self.servers):
+            with open(server.local_path('multi_get.log'), 'w') as f:
+                f.write('host %d' % i)
+        os.remove(self.servers[1].local_path('multi_get.log'))
+        results = self.multi.get(['multi_get.log', 'fan_in'])
+        self.assertIn('FAILED', results[1])
+        for i in (0, 2):
+            label = self.multi.labels[i].replace(':', '_')
+            with open(os.path.join('fan_in', label, 'multi_get.log')) as f:
+                self.assertEqual(f.read(), 'host %d' % i)
+
+    def test_generic_command(self):
+        """Test that other commands run on every host"""
+        for server in self.servers:
+            os.makedirs(server.local_path('multi_ls'), exist_ok=True)
+            open(server.local_path('multi_ls/x'), 'w').close()
+        results = self.multi.ls(['multi_ls'])
+        self.assertEqual([line.split(': ', 1)[1] for line in results[:3]], ['x', 'x', 'x'])
+
+    def test_parse_host(self):
+        self.assertEqual(MultiHost.parse_host('alice@example.com:2222'), ('example.com', 2222, 'alice'))
+        self.assertEqual(MultiHost.parse_host('[::1]', 22, 'bob'), ('::1', 22, 'bob'))
+        with self.assertRaises(ValueError):
+            MultiHost.parse_host('a@b@c:')
+
+
+class StreamHasherTestCase(unittest.TestCase):
+    """StreamHasher hashes out-of-order blocks as if they were sequential"""
+
+    def test_out_of_order(self):
+        data = os.urandom(5000)
+        hasher = Integrity.StreamHasher('sha256')
+        for offset in (4000, 1000, 3000, 0, 2000):
+            hasher.update(offset, data[offset:offset + 1000])
+        self.assertEqual(hasher.hexdigest(), hashlib.sha256(data).hexdigest())
+
+    def test_incomplete(self):
+        hasher = Integrity.StreamHasher('sha256')
+        hasher.update(10, b'x')
+        with self.assertRaises(ValueError):
+            hasher.hexdigest()
+
+
+class PreallocatedSinkTestCase(unittest.TestCase):
+    """PreallocatedSink accepts out-of-order writes and only publishes complete files"""
+
+    def setUp(self):
+        self._sandbox = sandbox()
+        self._sandbox.__enter__()
+
+    def tearDown(self):
+        self._sandbox.__exit__(None, None, None)
+
+    def test_out_of_order(self):
+        """Test that blocks written in reverse order produce the right file"""
+        data = os.urandom(10000)
+        with PreallocatedSink('sink.bin', len(data)) as sink:
+            self.assertEqual(os.path.getsize(sink.temp_path), len(data))
+            for offset in reversed(range(0, len(data), 1000)):
+                sink.write(offset, data[offset:offset + 1000])
+            self.assertFalse(os.path.exists('sink.bin'))
+            sink.commit(mtime=1000000000)
+        self.assertEqual(self.read('sink.bin'), data)
+        self.assertEqual(int(os.stat('sink.bin').st_mtime), 1000000000)
+
+    def test_umask(self):
+        """Test that the file gets the mode of a regular open() under the umask, which is left alone"""
+        previous = os.umask(0o027)
+        try:
+            with patch('SFTPClient.Sink.os.umask') as mock_umask:
+                with PreallocatedSink('sink_mode.bin', 0) as sink:
+                    sink.commit()
+            mock_umask.assert_not_called()
+        finally:
+            os.umask(previous)
+        self.assertEqual(stat.S_IMODE(os.stat('sink_mode.bin').st_mode), 0o640)
+
+    def test_missing_ranges(self):
+        """Test that gaps are tracked and an incomplete file cannot be committed"""
+        with PreallocatedSink('sink_gaps.bin', 100) as sink:
+            sink.write(10, b'x' * 10)
+            sink.write(30, b'x' * 10)
+            sink.write(20, b'x' * 5)
+            self.assertEqual(sink.missing_ranges(), [(0, 10), (25, 5), (40, 60)])
+            self.assertEqual(sink.completed, 25)
+            with self.assertRaises(IOError):
+                sink.commit()
+        self.assertEqual([name for name in os.listdir('.') if name.startswith('.sink_gaps')], [])
+        self.assertFalse(os.path.exists('sink_gaps.bin'))
+
+    def read(self, path):
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+class NoExtensionsTestCase(LocalServerTestCase):
+    """Extensions that are not advertised are refused, and exec can be disabled"""
+    server_options = {'extensions': {}, 'allow_exec': False}
+
+    def test_check_file_unsupported(self):
+        """Test that check-file is answered with SSH_FX_OP_UNSUPPORTED"""
+        self.write_remote('no_extensions.bin', b'z')
+        with self.sftp_client.connection.open('no_extensions.bin', 'rb') as f:
+            with self.assertRaises(IOError):
+                f.check('sha256')
+
+    def test_get_hash_unverified(self):
+        """Test that without check-file or exec the transfer is hashed but marked unverified"""
+        self.write_remote('no_extensions_hash.bin', b'data')
+        self.sftp_client.get(['--hash', 'sha256', 'no_extensions_hash.bin'])
+        with open(MANIFEST_FILE) as f:
+            self.assertEqual(f.read().splitlines()[-1].split('\t')[3], 'unverified')
+
+    def test_put_archive_falls_back(self):
+        """Test that put --archive uses plain SFTP when exec is refused"""
+        make_tree('fallback_tree', 5)
+        self.sftp_client.put(['--archive', 'fallback_tree'])
+        self.assertEqual(self.read_local(self.server.local_path('fallback_tree/sub/f3.txt')), b'file 3')
+
+    def test_get_archive_falls_back(self):
+        """Test that get --archive uses plain SFTP when exec is refused"""
+        self.write_remote('fallback_remote/sub/a.txt', b'a')
+        self.sftp_client.get(['--archive', 'fallback_remote', 'fallback_local'])
+        self.assertEqual(self.read_local('fallback_local/fallback_remote/sub/a.txt'), b'a')
+        self.assertEqual(os.listdir('fallback_local'), ['fallback_remote'])
+
+    def test_exec_refused(self):
+        """Test that remote command execution is refused"""
+        self.write_remote('no_exec/a.txt', b'a')
+        with self.assertRaises(paramiko.SSHException):
+            self.sftp_client.cp_r(['no_exec', 'no_exec_copy'])
+
+    def test_put_request_size(self):
+        """Test that without "limits@openssh.com" no WRITE is larger than REQUEST_SIZE"""
+        data = os.urandom(4 * 1024 * 1024)
+        with open('no_limits.bin', 'wb') as f:
+            f.write(data)
+        self.sftp_client.put(['no_limits.bin'])
+        self.assertEqual(self.read_local(self.server.local_path('no_limits.bin')), data)
+        self.assertLessEqual(self.server.largest_write, Transfer.REQUEST_SIZE)
+
+
+class PutArchiveTestCase(LocalServerTestCase):
+    """put --archive streams a directory through tar on the server"""
+
+    def assertTreeUploaded(self, remote_root, count):
+        for i in range(count):
+            relative = os.path.join('sub' if i % 2 else '', 'f%d.txt' % i)
+            path = os.path.join(remote_root, relative)
+            self.assertEqual(self.read_local(path), b'file %d' % i)
+            self.assertEqual(os.stat(path).st_mtime, 1000000000 + i)
+
+    def test_put_archive(self):
+        """Test that the tree is extracted in the remote working directory with mtimes preserved"""
+        make_tree('archive_tree', 20)
+        connections = self.server.connections
+        self.sftp_client.put(['--archive', 'archive_tree'])
+        self.assertTreeUploaded(self.server.local_path('archive_tree'), 20)
+        self.assertEqual(self.server.connections, connections)
+
+    def test_put_archive_gzip_target(self):
+        """Test a gzip-compressed stream into a -t target that does not exist yet"""
+        make_tree('archive_gzip', 6)
+        self.sftp_client.put(['-t', 'archive_target/nested', '--archive', '--compress', 'gzip', 'archive_gzip'])
+        self.assertTreeUploaded(self.server.local_path('archive_target/nested/archive_gzip'), 6)
+
+    def test_put_archive_relative_to_cwd(self):
+        """Test that the tree lands in the SFTP working directory, not the login directory"""
+        os.makedirs(self.server.local_path('archive_cwd'), exist_ok=True)
+        make_tree('archive_in_cwd', 2)
+        self.sftp_client.cd(['archive_cwd'])
+        self.addCleanup(self.sftp_client.cd, [self.server.root])
+        self.sftp_client.put(['--archive', 'archive_in_cwd'])
+        self.assertTreeUploaded(self.server.local_path('archive_cwd/archive_in_cwd'), 2)
+
+    def test_put_archive_unknown_compression(self):
+        """Test that an unknown compression is rejected before anything is sent"""
+        with self.assertRaises(ValueError):
+            self.sftp_client.put(['--archive', '--compress', 'lz4', 'archive_tree'])
+
+
+class GetArchiveTestCase(LocalServerTestCase):
+    """get --archive streams a remote directory out of tar on the server"""
+
+    def assertTreeDownloaded(self, local_root, count):
+        for i in range(count):
+            path = os.path.join(local_root, 'sub' if i % 2 else '', 'f%d.txt' % i)
+            self.assertEqual(self.read_local(path), b'file %d' % i)
+            self.assertEqual(os.stat(path).st_mtime, 1000000000 + i)
+
+    def test_get_archive(self):
+        """Test that the tree is extracted into the downloads directory with mtimes preserved"""
+        make_tree(self.server.local_path('remote_tree'), 20)
+        self.sftp_client.get(['--archive', 'remote_tree'])
+        self.assertTreeDownloaded(os.path.join(DOWNLOADS_DIRECTORY, 'remote_tree'), 20)
+
+    def test_get_archive_gzip(self):
+        """Test a gzip-compressed stream of an absolute remote path into a given local directory"""
+        make_tree(self.server.local_path('remote_gzip'), 6)
+        self.sftp_client.get(['--archive', '--compress', 'gzip', self.server.local_path('remote_gzip'), 'gz_out'])
+        self.assertTreeDownloaded(os.path.join('gz_out', 'remote_gzip'), 6)
+
+    def test_get_archive_noisy_stderr(self):
+        """Test that a tar writing more warnings than the channel window holds still finishes"""
+        self.wrap_command('tar', 'head -c %d /dev/zero | tr "\\0" w >&2' % (Flow.MAX_WINDOW + 4 * 1024 * 1024))
+        make_tree(self.server.local_path('remote_noisy'), 4)
+        self.run_briefly(self.sftp_client.get, ['--archive', 'remote_noisy'])
+        self.assertTreeDownloaded(os.path.join(DOWNLOADS_DIRECTORY, 'remote_noisy'), 4)
+
+    def test_get_archive_not_a_directory(self):
+        """Test that --archive needs a remote directory"""
+        self.write_remote('archive_file.txt', b'x')
+        with self.assertRaises(IOError):
+            self.sftp_client.get(['--archive', 'archive_file.txt'])
+
+    def test_get_archive_remote_failure(self):
+        """Test that a failing remote tar is reported with its error output"""
+        with self.assertRaises(IOError) as context:
+            Archive.download_tree(self.sftp_client.connection, 'no_such_remote_dir', 'failure_out')
+        self.assertIn('no_such_remote_dir', str(context.exception))
+
+
+class DownloadCacheTestCase(LocalServerTestCase):
+    """get/getm with a download cache skip the transfer of remote files that have not changed"""
+
+    def setUp(self):
+        self.cache_dir = 'cache_' + self.id().rsplit('.', 1)[-1]
+        self.client = self.server.client(download_cache=Cache.DownloadCache(self.cache_dir, max_bytes=10000))
+        self.addCleanup(self.client.connection.close)
+
+    def test_get_cached(self):
+        """Test that an unchanged file is linked from the cache and a changed one downloaded again"""
+        remote = self.write_remote('cached.txt', b'version 1')
+        os.utime(remote, (1000000000, 1000000000))
+        self.client.get(['cached.txt', 'cached_1.txt'])
+        with patch.object(Transfer, 'download', wraps=Transfer.download) as download:
+            self.client.get(['cached.txt', 'cached_2.txt'])
+            download.assert_not_called()
+            self.assertEqual(self.read_local('cached_2.txt'), b'version 1')
+            self.assertEqual(os.stat('cached_2.txt').st_mtime, 1000000000)
+
+            self.write_remote('cached.txt', b'version 2!')
+            self.client.get(['cached.txt', 'cached_3.txt'])
+            download.assert_called_once()
+        self.assertEqual(self.read_local('cached_3.txt'), b'version 2!')
+        self.assertEqual(self.client.download_cache.stats()[0], 2)
+
+    def test_getm_cached_with_hash(self):
+        """Test that getm hits the cache and --hash still verifies the cached copies"""
+        for i in range(3):
+            self.write_remote('cached_m/m%d.txt' % i, b'm%d' % i)
+        paths = ['cached_m/m%d.txt' % i for i in range(3)]
+        self.client.getm(paths)
+        with patch.object(Transfer, 'download') as download:
+            self.client.getm(['--hash', 'sha256'] + paths)
+            download.assert_not_called()
+        for i in range(3):
+            self.assertEqual(self.read_local(os.path.join(DOWNLOADS_DIRECTORY, 'm%d.txt' % i)), b'm%d' % i)
+
+    def test_modified_download_not_served(self):
+        """Test that editing a (hardlinked) download in place invalidates the cached copy"""
+        remote = self.write_remote('cached_edit.txt', b'original')
+        os.utime(remote, (1000000000, 1000000000))
+        self.client.get(['cached_edit.txt', 'cached_edit_1.txt'])
+        with open('cached_edit_1.txt', 'r+b') as f:
+            f.write(b'ORIG')
+        self.client.get(['cached_edit.txt', 'cached_edit_2.txt'])
+        self.assertEqual(self.read_local('cached_edit_2.txt'), b'original')
+
+    def test_eviction(self):
+        """Test that the least recently used files are evicted once the size cap is exceeded"""
+        for i in range(4):
+            self.write_remote('cached_big%d.bin' % i, b'%d' % i * 4000)
+            self.client.get(['cached_big%d.bin' % i, 'cached_big%d.bin' % i])
+        entries, objects, used = self.client.download_cache.stats()
+        self.assertEqual((entries, objects, used), (2, 2, 8000))
+        self.assertEqual(len(os.listdir(self.client.download_cache.objects)), 2)
+        self.assertEqual(self.client.cache(['clear']), 'Download cache cleared')
+        self.assertEqual(self.client.download_cache.stats(), (0, 0, 0))
+
+    def test_dedupe(self):
+        """Test that with content_hash identical files at different paths share one object"""
+        cache = Cache.DownloadCache(self.cache_dir + '_dedupe', content_hash=True)
+        self.client.download_cache = cache
+        self.write_remote('cached_a.txt', b'same')
+        self.write_remote('cached_b.txt', b'same')
+        os.utime(self.server.local_path('cached_a.txt'), (1000000000, 1000000000))
+        os.utime(self.server.local_path('cached_b.txt'), (1200000000, 1200000000))
+        self.client.getm(['cached_a.txt', 'cached_b.txt'])
+        self.assertEqual(cache.stats(), (2, 1, 4))
+        with patch.object(Transfer, 'download_many') as download_many, \
+                patch.object(Transfer, 'download') as download:
+            self.client.getm(['cached_a.txt', 'cached_b.txt'])
+            download_many.assert_not_called()
+            download.assert_not_called()
+        for name in ('cached_a.txt', 'cached_b.txt'):
+            self.assertEqual(self.read_local(os.path.join(DOWNLOADS_DIRECTORY, name)), b'same')
+        self.assertEqual(cache.stats(), (2, 1, 4))
+
+
+class ModeChangeTestCase(unittest.TestCase):
+    """Octal and symbolic chmod modes"""
+
+    def test_octal(self):
+        self.assertEqual(Modes.ModeChange('755').new_mode(0o100600), 0o755)
+        self.assertTrue(Modes.ModeChange('0644').absolute)
+
+    def test_symbolic(self):
+        self.assertEqual(Modes.ModeChange('u+x,go-w').new_mode(0o100666), 0o744)
+        self.assertEqual(Modes.ModeChange('a=rX').new_mode(0o100644), 0o444)
+        self.assertEqual(Modes.ModeChange('a=rX').new_mode(0o040700, is_dir=True), 0o555)
+        self.assertEqual(Modes.ModeChange('+X').new_mode(0o100744), 0o755)
+        self.assertEqual(Modes.ModeChange('o+t,u+s').new_mode(0o040755, is_dir=True), 0o5755)
+
+    def test_invalid(self):
+        for text in ('q+z', '8', '7777 ', 'u+x,'):
+            with self.assertRaises(ValueError):
+                Modes.ModeChange(text)
+
+
+class ChmodTestCase(LocalServerTestCase):
+    """chmod -R and multi-path chmod pipeline their SETSTAT requests and skip unchanged entries"""
+    server_options = {'latency': 0.01}
+
+    def modes(self, root):
+        modes = {}
+        for directory, dirs, files in os.walk(root):
+            for name in dirs + files:
+                path = os.path.join(directory, name)
+                modes[os.path.relpath(path, root)] = stat.S_IMODE(os.lstat(path).st_mode)
+        return modes
+
+    def test_chmod_recursive(self):
+        """Test that every entry below the path is changed once, and a second run changes nothing"""
+        root = self.server.local_path('chmod_tree')
+        make_tree(root, 40)
+        os.makedirs(os.path.join(root, 'sub', 'deeper', 'deepest'))
+        for path in self.modes(root):
+            os.chmod(os.path.join(root, path), 0o700 if os.path.isdir(os.path.join(root, path)) else 0o600)
+        os.chmod(root, 0o700)
+        os.chmod(os.path.join(root, 'f0.txt'), 0o644)
+        result = self.sftp_client.chmod(['-R', 'u=rwX,go=rX', 'chmod_tree'])
+        self.assertEqual(result, ['chmod: 43 changed, 1 already u=rwX,go=rX, 0 failed'])
+        modes = self.modes(root)
+        self.assertEqual(modes['sub/deeper/deepest'], 0o755)
+        self.assertEqual(modes['sub/f1.txt'], 0o644)
+        self.assertEqual(stat.S_IMODE(os.stat(root).st_mode), 0o755)
+        self.assertEqual(self.sftp_client.chmod(['-R', '644', 'chmod_tree/sub/deeper']),
+                         ['chmod: 2 changed, 0 already 644, 0 failed'])
+        self.assertEqual(self.sftp_client.chmod(['-R', 'u=rwX,go=rX', 'chmod_tree'])[0],
+                         'chmod: 2 changed, 42 already u=rwX,go=rX, 0 failed')
+
+    def test_chmod_symlink_not_followed(self):
+        """Test that symbolic links met while walking are neither changed nor descended into"""
+        outside = self.write_remote('chmod_outside.txt', b'x')
+        os.chmod(outside, 0o600)
+        self.write_remote('chmod_links/a.txt', b'a')
+        os.symlink(outside, self.server.local_path('chmod_links/link'))
+        self.sftp_client.chmod(['-R', '644', 'chmod_links'])
+        self.assertEqual(stat.S_IMODE(os.stat(outside).st_mode), 0o600)
+        self.assertEqual(stat.S_IMODE(os.stat(self.server.local_path('chmod_links/a.txt')).st_mode), 0o644)
+
+    def test_chmod_multiple_paths(self):
+        """Test several paths in one command, with a missing one reported rather than raised"""
+        paths = [self.write_remote('chmod_multi_%d.txt' % i, b'x') for i in range(3)]
+        result = self.sftp_client.chmod(['o-r', 'chmod_multi_0.txt', 'chmod_missing.txt', 'chmod_multi_1.txt',
+                                         'chmod_multi_2.txt'])
+        self.assertEqual(result[0], 'chmod: 3 changed, 0 already o-r, 1 failed')
+        self.assertTrue(result[1].startswith('chmod_missing.txt: '))
+        for path in paths:
+            self.assertEqual(stat.S_IMODE(os.stat(path).st_mode) & 0o004, 0)
+
+    def test_chmod_octal(self):
+        """Test that the original "chmod <path> <mode>" form takes the mode as octal"""
+        path = self.write_remote('chmod_octal.txt', b'x')
+        self.sftp_client.chmod(['chmod_octal.txt', '751'])
+        self.assertEqual(stat.S_IMODE(os.stat(path).st_mode), 0o751)
+
+    def test_walk(self):
+        """Test that the concurrent walk lists every entry once, reporting unreadable directories"""
+        make_tree(self.server.local_path('walk_tree'), 10)
+        errors = []
+        entries = dict(Batch.walk(self.sftp_client.connection.sftp_client, 'walk_tree'))
+        self.assertEqual(sorted(entries), sorted(['walk_tree/sub'] + ['walk_tree/' + ('sub/' if i % 2 else '')
+                                                                       + 'f%d.txt' % i for i in range(10)]))
+        list(Batch.walk(self.sftp_client.connection.sftp_client, 'walk_missing', lambda p, e: errors.append(p)))
+        self.assertEqual(errors, ['walk_missing'])
+
+
+class BulkRemoveRenameTestCase(LocalServerTestCase):
+    """rm and rename act on many files, expanded from one listing per directory, with pipelined requests"""
+    server_options = {'latency': 0.01}
+
+    def test_rm_paths_and_patterns(self):
+        """Test that files and pattern matches are removed, and problems are reported per item"""
+        for name in ('bulk_rm/a.txt', 'bulk_rm/logs/1.log', 'bulk_rm/logs/2.log', 'bulk_rm/logs/keep.txt',
+                     'bulk_rm/logs/.hidden.log'):
+            self.write_remote(name, b'x')
+        result = self.sftp_client.rm(['bulk_rm/a.txt', 'bulk_rm/logs/*.log', 'bulk_rm/missing.txt', 'bulk_rm/l*'])
+        self.assertEqual(result[:4], ['bulk_rm/a.txt: removed', 'bulk_rm/logs: FAILED: Is a directory (use rmdir)',
+                                      'bulk_rm/logs/1.log: removed', 'bulk_rm/logs/2.log: removed'])
+        self.assertTrue(result[4].startswith('bulk_rm/missing.txt: FAILED: '))
+        self.assertEqual(result[5], '3 removed, 2 failed')
+        self.assertEqual(sorted(os.listdir(self.server.local_path('bulk_rm/logs'))), ['.hidden.log', 'keep.txt'])
+
+    def test_rm_dry_run(self):
+        """Test that -n lists the matches without removing them"""
+        make_tree(self.server.local_path('bulk_dry'), 4)
+        self.assertEqual(self.sftp_client.rm(['-n', 'bulk_dry/*/*.txt', 'bulk_dry/nothing*']),
+                         ['would remove bulk_dry/sub/f1.txt', 'would remove bulk_dry/sub/f3.txt',
+                          'bulk_dry/nothing*: FAILED: No match for bulk_dry/nothing*'])
+        self.assertTrue(os.path.exists(self.server.local_path('bulk_dry/sub/f1.txt')))
+
+    def test_rm_many(self):
+        """Test a directory that takes several READDIR replies to list"""
+        root = self.server.local_path('bulk_many')
+        os.makedirs(root)
+        for i in range(1000):
+            open(os.path.join(root, 'm%04d.tmp' % i), 'w').close()
+        self.assertEqual(self.sftp_client.rm(['bulk_many/*.tmp'])[-1], '1000 removed, 0 failed')
+        self.assertEqual(os.listdir(root), [])
+
+    def test_rename_regex(self):
+        """Test that regex renames replace the first match, using groups, in the given directory"""
+        for i in range(3):
+            self.write_remote('bulk_re/img%d.jpeg' % i, b'%d' % i)
+        self.write_remote('bulk_re/notes.txt', b'n')
+        result = self.sftp_client.rename(['-r', r'^img(\d)\.jpeg$', r'photo_\1.jpg', 'bulk_re'])
+        self.assertEqual(result, ['bulk_re/img0.jpeg -> bulk_re/photo_0.jpg: renamed',
+                                  'bulk_re/img1.jpeg -> bulk_re/photo_1.jpg: renamed',
+                                  'bulk_re/img2.jpeg -> bulk_re/photo_2.jpg: renamed', '3 renamed, 0 failed'])
+        self.assertEqual(sorted(os.listdir(self.server.local_path('bulk_re'))),
+                         ['notes.txt', 'photo_0.jpg', 'photo_1.jpg', 'photo_2.jpg'])
+
+    def test_rename_template(self):
+        """Test printf-style templates, dry runs, and that existing targets are not overwritten"""
+        for name in ('b.txt', 'a.txt', 'doc_2.txt'):
+            self.write_remote('bulk_t/' + name, name.encode())
+        self.assertEqual(self.sftp_client.rename(['-n', '-t', '?.txt', 'doc_%(n)d%(ext)s', 'bulk_t']),
+                         ['would rename bulk_t/a.txt -> bulk_t/doc_1.txt',
+                          'would rename bulk_t/b.txt -> bulk_t/doc_2.txt'])
+        result = self.sftp_client.rename(['-t', '?.txt', 'doc_%(n)d%(ext)s', 'bulk_t'])
+        self.assertEqual(result[0], 'bulk_t/a.txt -> bulk_t/doc_1.txt: renamed')
+        self.assertTrue(result[1].startswith('bulk_t/b.txt -> bulk_t/doc_2.txt: FAILED: '))
+        self.assertEqual(self.read_local(self.server.local_path('bulk_t/doc_2.txt')), b'doc_2.txt')
+        self.assertEqual(Batch.template_renames(['x.txt', 'y.txt'], '*', '%03d.txt'),
+                         [('x.txt', '001.txt'), ('y.txt', '002.txt')])
+
+    def test_rename_collisions(self):
+        """Test that renames onto each other's names are refused before anything is renamed"""
+        self.write_remote('bulk_c/a2', b'a')
+        self.write_remote('bulk_c/a3', b'b')
+        with self.assertRaises(TypeError):
+            self.sftp_client.rename(['-t', 'a?', 'a%d', 'bulk_c'])
+        with self.assertRaises(TypeError):
+            self.sftp_client.rename(['-r', '[0-9]', '', 'bulk_c'])
+        self.assertEqual(sorted(os.listdir(self.server.local_path('bulk_c'))), ['a2', 'a3'])
+
+
+class DirectoryCacheTestCase(LocalServerTestCase):
+    """put -t and mkdir -p remember the remote directories they have seen or created"""
+
+    def directory_requests(self, directories, func, *args):
+        """Run func, returning the STAT/MKDIR requests it made for any of directories"""
+        sftp = self.sftp_client.connection.sftp_client
+        with patch.object(sftp, 'stat', wraps=sftp.stat) as stat_:
+            with patch.object(sftp, 'mkdir', wraps=sftp.mkdir) as mkdir:
+                func(*args)
+        return ([c[0][0] for c in stat_.call_args_list if c[0][0] in directories]
+                + [c[0][0] for c in mkdir.call_args_list])
+
+    def test_put_target(self):
+        """Test that missing levels are created once and repeat uploads make no directory requests"""
+        for name in ('dc1.txt', 'dc2.txt'):
+            with open(name, 'wb') as f:
+                f.write(name.encode())
+        directories = ['dcache', 'dcache/a', 'dcache/a/b']
+        first = self.directory_requests(directories, self.sftp_client.put, ['-t', 'dcache/a/b', 'dc1.txt'])
+        self.assertEqual(first, ['dcache/a/b', 'dcache/a', 'dcache', 'dcache', 'dcache/a', 'dcache/a/b'])
+        repeat = self.directory_requests(directories, self.sftp_client.put,
+                                         ['-t', 'dcache/a/b', 'dc2.txt', '-t', 'dcache/a', 'dc1.txt'])
+        self.assertEqual(repeat, [])
+        self.assertEqual(self.read_local(self.server.local_path('dcache/a/b/dc2.txt')), b'dc2.txt')
+        self.assertEqual(self.read_local(self.server.local_path('dcache/a/dc1.txt')), b'dc1.txt')
+
+    def test_mkdir_parents(self):
+        """Test mkdir -p of an existing directory, a repeat, and recreation after rmdir"""
+        os.makedirs(self.server.local_path('dexisting/x'))
+        self.assertEqual(self.directory_requests(['dexisting/x'], self.sftp_client.mkdir, ['-p', 'dexisting/x']),
+                         ['dexisting/x'])
+        self.assertEqual(self.directory_requests(['dexisting', 'dexisting/x'], self.sftp_client.mkdir,
+                                                 ['-p', 'dexisting']), [])
+        self.sftp_client.rmdir(['dexisting'])
+        self.sftp_client.mkdir(['dexisting/x/y'])
+        self.assertTrue(os.path.isdir(self.server.local_path('dexisting/x/y')))
+
+    def test_mkdir_parents_file(self):
+        """Test that a file in the way is reported"""
+        self.write_remote('dfile', b'x')
+        with self.assertRaises(IOError):
+            self.sftp_client.mkdir(['-p', 'dfile/sub'])
+
+
+class PutSegmentsTestCase(LocalServerTestCase):
+    """put --segments writes byte ranges of one file concurrently over several channels"""
+
+    def put_segments(self, name, data, segments, target=None):
+        with open(name, 'wb') as f:
+            f.write(data)
+        os.utime(name, (1000000000, 1000000000))
+        with patch.object(Transfer, '_put_segment', wraps=Transfer._put_segment) as put_segment:
+            self.sftp_client.put((['-t', target] if target else []) + ['--segments', str(segments), name])
+        return put_segment.call_count
+
+    def test_put_segments(self):
+        """Test that the segments reassemble the file, and the mtime is restored"""
+        data = os.urandom(3 * Transfer.MIN_SEGMENT_SIZE + 12345)
+        self.assertEqual(self.put_segments('segments.bin', data, 8), 3)
+        remote = self.server.local_path('segments.bin')
+        self.assertEqual(self.read_local(remote), data)
+        self.assertEqual(int(os.stat(remote).st_mtime), 1000000000)
+
+    def test_put_segments_over_existing(self):
+        """Test that a longer existing remote file is truncated, in a target directory"""
+        self.write_remote('segments_dir/over.bin', b'x' * (3 * 1024 * 1024))
+        data = os.urandom(1024 * 1024 + 5)
+        with patch.object(Transfer, 'MIN_SEGMENT_SIZE', 256 * 1024):
+            self.assertEqual(self.put_segments('over.bin', data, 3, 'segments_dir'), 3)
+        self.assertEqual(self.read_local(self.server.local_path('segments_dir/over.bin')), data)
+
+    def test_put_segments_relative_to_cwd(self):
+        """Test that the extra channels write to the working directory of the session"""
+        os.makedirs(self.server.local_path('segments_cwd'), exist_ok=True)
+        self.sftp_client.cd([self.server.local_path('segments_cwd')])
+        self.addCleanup(self.sftp_client.cd, [self.server.root])
+        data = os.urandom(600000)
+        with patch.object(Transfer, 'MIN_SEGMENT_SIZE', 100000):
+            self.assertEqual(self.put_segments('cwd.bin', data, 2), 2)
+        self.assertEqual(self.read_local(self.server.local_path('segments_cwd/cwd.bin')), data)
+
+    def test_put_segments_small_file(self):
+        """Test that a file too small to split is uploaded in one piece"""
+        self.assertEqual(self.put_segments('small_segments.bin', b'small', 4), 0)
+        self.assertEqual(self.read_local(self.server.local_path('small_segments.bin')), b'small')
+
+    def test_put_segments_with_hash(self):
+        with open('segments_hash.bin', 'wb') as f:
+            f.write(b'x')
+        with self.assertRaises(TypeError):
+            self.sftp_client.put(['--segments', '2', '--hash', 'sha256', 'segments_hash.bin'])
+        with self.assertRaises(TypeError):
+            self.sftp_client.put(['--segments', 'many', 'segments_hash.bin'])
+
+
+def simulate_link(flow, bandwidth, rtt, duration):
+    """Run a transfer through flow over a simulated link, returning the bytes delivered
+
+        Requests queue at a bottleneck of the given bandwidth (bytes/second), and each reply
+        arrives rtt seconds after its request has passed it.
+    """
+    clock = [0.0]
+    replies = []
+    link_free = 0.0
+    with patch.object(Flow.time, 'monotonic', lambda: clock[0]):
+        while clock[0] < duration:
+            while len(replies) < flow.in_flight:
+                length = flow.block_size
+                token = flow.sent(length)
+                link_free = max(link_free, clock[0]) + length / float(bandwidth)
+                replies.append((link_free + rtt, token, length))
+            replies.sort(key=lambda reply: reply[0])
+            clock[0], token, length = replies.pop(0)
+            flow.received(token, length)
+    return flow.delivered
+
+
+class FlowControllerTestCase(unittest.TestCase):
+    """The flow controller sizes the window from the measured bandwidth and RTT"""
+
+    def test_converges_to_bandwidth_delay_product(self):
+        """Test that a long fat link is filled without queueing much more than GAIN times its BDP"""
+        flow = Flow.FlowController(Transfer.MAX_REQUEST_SIZE)
+        delivered = simulate_link(flow, 20e6, 0.1, 10)
+        self.assertEqual(flow.state, 'steady')
+        self.assertGreater(delivered, 0.9 * 20e6 * 10)
+        self.assertAlmostEqual(flow.bandwidth / 20e6, 1, delta=0.1)
+        self.assertLessEqual(flow.window, 1.2 * Flow.GAIN * 20e6 * flow.min_rtt)
+        self.assertEqual(flow.block_size, 128 * 1024)
+
+    def test_slow_link(self):
+        """Test that a slow link gets small requests and a window of a few round trips"""
+        flow = Flow.FlowController(Transfer.MAX_REQUEST_SIZE)
+        delivered = simulate_link(flow, 1e6, 0.05, 10)
+        self.assertGreater(delivered, 0.9 * 1e6 * 10)
+        self.assertLess(flow.window, Flow.INITIAL_WINDOW)
+        self.assertLess(flow.block_size, Transfer.REQUEST_SIZE)
+
+    def test_min_rtt_probe(self):
+        """Test that the RTT is measured again once MIN_RTT_EXPIRY has passed"""
+        flow = Flow.FlowController(Transfer.MAX_REQUEST_SIZE)
+        states = []
+        original = flow._end_round
+
+        def end_round(now):
+            original(now)
+            states.append(flow.state)
+        flow._end_round = end_round
+        simulate_link(flow, 5e6, 0.02, Flow.MIN_RTT_EXPIRY + 5)
+        self.assertIn('probe rtt', states)
+        self.assertEqual(states[-1], 'steady')
+        self.assertAlmostEqual(flow.min_rtt, 0.02, delta=0.005)
+
+    def test_fixed(self):
+        """Test that a controller given in_flight never changes"""
+        flow = Flow.FlowController(Transfer.REQUEST_SIZE, in_flight=8)
+        simulate_link(flow, 10e6, 0.02, 2)
+        self.assertEqual((flow.block_size, flow.in_flight), (Transfer.REQUEST_SIZE, 8))
+
+    def test_limit_block_size(self):
+        flow = Flow.FlowController(Transfer.MAX_REQUEST_SIZE)
+        flow.limit_block_size(20000)
+        simulate_link(flow, 100e6, 0.05, 2)
+        self.assertEqual(flow.block_size, 20000)
+
+
+class RequestSizeTestCase(LocalServerTestCase):
+    """Request sizes follow "limits@openssh.com" and the length of the server's READ replies"""
+    server_options = {'extensions': {'limits@openssh.com': '1'}, 'max_read_length': 100000}
+
+    def test_server_limits(self):
+        self.assertEqual(Transfer.server_limits(self.sftp_client.connection.sftp_client), (100000, 255 * 1024))
+
+    def test_put_large_writes(self):
+        """Test that WRITEs grow past REQUEST_SIZE when the server allows it"""
+        data = os.urandom(8 * 1024 * 1024)
+        with open('large_writes.bin', 'wb') as f:
+            f.write(data)
+        transport = self.sftp_client.connection.sftp_client.get_channel().get_transport()
+        sftp = paramiko.SFTPClient.from_transport(transport)
+        self.addCleanup(sftp.close)
+        # start with a window large enough for the largest requests
+        with patch.object(Flow, 'INITIAL_WINDOW', Flow.MAX_WINDOW):
+            Transfer.mmap_put(sftp, 'large_writes.bin', 'large_writes.bin')
+        self.assertEqual(self.read_local(self.server.local_path('large_writes.bin')), data)
+        self.assertEqual(self.server.largest_write, 255 * 1024)
+
+    def test_get_short_reads(self):
+        """Test that READs answered with less data are completed and capped at what the server returns"""
+        data = os.urandom(3 * 1024 * 1024 + 7)
+        self.write_remote('short_reads.bin', data)
+        transport = self.sftp_client.connection.sftp_client.get_channel().get_transport()
+        sftp = paramiko.SFTPClient.from_transport(transport)
+        self.addCleanup(sftp.close)
+        # as if the server did not report its limits, and the window had grown to the largest requests
+        with patch.object(Transfer, 'server_limits', return_value=(Transfer.MAX_REQUEST_SIZE, Transfer.REQUEST_SIZE)):
+            flow = Transfer.flow_controller(sftp, 'read')
+        flow.block_size = Transfer.MAX_REQUEST_SIZE
+        Transfer.download(sftp, 'short_reads.bin', 'short_reads.bin')
+        self.assertEqual(self.read_local('short_reads.bin'), data)
+        self.assertEqual(flow.max_block_size, 100000)
+
+
+class TokenBucketTestCase(unittest.TestCase):
+    """Rates parse with binary units, and a token bucket holds a flow to its rate after the burst"""
+
+    def test_parse_rate(self):
+        self.assertEqual(Throttle.parse_rate('500K'), 500 * 1024)
+        self.assertEqual(Throttle.parse_rate('1.5MB/s'), 1536 * 1024)
+        self.assertEqual(Throttle.parse_rate('4096'), 4096)
+        for text in ('fast', '0', '-1M', '20T'):
+            with self.assertRaises(ValueError):
+                Throttle.parse_rate(text)
+
+    def test_format_rate(self):
+        self.assertEqual(Throttle.format_rate(20 * 1024 * 1024), '20M/s')
+        self.assertEqual(Throttle.format_rate(1536 * 1024), '1.5M/s')
+        self.assertEqual(Throttle.format_rate(100), '100/s')
+
+    def test_consume(self):
+        """Test that 1 MB through a 1 MB/s bucket takes as long as what exceeds the burst"""
+        bucket = Throttle.TokenBucket(1024 * 1024)
+        self.assertEqual(bucket.burst, Transfer.MAX_REQUEST_SIZE)
+        start = time.monotonic()
+        for _ in range(4):
+            bucket.consume(256 * 1024)
+        self.assertGreaterEqual(time.monotonic() - start, 0.7)
+
+    def test_set_rate(self):
+        """Test that a transfer's admit() follows the session-wide limit set after it started"""
+        scheduler = Throttle.Scheduler()
+        admit = scheduler.throttle()
+        start = time.monotonic()
+        admit(4 * 1024 * 1024)
+        self.assertLess(time.monotonic() - start, 0.1)
+        scheduler.set_rate(1024 * 1024)
+        start = time.monotonic()
+        for _ in range(4):
+            admit(256 * 1024)
+        self.assertGreaterEqual(time.monotonic() - start, 0.7)
+        scheduler.set_rate(None)
+        self.assertIsNone(scheduler.rate)
+
+class ThrottleTestCase(LocalServerTestCase):
+    """--limit and the limit command pace the data of transfers"""
+
+    def test_get_limit(self):
+        """Test that a 768 KB download limited to 1 MB/s takes at least the half second past the burst"""
+        data = os.urandom(768 * 1024)
+        self.write_remote('limited.bin', data)
+        start = time.monotonic()
+        self.sftp_client.get(['--limit', '1M', 'limited.bin', 'limited.bin'])
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+        self.assertEqual(self.read_local('limited.bin'), data)
+
+    def test_session_limit(self):
+        """Test that the limit command paces put, and can be shown and removed"""
+        self.addCleanup(self.sftp_client.limit, ['off'])
+        self.assertEqual(self.sftp_client.limit(['1M']), 'limit: 1M/s')
+        data = os.urandom(768 * 1024)
+        with open('session_limited.bin', 'wb') as f:
+            f.write(data)
+        start = time.monotonic()
+        self.sftp_client.put(['session_limited.bin'])
+        self.assertGreaterEqual(time.monotonic() - start, 0.45)
+        self.assertEqual(self.read_local(self.server.local_path('session_limited.bin')), data)
+        self.assertEqual(self.sftp_client.limit(['off']), 'limit: off')
+        self.assertEqual(self.sftp_client.limit([]), 'limit: off')
+
+    def test_cp_limit(self):
+        """Test that a limited cp copies the tree through the paced transfers"""
+        self.write_remote('cp_limited/a.txt', b'a' * 1000)
+        self.write_remote('cp_limited/sub/b.txt', b'b' * 2000)
+        self.sftp_client.cp(['--limit', '10M', 'cp_limited', 'cp_limited_copy'])
+        self.assertEqual(self.read_local(self.server.local_path('cp_limited_copy/a.txt')), b'a' * 1000)
+        self.assertEqual(self.read_local(self.server.local_path('cp_limited_copy/sub/b.txt')), b'b' * 2000)
+
+
+class BatchTransferTestCase(LocalServerTestCase):
+    """getm and multi-file put send their files over one pipeline, opening the next ones ahead"""
+    server_options = {'latency': 0.02}
+
+    def test_getm_batch(self):
+        """Test that many files, including an empty one, arrive without a round trip per file step"""
+        files = {'batch_get/f%d.bin' % i: os.urandom(i * 7000) for i in range(20)}
+        for name, data in files.items():
+            self.write_remote(name, data)
+        start = time.monotonic()
+        with patch.object(Transfer, 'download_many', wraps=Transfer.download_many) as download_many:
+            self.sftp_client.getm(sorted(files))
+        # stat, open, read and close one after another would take at least 20 * 4 round trips
+        self.assertLess(time.monotonic() - start, 20 * 4 * 0.02)
+        self.assertEqual(download_many.call_count, 1)
+        for name, data in files.items():
+            self.assertEqual(self.read_local(os.path.join(DOWNLOADS_DIRECTORY, os.path.basename(name))), data)
+        self.assertEqual([name for name in os.listdir(DOWNLOADS_DIRECTORY) if name.endswith('.part')], [])
+
+    def test_getm_missing_file(self):
+        """Test that a path that is not a file is reported before anything is transferred"""
+        self.write_remote('batch_missing/a.bin', b'a')
+        with self.assertRaises(IOError):
+            self.sftp_client.getm(['batch_missing/a.bin', 'batch_missing/absent.bin'])
+        self.assertFalse(os.path.exists(os.path.join(DOWNLOADS_DIRECTORY, 'absent.bin')))
+
+    def write_files(self, prefix, count, size):
+        files = {prefix + '%d.bin' % i: os.urandom(i * size) for i in range(count)}
+        for name, data in files.items():
+            with open(name, 'wb') as f:
+                f.write(data)
+            os.utime(name, (1000000000, 1000000000))
+        return files
+
+    def test_put_batch(self):
+        """Test that many files, including an empty one, are uploaded intact with their mtimes"""
+        files = self.write_files('batch_put_', 20, 9000)
+        start = time.monotonic()
+        with patch.object(Transfer, 'put_many', wraps=Transfer.put_many) as put_many:
+            self.sftp_client.put(['-t', 'batch_put'] + sorted(files))
+        # open, write, close, stat and utime one after another would take at least 20 * 4 round trips
+        self.assertLess(time.monotonic() - start, 20 * 4 * 0.02)
+        self.assertEqual(put_many.call_count, 1)
+        for name, data in files.items():
+            remote = self.server.local_path('batch_put/' + name)
+            self.assertEqual(self.read_local(remote), data)
+            self.assertEqual(int(os.stat(remote).st_mtime), 1000000000)
+
+    def test_put_batch_hash(self):
+        """Test that every file of a batch is verified and recorded in the manifest"""
+        files = self.write_files('batch_hash_', 3, 5000)
+        self.sftp_client.put(['--hash', 'sha256'] + sorted(files))
+        with open(MANIFEST_FILE) as manifest:
+            recorded = manifest.read()
+        self.assertTrue(all('\tverified\t' + name in recorded for name in files))
+
+    def test_put_batch_missing_file(self):
+        """Test that the files before a missing one are still uploaded"""
+        with open('batch_before.bin', 'wb') as f:
+            f.write(b'before')
+        with self.assertRaises(FileNotFoundError):
+            self.sftp_client.put(['batch_before.bin', 'batch_absent.bin'])
+        self.assertEqual(self.read_local(self.server.local_path('batch_before.bin')), b'before')
+
+
+class DiffTestCase(LocalServerTestCase):
+    """diff walks a local and a remote tree at the same time and lists what differs"""
+
+    def make_trees(self, name, local_files, remote_files):
+        """Create name/ locally and on the server from dicts of path -> bytes (None for a directory)"""
+        for root, files in ((name, local_files), (self.server.local_path(name), remote_files)):
+            os.makedirs(root, exist_ok=True)
+            for path, data in files.items():
+                path = os.path.join(root, path)
+                if data is None:
+                    os.makedirs(path, exist_ok=True)
+                    continue
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(data)
+                os.utime(path, (1000000000, 1000000000))
+
+    def test_diff(self):
+        """Test that added, removed and changed paths are reported by their reason"""
+        self.make_trees('diff_tree',
+                        {'same.txt': b'same', 'size.txt': b'longer', 'mtime.txt': b'mtime', 'new/a.txt': b'a',
+                         'kind': b'file', 'sub/kept.txt': b'kept'},
+                        {'same.txt': b'same', 'size.txt': b'short', 'mtime.txt': b'mtime', 'gone.txt': b'gone',
+                         'kind': None, 'sub/kept.txt': b'kept', 'sub/old/b.txt': b'b'})
+        os.utime('diff_tree/mtime.txt', (1000000100, 1000000100))
+        result = self.sftp_client.diff(['diff_tree', 'diff_tree'])
+        self.assertEqual(sorted(result[:-1]), ['added new', 'added new/a.txt', 'changed kind (type)',
+                                               'changed mtime.txt (mtime)', 'changed size.txt (size)',
+                                               'removed gone.txt', 'removed sub/old', 'removed sub/old/b.txt'])
+        self.assertEqual(result[-1], '2 added, 3 removed, 3 changed')
+
+    def test_diff_checksum(self):
+        """Test that --checksum finds same-sized files with other contents, and ignores the mtime"""
+        self.make_trees('diff_checksum', {'edited.txt': b'abcd', 'touched.txt': b'same'},
+                        {'edited.txt': b'abce', 'touched.txt': b'same'})
+        os.utime('diff_checksum/touched.txt', (1000000100, 1000000100))
+        self.assertEqual(self.sftp_client.diff(['diff_checksum', 'diff_checksum'])[:-1],
+                         ['changed touched.txt (mtime)'])
+        self.assertEqual(self.sftp_client.diff(['--checksum', 'diff_checksum', 'diff_checksum'])[:-1],
+                         ['changed edited.txt (checksum)'])
+
+    def test_checksum_without_server_digests(self):
+        """Test that files are read to hash them when the server cannot"""
+        self.make_trees('diff_read', {'edited.txt': b'abcd', 'same.txt': b'same'},
+                        {'edited.txt': b'abce', 'same.txt': b'same'})
+        with patch.object(Integrity, 'remote_digests', return_value={}), \
+                patch.object(Integrity, 'remote_digest', return_value=None):
+            changes = list(Diff.compare(self.sftp_client.connection, 'diff_read', 'diff_read', 'sha256'))
+        self.assertEqual([(change.status, change.path, change.reason) for change in changes],
+                         [('changed', 'edited.txt', 'checksum')])
+
+    def test_remote_digests(self):
+        """Test that one command hashes several files, including names that need quoting"""
+        self.write_remote('digests/a b.txt', b'a')
+        self.write_remote('digests/c.txt', b'c')
+        paths = ['digests/a b.txt', 'digests/c.txt', 'digests/missing.txt']
+        digests = Integrity.remote_digests(self.sftp_client.connection, paths, 'sha256')
+        self.assertEqual(digests, {'digests/a b.txt': hashlib.sha256(b'a').hexdigest(),
+                                   'digests/c.txt': hashlib.sha256(b'c').hexdigest()})
+
+
+class MirrorTestCase(LocalServerTestCase):
+    """mirror push|pull keeps a manifest of the last sync and only lists directories that changed since"""
+
+    def make_tree(self, root, files):
+        """Create root/ from a dict of path -> bytes, every file with an mtime of 1000000000"""
+        for path, data in files.items():
+            path = os.path.join(root, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'wb') as f:
+                f.write(data)
+            os.utime(path, (1000000000, 1000000000))
+
+    def test_push(self):
+        """Test that a second push lists no directory, and later ones only send what changed"""
+        self.make_tree('mirror_push', {'a.txt': b'a', 'sub/b.txt': b'b', 'sub/deep/c.txt': b'c', 'other/d.txt': b'd'})
+        result = self.sftp_client.mirror(['push', 'mirror_push', 'mirror_push'])
+        self.assertEqual(result[-1], '4 uploaded, 4 created, 0 deleted, 0 failed; 4 directories listed of 4')
+        self.assertEqual(self.read_local(self.server.local_path('mirror_push/sub/deep/c.txt')), b'c')
+        self.assertEqual(os.stat(self.server.local_path('mirror_push/sub/b.txt')).st_mtime, 1000000000)
+
+        result = self.sftp_client.mirror(['push', 'mirror_push', 'mirror_push'])
+        self.assertEqual(result, ['0 uploaded, 0 created, 0 deleted, 0 failed; 0 directories listed of 4'])
+
+        self.make_tree('mirror_push', {'sub/new.txt': b'new'})
+        os.remove('mirror_push/other/d.txt')
+        result = self.sftp_client.mirror(['push', '--delete', 'mirror_push', 'mirror_push'])
+        self.assertEqual(result, ['other/d.txt: deleted', 'sub/new.txt: uploaded',
+                                  '1 uploaded, 0 created, 1 deleted, 0 failed; 2 directories listed of 4'])
+        self.assertFalse(os.path.exists(self.server.local_path('mirror_push/other/d.txt')))
+        self.assertEqual(self.sftp_client.mirror(['push', 'mirror_push', 'mirror_push'])[-1],
+                         '0 uploaded, 0 created, 0 deleted, 0 failed; 0 directories listed of 4')
+
+    def test_full(self):
+        """Test that a file edited in place is found by --full, and that -n changes nothing"""
+        self.make_tree('mirror_full', {'sub/edited.txt': b'old'})
+        self.sftp_client.mirror(['push', 'mirror_full', 'mirror_full'])
+        self.make_tree('mirror_full', {'sub/edited.txt': b'newer'})
+        self.assertEqual(self.sftp_client.mirror(['push', 'mirror_full', 'mirror_full'])[-1],
+                         '0 uploaded, 0 created, 0 deleted, 0 failed; 0 directories listed of 2')
+        self.assertEqual(self.sftp_client.mirror(['push', '-n', '--full', 'mirror_full', 'mirror_full'])[0],
+                         'sub/edited.txt: uploaded')
+        self.assertEqual(self.read_local(self.server.local_path('mirror_full/sub/edited.txt')), b'old')
+        self.sftp_client.mirror(['push', '--full', 'mirror_full', 'mirror_full'])
+        self.assertEqual(self.read_local(self.server.local_path('mirror_full/sub/edited.txt')), b'newer')
+
+    def test_pull(self):
+        """Test that pull follows remote changes, and replaces a file by a directory only with --delete"""
+        remote = self.server.local_path('mirror_pull')
+        self.make_tree(remote, {'a.txt': b'a', 'kind': b'file', 'sub/b.txt': b'b'})
+        self.sftp_client.mirror(['pull', 'local_pull', 'mirror_pull'])
+        self.assertEqual(self.read_local('local_pull/sub/b.txt'), b'b')
+
+        os.remove(os.path.join(remote, 'kind'))
+        self.make_tree(remote, {'kind/c.txt': b'c', 'sub/b.txt': b'bb'})
+        # directory mtimes on the server move in whole seconds
+        os.utime(remote, (1000000100, 1000000100))
+        os.utime(os.path.join(remote, 'sub'), (1000000100, 1000000100))
+        result = self.sftp_client.mirror(['pull', 'local_pull', 'mirror_pull'])
+        self.assertEqual(result[:2], ['kind: FAILED: the destination is a file, use --delete to replace it',
+                                      'sub/b.txt: downloaded'])
+        self.assertEqual(self.read_local('local_pull/sub/b.txt'), b'bb')
+        result = self.sftp_client.mirror(['pull', '--delete', 'local_pull', 'mirror_pull'])
+        self.assertEqual(result, ['kind: deleted', 'kind: created', 'kind/c.txt: downloaded',
+                                  '1 downloaded, 1 created, 1 deleted, 0 failed; 3 directories listed of 3'])
+        self.assertEqual(self.read_local('local_pull/kind/c.txt'), b'c')
+
+
+class WatchTestCase(LocalServerTestCase):
+    """watch pushes a local tree, then every batch of changes made to it"""
+
+    def start(self, name, **options):
+        """Watch name/ into the remote name/; returns the stop event and the iterator of pushes"""
+        os.makedirs(os.path.join(name, 'sub'))
+        with open(os.path.join(name, 'sub', 'first.txt'), 'wb') as f:
+            f.write(b'first')
+        stop = threading.Event()
+        manifest = Mirror.Manifest()
+        self.addCleanup(manifest.close)
+        pushes = Watch.watch(self.sftp_client.connection.sftp_client, manifest, 'watch', os.path.abspath(name),
+                             self.server.local_path(name), stop, debounce=0.3, **options)
+        self.addCleanup(pushes.close)
+        self.assertEqual([(result.action, result.path) for result in next(pushes)],
+                         [('created', ''), ('created', 'sub'), ('uploaded', 'sub/first.txt')])
+        return stop, pushes
+
+    def check_pushes(self, name, pushes):
+        """Test that edits, new directories and deletes arrive as one push each"""
+        with open(os.path.join(name, 'sub', 'first.txt'), 'ab') as f:
+            f.write(b' edited')
+        self.assertEqual([(result.action, result.path) for result in next(pushes)], [('uploaded', 'sub/first.txt')])
+        self.assertEqual(self.read_local(self.server.local_path(name + '/sub/first.txt')), b'first edited')
+
+        os.makedirs(os.path.join(name, 'new', 'deeper'))
+        for path in ('new/a.txt', 'new/deeper/b.txt'):
+            with open(os.path.join(name, path), 'wb') as f:
+                f.write(b'new')
+        self.assertEqual([(result.action, result.path) for result in next(pushes)],
+                         [('created', 'new'), ('uploaded', 'new/a.txt'), ('created', 'new/deeper'),
+                          ('uploaded', 'new/deeper/b.txt')])
+
+        os.remove(os.path.join(name, 'new', 'a.txt'))
+        self.assertEqual([(result.action, result.path) for result in next(pushes)], [('deleted', 'new/a.txt')])
+        self.assertFalse(os.path.exists(self.server.local_path(name + '/new/a.txt')))
+
+    def test_inotify(self):
+        """Test that inotify events are pushed, and that the watch ends once stopped"""
+        stop, pushes = self.start('watch_inotify', delete=True)
+        self.check_pushes('watch_inotify', pushes)
+        stop.set()
+        self.assertEqual(list(pushes), [])
+
+    def test_polling(self):
+        """Test that the polling fallback finds the same changes"""
+        _stop, pushes = self.start('watch_poll', delete=True, poll=True, interval=0.2)
+        self.check_pushes('watch_poll', pushes)
+
+    def test_watch_command(self):
+        """Test that the command returns what it pushed once interrupted"""
+        os.makedirs('watch_command')
+        with open('watch_command/a.txt', 'wb') as f:
+            f.write(b'a')
+        threading.Timer(1.0, self.sftp_client.interrupted.set).start()
+        self.assertEqual(self.sftp_client.watch(['watch_command', 'watch_command']),
+                         'watch: 1 uploaded, 1 created, 0 deleted, 0 failed')
+        self.assertEqual(self.read_local(self.server.local_path('watch_command/a.txt')), b'a')
+
+
+class PeekTestCase(LocalServerTestCase):
+    """cat, head and tail read only the parts of a remote file they print"""
+
+    LINES = b''.join(b'line %d\n' % number for number in range(1, 20001))
+
+    def read_bytes(self):
+        """Patch Transfer.read_pipelined, returning the list the bytes of every read are counted into"""
+        counted = []
+        read_pipelined = Transfer.read_pipelined
+
+        def counting(sftp, handle, size, write, in_flight=None, ranges=None, throttle=None):
+            counted.append(sum(length for _offset, length in ranges))
+            return read_pipelined(sftp, handle, size, write, in_flight, ranges, throttle)
+
+        patcher = patch.object(Transfer, 'read_pipelined', counting)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return counted
+
+    def test_cat(self):
+        """Test that cat returns the lines of the whole file, read window by window"""
+        self.write_remote('peek_cat.txt', self.LINES)
+        with patch.object(Peek, 'CAT_WINDOW', 10000):
+            self.assertEqual(list(self.sftp_client.cat([self.server.local_path('peek_cat.txt')])),
+                             self.LINES.decode().splitlines())
+
+    def test_head(self):
+        """Test that head stops reading once it has the lines"""
+        counted = self.read_bytes()
+        path = self.write_remote('peek_head.txt', self.LINES)
+        self.assertEqual(self.sftp_client.head([path]), ['line %d' % number for number in range(1, 11)])
+        self.assertEqual(self.sftp_client.head(['-n', '2', path]), ['line 1', 'line 2'])
+        self.assertEqual(self.sftp_client.head(['-c', '9', path]), 'line 1\nli')
+        self.assertEqual(self.sftp_client.head(['-n', '0', path]), [])
+        self.assertLessEqual(sum(counted), 3 * Peek.BLOCK_SIZE)
+
+    def test_tail(self):
+        """Test that tail reads backwards only as far as its lines, across block boundaries"""
+        counted = self.read_bytes()
+        path = self.write_remote('peek_tail.txt', self.LINES)
+        self.assertEqual(self.sftp_client.tail([path]), ['line %d' % number for number in range(19991, 20001)])
+        self.assertLessEqual(sum(counted), Peek.BLOCK_SIZE)
+        with patch.object(Peek, 'BLOCK_SIZE', 16):
+            self.assertEqual(self.sftp_client.tail(['-n', '3', path]), ['line 19998', 'line 19999', 'line 20000'])
+        self.assertEqual(self.sftp_client.tail(['-c', '6', path]), '20000\n')
+        self.assertEqual(self.sftp_client.tail(['-n', '0', path]), [])
+        self.assertEqual(len(self.sftp_client.tail(['-n', '30000', path])), 20000)
+
+        path = self.write_remote('peek_tail_unterminated.txt', b'one\ntwo\n\nthree')
+        self.assertEqual(self.sftp_client.tail(['-n', '2', path]), ['', 'three'])
+        self.assertEqual(self.sftp_client.tail(['-n', '4', path]), ['one', 'two', '', 'three'])
+
+    def test_follow(self):
+        """Test that tail -f prints what is appended, and starts over when the file is truncated"""
+        path = self.write_remote('peek_follow.txt', b'old\nlast\n')
+        stop = threading.Event()
+        written = []
+        follower = threading.Thread(target=lambda: written.extend(
+            Peek.follow(self.sftp_client.connection.sftp_client, path, 9, stop, 0.05)))
+        follower.start()
+        with open(path, 'ab') as f:
+            f.write(b'appended\n')
+        time.sleep(0.3)
+        with open(path, 'wb') as f:
+            f.write(b'new\n')
+        time.sleep(0.3)
+        stop.set()
+        follower.join()
+        self.assertEqual(b''.join(written), b'appended\nnew\n')
+
+    def test_tail_follow_command(self):
+        """Test that the command returns the last lines and what follows until interrupted"""
+        path = self.write_remote('peek_follow_command.txt', b'one\ntwo\n')
+
+        def append():
+            with open(path, 'ab') as f:
+                f.write(b'three\n')
+
+        threading.Timer(0.5, append).start()
+        threading.Timer(2.5, self.sftp_client.interrupted.set).start()
+        self.assertEqual(list(self.sftp_client.tail(['-f', '-n', '1', path])), ['two', 'three'])
+
+
+class LineMatcherTestCase(unittest.TestCase):
+    """LineMatcher finds the same lines however the stream is split into blocks"""
+
+    DATA = b'alpha\nbeta gamma\n\nalphabet\nno\n' + b'x' * 100 + b'alpha\nlast alpha'
+
+    def matches(self, pattern, blocks, max_line=1000):
+        matcher = Grep.LineMatcher(re.compile(pattern, re.MULTILINE), max_line)
+        for block in blocks:
+            matcher.feed(block)
+        matcher.finish()
+        return matcher.matches
+
+    def test_split_lines(self):
+        """Test that lines spanning block boundaries are matched once, with their line numbers"""
+        expected = [(1, b'alpha'), (4, b'alphabet'), (6, b'x' * 100 + b'alpha'), (7, b'last alpha')]
+        self.assertEqual(self.matches(b'alpha', [self.DATA]), expected)
+        for size in (1, 2, 3, 7, 64):
+            blocks = [self.DATA[start:start + size] for start in range(0, len(self.DATA), size)]
+            self.assertEqual(self.matches(b'alpha', blocks), expected)
+
+    def test_anchors_and_line_ends(self):
+        """Test that anchors work per line and matches may not run on into the next line"""
+        self.assertEqual(self.matches(b'^alpha$', [self.DATA]), [(1, b'alpha')])
+        self.assertEqual(self.matches(b'gamma\\s+alphabet', [self.DATA]), [])
+        self.assertEqual(self.matches(b'^$', [self.DATA]), [(3, b'')])
+
+    def test_long_line(self):
+        """Test that only the start of a line longer than max_line is kept and searched"""
+        self.assertEqual(self.matches(b'x+', [self.DATA[:60], self.DATA[60:]], max_line=10), [(6, b'x' * 10)])
+        self.assertEqual(self.matches(b'x+alpha', [self.DATA], max_line=10), [])
+
+
+class GrepTestCase(LocalServerTestCase):
+    """grep streams remote files through LineMatchers, or runs grep on the server"""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.root = cls.server.local_path('grep_tree')
+        for name, data in (('a.log', b'start\nerror: one\nok\n'),
+                           ('sub/b.log', b'ok\n' * 50000 + b'error: two\nERROR: three'),
+                           ('sub/deeper/c.log', b'nothing here\n')):
+            os.makedirs(os.path.dirname(os.path.join(cls.root, name)), exist_ok=True)
+            with open(os.path.join(cls.root, name), 'wb') as f:
+                f.write(data)
+
+    def expected(self, *names):
+        lines = {'a.log': ['a.log:2:error: one'], 'sub/b.log': ['sub/b.log:50001:error: two'],
+                 'sub/b.log -i': ['sub/b.log:50001:error: two', 'sub/b.log:50002:ERROR: three']}
+        return [self.root + '/' + line for name in names for line in lines[name]]
+
+    def test_files(self):
+        """Test that several files are searched and reported in the order given"""
+        with patch.object(Grep, 'FILES_AT_ONCE', 1):
+            self.assertEqual(self.sftp_client.grep(['error', self.root + '/sub/b.log', self.root + '/a.log']),
+                             self.expected('sub/b.log', 'a.log'))
+        self.assertEqual(self.sftp_client.grep(['-i', 'error', self.root + '/a.log', self.root + '/sub/b.log']),
+                         self.expected('a.log', 'sub/b.log -i'))
+
+    def test_recursive(self):
+        """Test that -r searches every file below a directory, and directories need it"""
+        self.assertEqual(self.sftp_client.grep(['-r', 'error', self.root]), self.expected('a.log', 'sub/b.log'))
+        self.assertEqual(self.sftp_client.grep(['error', self.root, self.root + '/missing']),
+                         [self.root + ': FAILED: Is a directory',
+                          self.root + '/missing: FAILED: [Errno 2] No such file'])
+
+    def test_remote(self):
+        """Test that --remote runs grep on the server, and falls back to SFTP where it cannot"""
+        self.assertEqual(self.sftp_client.grep(['--remote', '-r', '-i', 'error', self.root]),
+                         self.expected('a.log', 'sub/b.log -i'))
+        with patch.object(Archive, 'open_exec', side_effect=Archive.ExecUnavailable('exec not available')):
+            self.assertEqual(self.sftp_client.grep(['--remote', '-r', 'error', self.root]),
+                             self.expected('a.log', 'sub/b.log'))
+
+    def test_remote_noisy_stderr(self):
+        """Test that a grep writing more errors than the channel window holds still finishes"""
+        self.wrap_command('grep', '[ "$1" = -E ] && head -c %d /dev/zero | tr "\\0" w >&2'
+                          % (Flow.MAX_WINDOW + 4 * 1024 * 1024))
+        self.assertEqual(self.run_briefly(self.sftp_client.grep, ['--remote', '-r', 'error', self.root]),
+                         self.expected('a.log', 'sub/b.log'))
+
+    def test_remote_not_gnu(self):
+        """Test that a server whose grep is not GNU grep (-Z means something else) is searched over SFTP"""
+        self.wrap_command('grep', '[ "$1" = --version ] && { echo "grep (BSD grep, GNU compatible) 2.6.0"; exit 0; }')
+        with patch.object(Grep, 'search', wraps=Grep.search) as mock_search:
+            self.assertEqual(self.sftp_client.grep(['--remote', '-r', 'error', self.root]),
+                             self.expected('a.log', 'sub/b.log'))
+        mock_search.assert_called_once()
+
+
+class GrepShortReadTestCase(GrepTestCase):
+    """The same searches against a server returning at most 1000 bytes per READ"""
+    server_options = {'max_read_length': 1000}
+
+
+class StreamTestCase(LocalServerTestCase):
+    """open() returns file objects reading ahead and writing behind with pipelined requests"""
+
+    DATA = os.urandom(3 * 1024 * 1024 + 1234)
+
+    def test_read(self):
+        """Test that sequential, partial and whole reads return the file's bytes"""
+        path = self.write_remote('stream_read.bin', self.DATA)
+        with self.sftp_client.open(path, 'rb') as f:
+            self.assertEqual(f.read(10), self.DATA[:10])
+            self.assertEqual(f.read(100000), self.DATA[10:100010])
+            self.assertEqual(f.tell(), 100010)
+            self.assertEqual(f.read(), self.DATA[100010:])
+            self.assertEqual(f.read(), b'')
+        self.assertTrue(f.closed)
+        self.assertRaises(ValueError, f.read)
+
+    def test_seek(self):
+        """Test that reads after seeks anywhere in the file return the right bytes"""
+        path = self.write_remote('stream_seek.bin', self.DATA)
+        with self.sftp_client.open(path, 'rb', readahead=65536) as f:
+            for offset, length in ((2000000, 5000), (100, 70000), (2000000 + 5000, 10), (len(self.DATA) - 3, 10)):
+                self.assertEqual(f.seek(offset), offset)
+                self.assertEqual(f.read(length), self.DATA[offset:offset + length])
+            self.assertEqual(f.seek(-5, io.SEEK_END), len(self.DATA) - 5)
+            self.assertEqual(f.read(), self.DATA[-5:])
+            f.seek(10)
+            self.assertEqual(f.seek(20, io.SEEK_CUR), 30)
+            self.assertEqual(f.read(3), self.DATA[30:33])
+            self.assertRaises(ValueError, f.seek, -1)
+
+    def test_text_lines(self):
+        """Test that text mode decodes the file and iterates over its lines"""
+        lines = ['line %d é\n' % number for number in range(50000)]
+        path = self.write_remote('stream_lines.txt', ''.join(lines).encode())
+        with self.sftp_client.open(path) as f:
+            self.assertEqual(list(f), lines)
+        with self.sftp_client.open(path, 'rb') as f:
+            self.assertEqual(f.readline(), lines[0].encode())
+            self.assertEqual(f.readline(4), b'line')
+            self.assertEqual(f.readline(), b' 1 \xc3\xa9\n')
+
+    def test_write(self):
+        """Test that small writes are gathered and sent behind, and flush or close confirms them"""
+        path = self.server.local_path('stream_write.bin')
+        with self.sftp_client.open(path, 'wb', write_behind=100000) as f:
+            for start in range(0, len(self.DATA), 1000):
+                f.write(self.DATA[start:start + 1000])
+            f.flush()
+            self.assertEqual(self.read_local(path), self.DATA)
+            f.seek(10)
+            f.write(b'overwritten')
+        self.assertEqual(self.read_local(path), self.DATA[:10] + b'overwritten' + self.DATA[21:])
+
+        with self.sftp_client.open(path, 'a') as f:
+            f.write('appended')
+        self.assertEqual(self.read_local(path)[-8:], b'appended')
+        self.assertRaises(IOError, self.sftp_client.open, path, 'x')
+
+    def test_read_write(self):
+        """Test that a file opened with '+' reads what was written to it"""
+        path = self.write_remote('stream_update.bin', b'0123456789' * 10000)
+        with self.sftp_client.open(path, 'r+b') as f:
+            self.assertEqual(f.read(5), b'01234')
+            f.write(b'abc')
+            self.assertEqual(f.read(2), b'89')
+            f.seek(0)
+            self.assertEqual(f.read(12), b'01234abc8901')
+        with self.sftp_client.open(path, 'rb') as f:
+            self.assertRaises(io.UnsupportedOperation, f.write, b'x')
+
+    def test_growing_file(self):
+        """Test that reading past the end finds what was appended since the file was opened"""
+        path = self.write_remote('stream_growing.txt', b'first\n')
+        with self.sftp_client.open(path, 'rb') as f:
+            self.assertEqual(f.read(), b'first\n')
+            with open(path, 'ab') as appended:
+                appended.write(b'second\n')
+            self.assertEqual(f.readline(), b'second\n')
+
+    def test_errors(self):
+        """Test that missing files and invalid modes are refused"""
+        self.assertRaises(IOError, self.sftp_client.open, self.server.local_path('stream_missing'))
+        for mode in ('', 'rw', 'bb', 'q', 'rbt'):
+            self.assertRaises(ValueError, self.sftp_client.open, self.server.local_path('stream_missing'), mode)
+        self.assertRaises(TypeError, self.sftp_client.open, ['stream_missing'])
+
+
+class StreamShortReadTestCase(StreamTestCase):
+    """The same file objects against a server returning at most 1000 bytes per READ"""
+    server_options = {'max_read_length': 1000}
+
+
+class ShapedLinkTestCase(LocalServerTestCase):
+    """The link applies the configured latency and bandwidth"""
+    server_options = {'latency': 0.05, 'bandwidth': 1000000}
+
+    def test_latency(self):
+        """Test that a single round-trip costs at least the configured latency"""
+        start = time.monotonic()
+        self.sftp_client.connection.stat('.')
+        self.assertGreaterEqual(time.monotonic() - start, 0.05)
+
+    def test_bandwidth(self):
+        """Test that a 500 KB download takes at least half a second at 1 MB/s"""
+        self.write_remote('shaped.bin', os.urandom(500000))
+        start = time.monotonic()
+        self.sftp_client.get(['shaped.bin'])
+        self.assertGreaterEqual(time.monotonic() - start, 0.5)
+
+
+class ReconnectTestCase(LocalServerTestCase):
+    """Dropped connections are re-established and interrupted transfers resume"""
+    server_options = {'bandwidth': 2000000}
+
+    def drop_after(self, delay):
+        timer = threading.Timer(delay, self.server.drop_connections)
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+    def wait_for_drop(self):
+        deadline = time.monotonic() + 5
+        while self.sftp_client.connection_alive() and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+    def test_command_after_drop(self):
+        """Test that the next command reconnects and the remote working directory is kept"""
+        os.makedirs(self.server.local_path('reconnect_dir'), exist_ok=True)
+        self.sftp_client.cd([self.server.local_path('reconnect_dir')])
+        self.addCleanup(self.sftp_client.cd, [self.server.root])
+        connections = self.server.connections
+        self.server.drop_connections()
+        self.wait_for_drop()
+        self.sftp_client.mkdir(['made_after_drop'])
+        self.assertEqual(self.server.connections, connections + 1)
+        self.assertTrue(os.path.isdir(self.server.local_path('reconnect_dir/made_after_drop')))
+        self.assertEqual(self.sftp_client.pwd([]), self.server.local_path('reconnect_dir'))
+
+    def test_get_resumes(self):
+        """Test that a download interrupted half way completes intact on a new connection"""
+        data = os.urandom(2000000)
+        self.write_remote('resume_get.bin', data)
+        connections = self.server.connections
+        self.drop_after(0.5)
+        self.sftp_client.get(['--hash', 'sha256', 'resume_get.bin'])
+        self.assertGreater(self.server.connections, connections)
+        self.assertEqual(self.read_local(os.path.join(DOWNLOADS_DIRECTORY, 'resume_get.bin')), data)
+
+    def test_mirror_push_resumes(self):
+        """Test that a sync whose transfer reconnected finishes on the new connection and records it"""
+        data = os.urandom(2000000)
+        os.makedirs('resume_mirror/sub')
+        with open('resume_mirror/sub/big.bin', 'wb') as f:
+            f.write(data)
+        with open('resume_mirror/small.txt', 'wb') as f:
+            f.write(b'small')
+        connections = self.server.connections
+        self.drop_after(0.5)
+        result = self.sftp_client.mirror(['push', 'resume_mirror', self.server.local_path('resume_mirror')])
+        self.assertGreater(self.server.connections, connections)
+        self.assertEqual(result[-1], '2 uploaded, 2 created, 0 deleted, 0 failed; 2 directories listed of 2')
+        self.assertEqual(self.read_local(self.server.local_path('resume_mirror/sub/big.bin')), data)
+        result = self.sftp_client.mirror(['push', 'resume_mirror', self.server.local_path('resume_mirror')])
+        self.assertEqual(result, ['0 uploaded, 0 created, 0 deleted, 0 failed; 0 directories listed of 2'])
+
+    def test_put_mmap_resumes(self):
+        """Test that an mmap upload interrupted half way completes intact on a new connection"""
+        data = os.urandom(2000000)
+        with open('resume_put.bin', 'wb') as f:
+            f.write(data)
+        connections = self.server.connections
+        self.drop_after(0.5)
+        self.sftp_client.put(['--hash', 'sha256', 'resume_put.bin'])
+        self.assertGreater(self.server.connections, connections)
+        self.assertEqual(self.read_local(self.server.local_path('resume_put.bin')), data)
+
+    def test_batch_resumes(self):
+        """Test that getm and multi-file put continue on a new connection after a drop"""
+        files = {'resume_batch_%d.bin' % i: os.urandom(300000) for i in range(6)}
+        for name, data in files.items():
+            self.write_remote('resume_batch/' + name, data)
+            with open(name, 'wb') as f:
+                f.write(data)
+        connections = self.server.connections
+        self.drop_after(0.3)
+        self.sftp_client.getm(['resume_batch/' + name for name in sorted(files)])
+        self.assertGreater(self.server.connections, connections)
+        connections = self.server.connections
+        self.drop_after(0.3)
+        self.sftp_client.put(['-t', 'resumed_batch'] + sorted(files))
+        self.assertGreater(self.server.connections, connections)
+        for name, data in files.items():
+            self.assertEqual(self.read_local(os.path.join(DOWNLOADS_DIRECTORY, name)), data)
+            self.assertEqual(self.read_local(self.server.local_path('resumed_batch/' + name)), data)
+
+    def test_put_segments_resumes(self):
+        """Test that every segment of a segmented upload continues from its confirmed offset"""
+        data = os.urandom(2000000)
+        with open('resume_segments.bin', 'wb') as f:
+            f.write(data)
+        self.drop_after(0.5)
+        with patch.object(Transfer, 'MIN_SEGMENT_SIZE', 256 * 1024), self.assertLogs(level='WARNING') as logs:
+            self.sftp_client.put(['--segments', '4', 'resume_segments.bin'])
+        self.assertTrue(any('unconfirmed bytes' in line for line in logs.output))
+        self.assertEqual(self.read_local(self.server.local_path('resume_segments.bin')), data)
+
+
+class FastConnectTestCase(LocalServerTestCase):
+    """Host keys and private keys are cached, and the preferred algorithms are negotiated"""
+
+    def write_ed25519_key(self, passphrase=None):
+        """Create ~/.ssh/id_ed25519 (OpenSSH format) and authorize it on the server"""
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import ed25519
+        encryption = serialization.BestAvailableEncryption(passphrase.encode()) if passphrase \
+            else serialization.NoEncryption()
+        pem = ed25519.Ed25519PrivateKey.generate().private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.OpenSSH, encryption)
+        path = os.path.join(os.environ['HOME'], '.ssh', 'id_ed25519')
+        with open(path, 'wb') as f:
+            f.write(pem)
+        self.addCleanup(os.remove, path)
+        self.server.authorized_keys.append(paramiko.Ed25519Key.from_private_key_file(path, passphrase))
+
+    def test_preferred_algorithms(self):
+        """Test that AES-GCM is negotiated and curve25519 is offered first"""
+        transport = self.sftp_client.connection.sftp_client.get_channel().get_transport()
+        self.assertEqual(transport.remote_cipher, 'aes128-gcm@openssh.com')
+        self.assertEqual(transport.local_cipher, 'aes128-gcm@openssh.com')
+        self.assertTrue(transport.get_security_options().kex[0].startswith('curve25519'))
+
+    def test_known_hosts_parsed_once(self):
+        """Test that reconnecting does not parse known_hosts again"""
+        with patch.object(paramiko.HostKeys, 'load') as mock_load:
+            self.sftp_client.reconnect()
+        mock_load.assert_not_called()
+
+    def test_known_hosts_appended(self):
+        """Test that a new host key is appended without rewriting the existing entries"""
+        known_hosts = os.path.join(os.environ['HOME'], '.ssh', 'known_hosts')
+        with open(known_hosts, 'a') as f:
+            f.write('# keep this comment\n')
+        with patch.object(self.server, 'host', 'localhost'):
+            self.server.client().connection.close()
+        with open(known_hosts) as f:
+            lines = f.read().splitlines()
+        self.assertIn('# keep this comment', lines)
+        self.assertTrue(lines[-1].startswith('localhost ssh-rsa '))
+
+    @patch.dict(os.environ, {'SSH_AUTH_SOCK': ''})
+    def test_ed25519_key_decrypted_once(self):
+        """Test that an encrypted ed25519 key authenticates and is not decrypted again on reconnect"""
+        self.write_ed25519_key('secret')
+        with patch.object(paramiko.Ed25519Key, 'from_private_key_file',
+                          wraps=paramiko.Ed25519Key.from_private_key_file) as mock_load:
+            client = self.server.client(password=None, private_key_password='secret')
+            client.reconnect()
+        self.assertEqual(mock_load.call_count, 1)
+        self.assertEqual(client.pwd([]), self.server.root)
+        client.connection.close()
+
+    @patch.dict(os.environ, {'SSH_AUTH_SOCK': ''})
+    def test_keys_tried_over_one_transport(self):
+        """Test that a refused key is followed by the next one on the same connection"""
+        self.write_ed25519_key()
+        self.server.authorized_keys.clear()
+        path = os.path.join(os.environ['HOME'], '.ssh', 'id_rsa')
+        key = paramiko.RSAKey.generate(2048)
+        key.write_private_key_file(path)
+        self.addCleanup(os.remove, path)
+        self.server.authorized_keys.append(key)
+        with patch.object(paramiko, 'Transport', wraps=paramiko.Transport) as mock_transport:
+            client = self.server.client(password=None)
+        # the server's transports (in this process too) are made from sockets
+        self.assertEqual([call.args for call in mock_transport.call_args_list if isinstance(call.args[0], tuple)],
+                         [((self.server.host, self.server.port),)])
+        self.assertEqual(client.pwd([]), self.server.root)
+        client.connection.close()
+
+    @patch.dict(os.environ, {'SSH_AUTH_SOCK': ''})
+    def test_all_keys_refused(self):
+        """Test that the last key's refusal is raised"""
+        self.write_ed25519_key()
+        self.server.authorized_keys.clear()
+        with self.assertRaises(paramiko.AuthenticationException), self.assertLogs(level='CRITICAL'):
+            self.server.client(password=None)
+
+
+class BenchCommandTestCase(LocalServerTestCase):
+    """bench measures every setting and saves a profile that later connections use"""
+    server_options = {'compression': True}
+
+    def test_bench_save(self):
+        """Test that bench reports each setting and the saved profile is picked up on connect"""
+        lines = self.sftp_client.bench(['--size', '65536', '--save'])
+        self.assertTrue(any(line.startswith('cipher       aes128-ctr') for line in lines))
+        compression_lines = [line for line in lines if line.startswith('compression')]
+        self.assertEqual(len(compression_lines), 2)
+        self.assertFalse(any('not' in line for line in compression_lines))
+        profile = Connect.load_profile(self.server.host, self.server.port)
+        self.assertIn(profile['ciphers'][0], paramiko.Transport._preferred_ciphers)
+        self.assertNotIn(profile['ciphers'][0], Bench.WEAK_ALGORITHMS)
+        self.assertIn('compression', profile)
+        self.assertFalse(self.sftp_client.connection.exists(Bench.SCRATCH_FILE))
+
+        client = self.server.client()
+        transport = client.connection.sftp_client.get_channel().get_transport()
+        self.assertEqual(transport.local_cipher, profile['ciphers'][0])
+        self.assertEqual(transport.local_compression != 'none', profile['compression'])
+        client.connection.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
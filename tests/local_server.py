@@ -0,0 +1,565 @@
+#!/usr/bin/env python3
+"""In-process SFTP/SSH server used as a stand-in for a real host in tests and benchmarks
+
+    LocalSFTPServer serves a temporary directory over a real paramiko transport on 127.0.0.1,
+    so the SFTP class can be exercised end to end without network access or credentials.
+
+    The link between the client and the server can be shaped with an artificial round-trip
+    latency (seconds) and a bandwidth cap (bytes/second), and the SFTP extensions advertised
+    in the VERSION packet are configurable. Remote command execution (used by cp_r and
+    execute()) is served by running the command in a local shell inside the server root.
+
+    Typical use:
+
+        with sandbox(), LocalSFTPServer(latency=0.02) as server:
+            client = server.client()
+            client.ls([])
+"""
+import contextlib
+import hashlib
+import logging
+import os
+import queue
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import paramiko
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface, ServerInterface
+from paramiko.message import Message
+from paramiko.sftp import (CMD_EXTENDED, CMD_EXTENDED_REPLY, CMD_INIT, CMD_VERSION, SFTP_BAD_MESSAGE,
+                           SFTP_FAILURE, SFTP_OK, SFTP_OP_UNSUPPORTED, SFTPError)
+
+# fix for running as script(if project root not in PYTHONPATH)
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+DEFAULT_USERNAME = 'sftp_tester'
+DEFAULT_PASSWORD = 'sftp_tester_password'
+
+# extensions advertised by default, mirroring what paramiko's own server announces
+DEFAULT_EXTENSIONS = {'check-file': 'md5,sha1,sha256,sha512',
+                      'posix-rename@openssh.com': '1'}
+
+# hash algorithms understood by the "check-file" extension
+CHECK_FILE_ALGORITHMS = ('md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512')
+
+# largest packet, READ and WRITE reported by the "limits@openssh.com" extension (as OpenSSH does)
+MAX_PACKET_LENGTH = 256 * 1024
+MAX_READ_WRITE_LENGTH = MAX_PACKET_LENGTH - 1024
+
+_host_key = None
+_host_key_lock = threading.Lock()
+
+
+def host_key():
+    """Return the host key shared by every server in this process (generated on first use)"""
+    global _host_key
+    with _host_key_lock:
+        if _host_key is None:
+            _host_key = paramiko.RSAKey.generate(2048)
+        return _host_key
+
+
+@contextlib.contextmanager
+def sandbox():
+    """Run the enclosed block from a scratch working directory with a scratch $HOME
+
+        The SFTP class writes its downloads directory and history file to the working directory,
+        and reads/writes ~/.ssh/known_hosts, so tests must never touch the real ones.
+    """
+    old_cwd = os.getcwd()
+    old_home = os.environ.get('HOME')
+    workdir = tempfile.mkdtemp(prefix='sftp_sandbox_')
+    home = os.path.join(workdir, 'home')
+    os.makedirs(os.path.join(home, '.ssh'))
+    os.environ['HOME'] = home
+    os.chdir(workdir)
+    try:
+        yield workdir
+    finally:
+        os.chdir(old_cwd)
+        if old_home is None:
+            del os.environ['HOME']
+        else:
+            os.environ['HOME'] = old_home
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+class LocalSFTPServer(object):
+    """A threaded SSH server exposing a local directory over SFTP and exec channels
+
+        :param root: directory to serve; a temporary directory is created (and removed) if None
+        :param latency: artificial round-trip time added to the link, in seconds
+        :param bandwidth: maximum link throughput in each direction, in bytes/second (None = unlimited)
+        :param extensions: dict of SFTP extension name -> data to advertise; only advertised
+            extensions are honoured, everything else is answered with SSH_FX_OP_UNSUPPORTED
+        :param allow_exec: accept "exec" channel requests (remote shell commands)
+        :param authorized_keys: public keys accepted for publickey authentication
+        :param compression: accept clients' requests for SSH (zlib) compression
+        :param max_read_length: return at most this many bytes per READ, as servers are allowed to
+            (also reported by "limits@openssh.com" when it is advertised)
+    """
+
+    def __init__(self, root=None, username=DEFAULT_USERNAME, password=DEFAULT_PASSWORD, latency=0.0,
+                 bandwidth=None, extensions=None, allow_exec=True, authorized_keys=None, compression=False,
+                 max_read_length=None):
+        self._owns_root = root is None
+        self.root = os.path.realpath(root or tempfile.mkdtemp(prefix='sftp_root_'))
+        self.username = username
+        self.password = password
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.extensions = dict(DEFAULT_EXTENSIONS if extensions is None else extensions)
+        self.allow_exec = allow_exec
+        self.authorized_keys = list(authorized_keys or [])
+        self.compression = compression
+        self.max_read_length = max_read_length
+        # largest WRITE payload received, so tests can check request sizes
+        self.largest_write = 0
+        self.host = '127.0.0.1'
+        self.port = None
+        self.connections = 0
+        self._listener = None
+        self._accept_thread = None
+        self._transports = []
+        self._links = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_exc):
+        self.stop()
+
+    def start(self):
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((self.host, 0))
+        self._listener.listen(16)
+        self.port = self._listener.getsockname()[1]
+        self._accept_thread = threading.Thread(target=self._accept_loop, name='sftp-accept', daemon=True)
+        self._accept_thread.start()
+        logging.debug('Local SFTP server serving ' + self.root + ' on port ' + str(self.port))
+        return self
+
+    def stop(self):
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+        self.drop_connections()
+        if self._owns_root:
+            shutil.rmtree(self.root, ignore_errors=True)
+
+    def local_path(self, remote_path):
+        """Map a path relative to the remote home directory to the backing local path"""
+        return os.path.join(self.root, remote_path)
+
+    def client(self, **kwargs):
+        """Create a connected SFTPClient.Client.SFTP for this server (run inside sandbox())"""
+        from SFTPClient.Client import SFTP
+        kwargs.setdefault('password', self.password)
+        return SFTP(self.host, self.username, port=self.port, **kwargs)
+
+    def drop_connections(self):
+        """Abruptly close every live SSH connection, as a network failure would"""
+        with self._lock:
+            transports, self._transports = self._transports, []
+            links, self._links = self._links, []
+        for link in links:
+            link.close()
+        for transport in transports:
+            transport.close()
+
+    def _accept_loop(self):
+        while True:
+            try:
+                sock, _address = self._listener.accept()
+            except (OSError, AttributeError):
+                return
+            threading.Thread(target=self._handle, args=(sock,), daemon=True).start()
+
+    def _handle(self, sock):
+        if self.latency or self.bandwidth:
+            outer, inner = socket.socketpair()
+            link = _ShapedLink(sock, outer, self.latency / 2.0, self.bandwidth)
+            with self._lock:
+                self._links.append(link)
+            sock = inner
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(host_key())
+        transport.use_compression(self.compression)
+        transport.set_subsystem_handler('sftp', _SFTPServer, _FilesystemInterface)
+        with self._lock:
+            self._transports.append(transport)
+            self.connections += 1
+        try:
+            transport.start_server(server=_ServerInterface(self))
+        except (paramiko.SSHException, EOFError, OSError) as e:
+            logging.debug('Local SFTP server handshake failed: ' + str(e))
+            transport.close()
+
+    def _run_command(self, channel, command):
+        """Run an exec request in a local shell rooted at the server directory"""
+        proc = subprocess.Popen(command.decode('utf-8'), shell=True, cwd=self.root,
+                                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+        def feed_stdin():
+            try:
+                for data in iter(lambda: channel.recv(32768), b''):
+                    proc.stdin.write(data)
+                    proc.stdin.flush()
+            except (OSError, EOFError, ValueError):
+                pass
+            finally:
+                with contextlib.suppress(OSError, ValueError):
+                    proc.stdin.close()
+
+        def drain(stream, send):
+            for data in iter(lambda: stream.read1(32768), b''):
+                send(data)
+
+        threading.Thread(target=feed_stdin, daemon=True).start()
+        stderr_thread = threading.Thread(target=drain, args=(proc.stderr, channel.sendall_stderr), daemon=True)
+        stderr_thread.start()
+        try:
+            drain(proc.stdout, channel.sendall)
+            stderr_thread.join()
+            channel.send_exit_status(proc.wait())
+        except (OSError, EOFError, paramiko.SSHException):
+            proc.kill()
+        finally:
+            channel.close()
+
+
+class _ShapedLink(object):
+    """Relays bytes between two sockets, delaying and rate limiting each direction independently"""
+
+    def __init__(self, left, right, delay, bandwidth):
+        self._sockets = (left, right)
+        self._delay = delay
+        self._bandwidth = bandwidth
+        for src, dst in ((left, right), (right, left)):
+            pending = queue.Queue()
+            threading.Thread(target=self._receive, args=(src, pending), daemon=True).start()
+            threading.Thread(target=self._deliver, args=(dst, pending), daemon=True).start()
+
+    def close(self):
+        for sock in self._sockets:
+            with contextlib.suppress(OSError):
+                sock.shutdown(socket.SHUT_RDWR)
+            sock.close()
+
+    def _receive(self, src, pending):
+        try:
+            for data in iter(lambda: src.recv(65536), b''):
+                pending.put((time.monotonic() + self._delay, data))
+        except OSError:
+            pass
+        pending.put((None, None))
+
+    def _deliver(self, dst, pending):
+        link_free = 0.0
+        while True:
+            due, data = pending.get()
+            if data is None:
+                with contextlib.suppress(OSError):
+                    dst.shutdown(socket.SHUT_WR)
+                return
+            now = time.monotonic()
+            if self._bandwidth:
+                # the packet cannot leave before the previous one has finished serializing
+                link_free = max(due, link_free, now) + len(data) / float(self._bandwidth)
+                due = link_free
+            if due > now:
+                time.sleep(due - now)
+            try:
+                dst.sendall(data)
+            except OSError:
+                return
+
+
+class _ServerInterface(ServerInterface):
+    def __init__(self, fixture):
+        self.fixture = fixture
+
+    def get_allowed_auths(self, username):
+        return 'password,publickey'
+
+    def check_auth_password(self, username, password):
+        if username == self.fixture.username and password == self.fixture.password:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_auth_publickey(self, username, key):
+        if username == self.fixture.username and any(key == k for k in self.fixture.authorized_keys):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_exec_request(self, channel, command):
+        if not self.fixture.allow_exec:
+            return False
+        threading.Thread(target=self.fixture._run_command, args=(channel, command), daemon=True).start()
+        return True
+
+
+class _SFTPServer(SFTPServer):
+    """SFTPServer with configurable advertised extensions and a complete "check-file" implementation"""
+
+    def _send_server_version(self):
+        t, data = self._read_packet()
+        if t != CMD_INIT:
+            raise SFTPError('Incompatible sftp protocol')
+        version = struct.unpack('>I', data[:4])[0]
+        msg = Message()
+        msg.add_int(3)
+        for name, value in sorted(self.get_server().fixture.extensions.items()):
+            msg.add_string(name)
+            msg.add_string(value)
+        self._send_packet(CMD_VERSION, msg)
+        return version
+
+    def _process(self, t, request_number, msg):
+        if t == CMD_EXTENDED:
+            tag = msg.get_text()
+            if tag not in self.get_server().fixture.extensions:
+                self._send_status(request_number, SFTP_OP_UNSUPPORTED)
+                return
+            if tag == 'check-file':
+                self._check_file(request_number, msg)
+                return
+            if tag == 'limits@openssh.com':
+                self._limits(request_number)
+                return
+            # let paramiko handle the remaining extensions it knows about
+            msg.rewind()
+            msg.get_int()
+        super()._process(t, request_number, msg)
+
+    def _check_file(self, request_number, msg):
+        handle = msg.get_binary()
+        algorithms = msg.get_list()
+        start = msg.get_int64()
+        length = msg.get_int64()
+        block_size = msg.get_int()
+        if handle not in self.file_table:
+            self._send_status(request_number, SFTP_BAD_MESSAGE, 'Invalid handle')
+            return
+        algorithm = next((a for a in algorithms if a in CHECK_FILE_ALGORITHMS), None)
+        if algorithm is None:
+            self._send_status(request_number, SFTP_FAILURE, 'No supported hash types found')
+            return
+        f = self.file_table[handle]
+        if length == 0:
+            st = f.stat()
+            if not isinstance(st, SFTPAttributes):
+                self._send_status(request_number, st, 'Unable to stat file')
+                return
+            length = st.st_size - start
+        if block_size == 0:
+            block_size = max(length, 256)
+        if block_size < 256:
+            self._send_status(request_number, SFTP_FAILURE, 'Block size too small')
+            return
+
+        digests = b''
+        offset = start
+        end = start + length
+        while offset < end or not digests:
+            block_end = min(offset + block_size, end)
+            hash_obj = hashlib.new(algorithm)
+            while offset < block_end:
+                data = f.read(offset, min(block_end - offset, 65536))
+                if not isinstance(data, bytes):
+                    self._send_status(request_number, data, 'Unable to hash file')
+                    return
+                if not data:
+                    break
+                hash_obj.update(data)
+                offset += len(data)
+            digests += hash_obj.digest()
+            if offset < block_end:
+                break
+
+        reply = Message()
+        reply.add_int(request_number)
+        reply.add_string('check-file')
+        reply.add_string(algorithm)
+        reply.add_bytes(digests)
+        self._send_packet(CMD_EXTENDED_REPLY, reply)
+
+
+    def _limits(self, request_number):
+        reply = Message()
+        reply.add_int(request_number)
+        reply.add_int64(MAX_PACKET_LENGTH)
+        reply.add_int64(self.get_server().fixture.max_read_length or MAX_READ_WRITE_LENGTH)
+        reply.add_int64(MAX_READ_WRITE_LENGTH)
+        reply.add_int64(0)
+        self._send_packet(CMD_EXTENDED_REPLY, reply)
+
+
+class _Handle(SFTPHandle):
+    def __init__(self, fixture, flags=0):
+        super().__init__(flags)
+        self.fixture = fixture
+
+    def read(self, offset, length):
+        if self.fixture.max_read_length:
+            length = min(length, self.fixture.max_read_length)
+        return super().read(offset, length)
+
+    def write(self, offset, data):
+        self.fixture.largest_write = max(self.fixture.largest_write, len(data))
+        return super().write(offset, data)
+
+    def stat(self):
+        try:
+            return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def chattr(self, attr):
+        try:
+            SFTPServer.set_file_attr(self.filename, attr)
+            return SFTP_OK
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+
+class _FilesystemInterface(SFTPServerInterface):
+    """Serves the real filesystem, with relative paths resolved against the fixture root
+
+        Absolute paths are not translated, so paths seen over SFTP and by exec'd commands agree.
+    """
+
+    def __init__(self, server, *args, **kwargs):
+        super().__init__(server, *args, **kwargs)
+        self.root = server.fixture.root
+        self.fixture = server.fixture
+
+    def _local(self, path):
+        return os.path.join(self.root, path)
+
+    def canonicalize(self, path):
+        return os.path.normpath(self._local(path))
+
+    def list_folder(self, path):
+        path = self._local(path)
+        try:
+            entries = []
+            for name in os.listdir(path):
+                attr = SFTPAttributes.from_stat(os.lstat(os.path.join(path, name)))
+                attr.filename = name
+                entries.append(attr)
+            return entries
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def stat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.stat(self._local(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return SFTPAttributes.from_stat(os.lstat(self._local(path)))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        path = self._local(path)
+        try:
+            mode = getattr(attr, 'st_mode', None)
+            fd = os.open(path, flags, 0o666 if mode is None else mode)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        if (flags & os.O_CREAT) and (attr is not None):
+            attr._flags &= ~attr.FLAG_PERMISSIONS
+            SFTPServer.set_file_attr(path, attr)
+        if flags & os.O_WRONLY:
+            fstr = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            fstr = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            fstr = 'rb'
+        try:
+            f = os.fdopen(fd, fstr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        handle = _Handle(self.fixture, flags)
+        handle.filename = path
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def remove(self, path):
+        try:
+            os.remove(self._local(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        newpath = self._local(newpath)
+        if os.path.exists(newpath):
+            return SFTP_FAILURE
+        try:
+            os.rename(self._local(oldpath), newpath)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def posix_rename(self, oldpath, newpath):
+        try:
+            os.rename(self._local(oldpath), self._local(newpath))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def mkdir(self, path, attr):
+        path = self._local(path)
+        try:
+            os.mkdir(path)
+            if attr is not None:
+                SFTPServer.set_file_attr(path, attr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def rmdir(self, path):
+        try:
+            os.rmdir(self._local(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def chattr(self, path, attr):
+        try:
+            SFTPServer.set_file_attr(self._local(path), attr)
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def symlink(self, target_path, path):
+        try:
+            os.symlink(target_path, self._local(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)
+        return SFTP_OK
+
+    def readlink(self, path):
+        try:
+            return os.readlink(self._local(path))
+        except OSError as e:
+            return SFTPServer.convert_errno(e.errno)